@@ -0,0 +1,1055 @@
+import os
+import tempfile
+from collections import OrderedDict, defaultdict
+from copy import deepcopy
+
+import gsd
+import gsd.hoomd
+import gsd.pygsd
+import mbuild as mb
+import numpy as np
+from mbuild.utils.io import import_, run_from_ipython
+from oset import oset as OrderedSet
+
+from utils import (
+    AtomisticRecord,
+    FrameCache,
+    _compound_topology,
+    _make_topology,
+    _pybel_box,
+    _pybel_names,
+    amber_dict,
+    distance,
+    mb_to_freud_box,
+    pbc_bond_images,
+    perceive_bonds,
+    pybel_to_arrays,
+    v_distance,
+)
+
+
+class CG_Compound(mb.Compound):
+    def __init__(self):
+        super().__init__()
+        self.box = None
+        self.atomistic = None
+        self._cache = {}
+
+    def _get_cache(self):
+        # compounds made by mb.clone skip __init__
+        return self.__dict__.setdefault("_cache", {})
+
+    def _clear_cache(self, *keys):
+        """
+        Clears the cached particle list, names, and bonds of this compound and
+        of all its ancestors. If keys are given only those entries are cleared.
+        Call this after renaming particles directly.
+        """
+        if keys:
+            # the topology is built from the names and bonds
+            keys = set(keys) | {"topology"}
+        comp = self
+        while comp is not None:
+            cache = comp.__dict__.get("_cache")
+            if cache is not None:
+                if keys:
+                    for key in keys:
+                        cache.pop(key, None)
+                else:
+                    cache.clear()
+            comp = comp.parent
+
+    @staticmethod
+    def _clear_parent_caches(particles, *keys):
+        """
+        Clears the caches of the compounds holding particles, which may be
+        below the compound a change was made through
+        """
+        parents = {p.parent for p in particles if isinstance(p.parent, CG_Compound)}
+        for parent in parents:
+            parent._clear_cache(*keys)
+
+    def add(self, *args, **kwargs):
+        super().add(*args, **kwargs)
+        self._clear_cache()
+
+    def remove(self, objs_to_remove):
+        if isinstance(objs_to_remove, mb.Compound):
+            objs_to_remove = [objs_to_remove]
+        objs_to_remove = list(objs_to_remove)
+        particles = [
+            p for obj in objs_to_remove for p in obj.particles(include_ports=True)
+        ]
+        parents = [obj.parent for obj in objs_to_remove] + [
+            p.parent for p in particles
+        ]
+        super().remove(objs_to_remove)
+        self._clear_cache()
+        for parent in parents:
+            if isinstance(parent, CG_Compound):
+                parent._clear_cache()
+
+    def add_bond(self, particle_pair):
+        super().add_bond(particle_pair)
+        self._clear_cache("bonds")
+        self._clear_parent_caches(particle_pair, "bonds")
+
+    def remove_bond(self, particle_pair):
+        super().remove_bond(particle_pair)
+        self._clear_cache("bonds")
+        self._clear_parent_caches(particle_pair, "bonds")
+
+    def _particle_list(self):
+        """
+        Returns the cached list of particles in the compound
+        """
+        cache = self._get_cache()
+        if "particles" not in cache:
+            cache["particles"] = [part for part in self.particles()]
+        return cache["particles"]
+
+    def _particle_index(self):
+        """
+        Returns the cached dict of particle -> index in the compound
+        """
+        cache = self._get_cache()
+        if "index" not in cache:
+            cache["index"] = {p: i for i, p in enumerate(self._particle_list())}
+        return cache["index"]
+
+    def _name_map(self):
+        """
+        Returns the cached dict of particle name -> np.ndarray of indices
+        """
+        cache = self._get_cache()
+        if "names" not in cache:
+            names = np.array([p.name for p in self._particle_list()], dtype=object)
+            if len(names) == 0:
+                cache["names"] = {}
+                return cache["names"]
+            unique, inverse = np.unique(names, return_inverse=True)
+            order = np.argsort(inverse, kind="stable")
+            splits = np.cumsum(np.bincount(inverse))[:-1]
+            # shared by every caller, so guard against in-place changes
+            order.flags.writeable = False
+            cache["names"] = dict(zip(unique.tolist(), np.split(order, splits)))
+        return cache["names"]
+
+    def bond_array(self):
+        """
+        Returns the particle indices of every bond in the compound
+
+        Returns
+        -------
+        np.ndarray (B,2)
+        """
+        cache = self._get_cache()
+        if "bonds" not in cache:
+            index = self._particle_index()
+            cache["bonds"] = np.array(
+                [(index[a], index[b]) for a, b in self.bonds()], dtype=int
+            ).reshape(-1, 2)
+        return cache["bonds"]
+
+    def remove_mask(self, mask):
+        """
+        Removes every particle where mask is True with a single call to
+        remove().
+
+        Parameters
+        ----------
+        mask : np.ndarray (N,) of bool, in the order of self.particles()
+        """
+        mask = np.asarray(mask, dtype=bool)
+        particles = self._particle_list()
+        if len(mask) != len(particles):
+            raise ValueError(
+                f"Mask has length {len(mask)} but compound has {len(particles)} "
+                "particles."
+            )
+        if mask.any():
+            self.remove([particles[i] for i in np.flatnonzero(mask)])
+
+    def _remove_ports(self):
+        # Remove residual ports
+        ports = [child for child in self.children if type(child) == mb.port.Port]
+        if ports:
+            self.remove(ports)
+
+    @classmethod
+    def from_gsd(
+        cls,
+        gsdfile,
+        frame=-1,
+        coords_only=False,
+        scale=1.0,
+        infer_bonds=False,
+        type_elements=None,
+    ):
+        """
+        Given a trajectory gsd file creates an CG_Compound.
+        If there are multiple separate molecules, they are returned
+        as one compound.
+
+        Parameters
+        ----------
+        gsdfile : str, filename, or a FrameCache
+        frame : int, frame number (default -1)
+        coords_only : bool (default False)
+            If True, return compound with no bonds
+        scale : float, scaling factor multiplied to coordinates (default 1.0)
+        infer_bonds : bool (default False)
+            If True, bonds are found from interatomic distances using
+            perceive_bonds() instead of read from the file. Use this for files
+            without bonds. Coordinates must be in nm after scaling.
+        type_elements : dict of str, element symbol of each particle type used
+            by infer_bonds when types are not elements (default None), e.g.
+            forcefield_elements("forcefields/p3ht-aa.xml")
+
+        Returns
+        -------
+        CG_Compound
+        """
+        if isinstance(gsdfile, FrameCache):
+            return cls._from_frame_cache(
+                gsdfile, frame, coords_only, scale, infer_bonds, type_elements
+            )
+
+        f = gsd.pygsd.GSDFile(open(gsdfile, "rb"))
+        t = gsd.hoomd.HOOMDTrajectory(f)
+
+        snap = t[frame]
+        bond_array = snap.bonds.group
+        n_atoms = snap.particles.N
+
+        # Add particles
+        comp = cls()
+        comp.box = mb.box.Box(lengths=snap.configuration.box[:3] * scale)
+        particles = []
+        for i in range(n_atoms):
+            name = snap.particles.types[snap.particles.typeid[i]]
+            xyz = snap.particles.position[i] * scale
+            charge = snap.particles.charge[i]
+
+            atom = mb.Particle(name=name, pos=xyz, charge=charge)
+            comp.add(atom, label=str(i))
+            particles.append(atom)
+
+        if infer_bonds:
+            box = np.array(snap.configuration.box, dtype=float)
+            box[:3] *= scale
+            comp.perceive_bonds(box=box, type_elements=type_elements)
+        elif not coords_only:
+            # Add bonds
+            for atom1, atom2 in bond_array.tolist():
+                comp.add_bond([particles[atom1], particles[atom2]])
+        f.close()
+        return comp
+
+    @classmethod
+    def _from_frame_cache(
+        cls, cache, frame, coords_only, scale, infer_bonds, type_elements
+    ):
+        snap = cache[frame]
+        names = np.array(snap.types)[snap.typeid].tolist()
+        box = np.array(snap.box, dtype=float)
+        box[:3] *= scale
+        bonds = None if coords_only or infer_bonds else cache.bonds
+        comp = cls.from_arrays(
+            np.asarray(snap.position, dtype=float) * scale,
+            names,
+            bonds=bonds,
+            box=mb.box.Box(lengths=box[:3]),
+        )
+        if infer_bonds:
+            comp.perceive_bonds(box=box, type_elements=type_elements)
+        return comp
+
+    def perceive_bonds(self, box=None, tolerance=0.045, type_elements=None):
+        """
+        Finds bonds from interatomic distances (see perceive_bonds()) and adds
+        them to the compound. Names in type_elements and AMBER style names are
+        converted to elements for the radius lookup; particle names are not
+        changed.
+
+        Parameters
+        ----------
+        box : box accepted by box_matrix() (default None)
+            If None, self.box is used.
+        tolerance : float, added to the sum of covalent radii in nm (default 0.045)
+        type_elements : dict of str, element symbol of each particle name
+            (default None), e.g. forcefield_elements("forcefields/p3ht-aa.xml")
+
+        Returns
+        -------
+        np.ndarray (B,2), particle indices of the added bonds
+        """
+        if box is None:
+            box = self.box
+        type_elements = type_elements or {}
+        particles = [part for part in self.particles()]
+        elements = [
+            type_elements.get(part.name, amber_dict.get(part.name, part.name))
+            for part in particles
+        ]
+        bonds = perceive_bonds(self.xyz, elements, box=box, tolerance=tolerance)
+        for i, j in bonds.tolist():
+            self.add_bond((particles[i], particles[j]))
+        return bonds
+
+    def amber_to_element(self):
+        """
+        Pybel does not know how to parse atoms names in AMBER style
+        so this functions renames them to their atomistic counterparts
+        """
+        particles = self._particle_list()
+        for name, inds in self._name_map().items():
+            element = amber_dict[name]
+            for i in inds:
+                particles[i].name = element
+        self._clear_cache("names")
+        self._clear_parent_caches(particles, "names")
+
+    def remove_hydrogens(self):
+        """
+        Remove all particles with name = "H" in the compound
+        """
+        mask = np.zeros(len(self._particle_list()), dtype=bool)
+        mask[self.get_name_inds("H")] = True
+        self.remove_mask(mask)
+
+    def get_molecules(self):
+        """
+        Translates bond_graph.connected_components to particle indices in compound
+
+        Returns
+        -------
+        list of sets of connected atom indices
+        """
+        index = self._particle_index()
+        molecules = []
+        for group in self.bond_graph.connected_components():
+            molecules.append({index[particle] for particle in group})
+        return molecules
+
+    def get_bonds(self):
+        """
+        Translates bond_graph.bond_edges to particle indices in compound
+
+        Returns
+        -------
+        list of tuples of bonded atom indices sorted
+        """
+        bonds = np.sort(self.bond_array(), axis=1)
+        # This sorting is required for coarse-graining
+        bonds = bonds[np.lexsort((bonds[:, 1], bonds[:, 0]))]
+        return [tuple(bond) for bond in bonds.tolist()]
+
+    @classmethod
+    def from_arrays(cls, xyz, names, bonds=None, box=None, residues=None):
+        """
+        Builds a CG_Compound from arrays in one pass.
+
+        Parameters
+        ----------
+        xyz : np.ndarray (N,3), particle positions
+        names : list of str (N,), particle names
+        bonds : np.ndarray (B,2), particle indices of each bond (default None)
+        box : mbuild.box.Box (default None)
+        residues : np.ndarray (N,), residue index of each particle (default None)
+            Particles which share a residue index are grouped into a
+            sub-compound; negative indices are added directly.
+
+        Returns
+        -------
+        CG_Compound
+        """
+        comp = cls()
+        particles = [mb.Particle(name=name, pos=pos) for name, pos in zip(names, xyz)]
+
+        if residues is None:
+            comp.add(particles)
+        else:
+            children = []
+            res_cmpds = {}
+            for particle, res in zip(particles, np.asarray(residues).tolist()):
+                if res < 0:
+                    children.append(particle)
+                    continue
+                if res not in res_cmpds:
+                    res_cmpds[res] = cls()
+                    children.append(res_cmpds[res])
+                res_cmpds[res].add(particle)
+            comp.add(children)
+
+        if bonds is not None:
+            for i, j in np.asarray(bonds).reshape(-1, 2).tolist():
+                comp.add_bond((particles[i], particles[j]))
+
+        comp.box = box
+        return comp
+
+    def from_pybel(pybel_mol, use_element=True):
+        """
+        Create a Compound from a Pybel.Molecule
+
+        Parameters
+        ---------
+        pybel_mol: pybel.Molecule
+        use_element : bool, default True
+            If True, construct mb Particles based on the pybel Atom's element.
+            If False, constructs mb Particles based on the pybel Atom's type
+
+        Returns
+        ------
+        cmpd : CG_Compound
+        """
+        arrays = pybel_to_arrays(pybel_mol)
+        names = _pybel_names(arrays, use_element=use_element)
+        box = _pybel_box(pybel_mol)
+
+        cmpd = CG_Compound.from_arrays(
+            arrays["xyz"],
+            names,
+            bonds=arrays["bonds"],
+            box=box,
+            residues=arrays["residues"],
+        )
+        if box is not None:
+            cmpd.periodicity = box.lengths
+
+        return cmpd
+
+    def wrap(self):
+        """
+        Finds particles which are out of the box and translates
+        them to within the box.
+        """
+        try:
+            freud_box = mb_to_freud_box(self.box)
+        except TypeError:
+            print("Can't wrap because CG_Compound.box values aren't assigned.")
+            return
+        particles = [part for part in self.particles()]
+        # find rows where particles are out of the box
+        for row in np.argwhere(abs(self.xyz) > self.box.maxs / 2)[:, 0]:
+            new_xyz = freud_box.wrap(particles[row].pos)
+            particles[row].translate_to(new_xyz)
+
+    def unwrap(self, d_tolerance=0.22, _count=0):
+        """
+        Used to correct molecules which span the periodic boundary by translating particles
+        to their real-space position. The function uses a distance tolerance to detect
+        bonds which span the periodic boundary and from those determines which particle
+        should be considered an outlier, finds other particles the outlier is bonded to,
+        and shifts their position.
+
+        Parameters
+        ----------
+        d_tolerance = float, distance beyond which a bond is considered "bad" (default=0.22)
+        _count = int, used in recursive algorithm to prevent function from getting stuck
+                 fixing bonds which span the pbc -- user should not set this value.
+
+        if function is getting stuck in an endless loop, try adjusting d_tolerance
+        """
+
+        molecules = self.get_molecules()
+        particles = self._particle_list()
+
+        def check_bad_bonds(compound):
+            """
+            Used for identifying particles whose bonds span the periodic boundary.
+            Finds particles indices in the compound with bonds longer than the
+            distance tolerance.
+
+            Parameters
+            ----------
+            compound : CG_Compound
+
+            Returns
+            -------
+            list of tuples of particle indices
+            """
+            bonds = compound.bond_array()
+            xyz = compound.xyz
+            lengths = np.linalg.norm(xyz[bonds[:, 0]] - xyz[bonds[:, 1]], axis=1)
+            return [tuple(bond) for bond in bonds[lengths > d_tolerance].tolist()]
+
+        maybe_outliers = check_bad_bonds(self)
+        if not maybe_outliers:
+            print(
+                f"No bonds found longer than {d_tolerance}. Either compound doesn't need"
+                + " unwrapping or d_tolerance is too small. No changes made."
+            )
+            return
+
+        def find_outliers(compound):
+            """
+            Finds "outliers" (bonded particles which span the periodic boundary).
+            Starts by finding bonds that are too long, then determines which particle
+            in the pair is an outlier based on whether removal of that particle reduces
+            the average distance from the particles in the molecule to the geometric center.
+            From these, the function follows the bond graph and adds all particles
+            bonded to the outliers.
+
+            Parameters
+            ----------
+            compound : CG_Compound
+
+            Returns
+            -------
+            set of the particle indices of all outliers in the compound.
+            """
+
+            def _is_outlier(index):
+                for molecule in molecules:
+                    if index in molecule:
+                        test_molecule = molecule.copy()
+                        test_molecule.remove(index)
+                        a = compound.xyz[list(molecule), :]
+                        b = compound.xyz[list(test_molecule), :]
+                        center_a = np.mean(a, axis=0)
+                        center_b = np.mean(b, axis=0)
+                        avg_dist_a = np.mean(v_distance(a, center_a))
+                        avg_dist_b = np.mean(v_distance(b, center_b))
+                return avg_dist_a > avg_dist_b
+
+            def _d_to_center(index):
+                for molecule in molecules:
+                    if index in molecule:
+                        mol_xyz = compound.xyz[list(molecule), :]
+                        center = np.mean(mol_xyz, axis=0)
+                        dist = distance(particles[index].pos, center)
+                return dist
+
+            outliers = set()
+            checked = set()
+            for tup in maybe_outliers:
+                if _is_outlier(tup[0]) and _is_outlier(tup[1]):
+                    # add whichever is further from the center
+                    d_0 = _d_to_center(tup[0])
+                    d_1 = _d_to_center(tup[1])
+                    if d_0 > d_1:
+                        outliers.add(tup[0])
+                    elif d_1 > d_0:
+                        outliers.add(tup[1])
+                    else:
+                        raise RuntimeError(
+                            f"Can't determine which is outlier between indices {tup}"
+                        )
+                elif _is_outlier(tup[0]):
+                    outliers.add(tup[0])
+                elif _is_outlier(tup[1]):
+                    outliers.add(tup[1])
+                checked.add(tup[0])
+                checked.add(tup[1])
+
+            starts = outliers.copy()
+            while starts:
+                index = starts.pop()
+                outliers.update(bond_dict[index] - checked)
+                starts.update(bond_dict[index] - checked)
+                checked.add(index)
+            return outliers
+
+        bond_dict = self.bond_dict()
+        outliers = find_outliers(self)
+
+        # organize outliers by molecule
+        outlier_dict = defaultdict(set)
+        for outlier in outliers:
+            mol_ind = [i for i, mol in enumerate(molecules) if outlier in mol]
+            if mol_ind:
+                outlier_dict[mol_ind[0]].add(outlier)
+
+        # find the center of the molecule without outliers
+        for mol_ind in outlier_dict:
+            molecule = molecules[mol_ind].copy()
+            molecule -= outlier_dict[mol_ind]  # not outlier indices
+            mol_xyz = self.xyz[list(molecule), :]
+            mol_avg = np.mean(mol_xyz, axis=0)
+
+            # translate the outlier to its real-space position found using
+            # freud.box.unwrap. the direction is determined using the
+            # difference between the particle position and the molecule center
+            freud_box = mb_to_freud_box(self.box)
+            for outlier in outlier_dict[mol_ind]:
+                image = mol_avg - particles[outlier].pos
+                img = np.where(image > self.box.maxs / 2, 1, 0) + np.where(
+                    image < -self.box.maxs / 2, -1, 0
+                )
+                new_xyz = freud_box.unwrap(particles[outlier].pos, img)
+                particles[outlier].translate_to(new_xyz)
+
+        # check if any bad bonds remain
+        bad_bonds = check_bad_bonds(self)
+        if bad_bonds:
+            if _count < 5:
+                _count += 1
+                print(f"Bad bonds still present! Trying unwrap again. {_count}")
+                self.unwrap(d_tolerance=d_tolerance, _count=_count)
+            else:
+                print("Bad bonds still present and try limit exceeded.")
+
+    def bond_dict(self):
+        """
+        given an CG_Compound return an dict of the particle indices for each bond
+
+        CG_Compound.bond_dict() --> dict of sets
+        """
+        bond_dict = defaultdict(set)
+        for i, j in self.bond_array().tolist():
+            bond_dict[i].add(j)
+            bond_dict[j].add(i)
+        return bond_dict
+
+    def get_name_inds(self, name):
+        """
+        Find indices of particles in compound where particle.name matches given name
+
+        Parameters
+        ----------
+        name : str, particle.name in mb.Compound
+
+        Returns
+        -------
+        np.ndarray of particles indices which match name
+        """
+        if name not in self._name_map():
+            return np.empty(0, dtype=int)
+        return self._name_map()[name].copy()
+
+    def tuple_to_names(self, tup):
+        """
+        Get the names of particle indices passed in as a tuple.
+
+        Parameters
+        ----------
+        tup : tuple of ints, particle indices
+
+        Returns
+        -------
+        tuple of strings, particle.name of given indices
+        """
+        particles = [part for part in self.particles()]
+
+        types = []
+        for index in tup:
+            types.append(particles[index].name)
+        return tuple(sorted(types))
+
+    def find_angles(self):
+        """
+        Adapted from cme_utils.manip.builder.building_block.find_angles()
+        Finds unique angle constraints and their types.
+
+        Returns
+        -------
+        Dictionary with keys correponding to the angle types and
+        values which list the particle indices which have this angle type
+        """
+        angles = []
+        bond_dict = self.bond_dict()
+        for i in range(self.n_particles):
+            for n1 in bond_dict[i]:
+                for n2 in bond_dict[n1]:
+                    if n2 != i:
+                        if n2 > i:
+                            angles.append((i, n1, n2))
+                        else:
+                            angles.append((n2, n1, i))
+        angles = sorted(set(angles))
+        angle_types = []
+        for t in angles:
+            angle_types.append(self.tuple_to_names(t))
+
+        angle_dict = defaultdict(list)
+        for a, b in zip(angle_types, angles):
+            angle_dict[a].append(b)
+        return angle_dict
+
+    def find_bonds(self):
+        """
+        Finds unique bond constraints and their types.
+
+        Returns
+        -------
+        Dictionary with keys correponding to the bond types and
+        values which list the particle indices which have this type
+        """
+        bonds = []
+        bond_dict = self.bond_dict()
+        for i in range(self.n_particles):
+            for n1 in bond_dict[i]:
+                if n1 > i:
+                    bonds.append((i, n1))
+                else:
+                    bonds.append((n1, i))
+        bonds = sorted(set(bonds))
+        bond_types = []
+        for t in bonds:
+            bond_types.append(self.tuple_to_names(t))
+
+        bond_dict = defaultdict(list)
+        for a, b in zip(bond_types, bonds):
+            bond_dict[a].append(b)
+        return bond_dict
+
+    def find_pairs(self):
+        """
+        Finds unique (coarse-grained) pair types
+        (coarse particle names start with "_")
+
+        Returns
+        -------
+        list of tuples of pair names
+        """
+        particles = {p.name for p in self.particles() if p.name[0] == "_"}
+        pairs = set()
+        for i in particles:
+            for j in particles:
+                pair = tuple(sorted([i, j]))
+                pairs.add(pair)
+        return sorted(pairs)
+
+    def remove_atomistic(self):
+        """
+        all coarse-grained particles are named starting with '_'
+        remove any particles whose names do not start with '_'
+        """
+        self.remove_mask(~self._coarse_mask())
+        self._remove_ports()
+
+    def pbc_bonds(self):
+        """
+        Finds every bond in the compound which spans the periodic boundary
+        (see pbc_bond_images()).
+
+        Returns
+        -------
+        bonds : np.ndarray (M,2), particle indices of each bond
+        spans : np.ndarray (M,) of bool
+        images : np.ndarray (M,3) of int
+        shifts : np.ndarray (M,3)
+        """
+        bonds = self.bond_array()
+        return (bonds,) + pbc_bond_images(self.xyz, bonds, self.box)
+
+    def is_bad_bond(self, tup):
+        """
+        Determines whether a bond spans the periodic boundary based on a distance
+        cutoff of the self.box.maxs/2
+        To check every bond at once use pbc_bonds().
+
+        Parameters
+        ----------
+        tup : tuple, indices of the bonded particles
+
+        Returns
+        -------
+        bool
+        """
+        bonds = self.bond_array()
+        if not (
+            np.all(bonds == tup, axis=1) | np.all(bonds == tup[::-1], axis=1)
+        ).any():
+            print(f"Bond {tup} not found in compound! Aborting...")
+            return
+        return bool(self._pair_images(tup)[0][0])
+
+    def unwrap_position(self, tup):
+        """
+        Given the indices of a bonded pair which spans the periodic boundary,
+        moves the second index to it's real-space position.
+
+        Parameters
+        ----------
+        tup : tuple, indices (2) of bonded particles
+
+        Returns
+        -------
+        np.ndarray(3,), unwrapped coordinates for index in tup[1]
+        (if you want to move the first index, enter it as tup[::-1])
+        """
+        _, _, shifts = self._pair_images(tup)
+        return self._particle_list()[tup[1]].pos + shifts[0]
+
+    def _pair_images(self, tup):
+        particles = self._particle_list()
+        xyz = np.array([particles[tup[0]].pos, particles[tup[1]].pos])
+        return pbc_bond_images(xyz, [(0, 1)], self.box)
+
+    def topology(self):
+        """
+        Returns the particle names and bonds of the compound as a read-only
+        Topology. The topology is cached, so compounds cloned from this one
+        with from_mbuild() share the same arrays.
+
+        Returns
+        -------
+        Topology
+        """
+        cache = self._get_cache()
+        if "topology" not in cache:
+            names = tuple(p.name for p in self._particle_list())
+            cache["topology"] = _make_topology(names, self.bond_array().copy())
+        return cache["topology"]
+
+    def clone(self):
+        """
+        Returns a copy of the compound which shares its topology
+        (see from_mbuild())
+
+        Returns
+        -------
+        CG_Compound
+        """
+        clone = type(self).from_mbuild(self)
+        clone.box = self.box
+        return clone
+
+    @classmethod
+    def from_mbuild(cls, compound, topology=None, share_topology=True):
+        """
+        Instantiates a CG_Compound and follows mb.Compound.deep_copy
+        to copy particles and bonds to CG_Compound.
+        Coordinates, names and bonds are copied as arrays and the particles
+        are added in one pass.
+
+        Parameters
+        ----------
+        compound : mb.Compound to be compied
+        topology : Topology (default None)
+            Names and bonds to use instead of reading them from compound, e.g.
+            template.topology() when cloning many copies of the same molecule.
+            Only the coordinates are read from compound.
+        share_topology : bool (default True)
+            If True and compound is a CG_Compound, the clone shares the
+            read-only topology of compound instead of copying it.
+
+        Returns
+        -------
+        CG_Compound
+        """
+
+        comp = cls()
+
+        comp.name = deepcopy(compound.name)
+        comp.periodicity = deepcopy(compound.periodicity)
+        comp._pos = deepcopy(compound._pos)
+        comp.port_particle = deepcopy(compound.port_particle)
+        comp._check_if_contains_rigid_bodies = deepcopy(
+            compound._check_if_contains_rigid_bodies
+        )
+        comp._contains_rigid = deepcopy(compound._contains_rigid)
+        comp._rigid_id = deepcopy(compound._rigid_id)
+        comp._charge = deepcopy(compound._charge)
+
+        if compound.children is None:
+            comp.children = None
+        else:
+            comp.children = OrderedSet()
+        # Parent should be None initially.
+        comp.parent = None
+        comp.labels = OrderedDict()
+        comp.referrers = set()
+        comp.bond_graph = None
+
+        if topology is None:
+            if share_topology and isinstance(compound, CG_Compound):
+                topology = compound.topology()
+            else:
+                topology = _compound_topology(compound)
+
+        xyz = compound.xyz
+        if len(xyz) != len(topology.names):
+            raise ValueError(
+                f"Topology has {len(topology.names)} particles, but compound has "
+                f"{len(xyz)}."
+            )
+        particles = [
+            mb.Particle(name=name, pos=pos) for name, pos in zip(topology.names, xyz)
+        ]
+        comp.add(particles)
+        for i, j in topology.bonds.tolist():
+            comp.add_bond((particles[i], particles[j]))
+
+        cache = comp._get_cache()
+        cache["particles"] = particles
+        cache["bonds"] = topology.bonds
+        cache["topology"] = topology
+        return comp
+
+    def visualize(self, show_ports=False, backend='py3dmol',
+            color_scheme={}, show_atomistic=False, scale=1.0): # pragma: no cover
+        """
+        Visualize the Compound using py3dmol (default) or nglview.
+        Allows for visualization of a Compound within a Jupyter Notebook.
+        Parameters
+        ----------
+        show_ports : bool, optional, default=False
+            Visualize Ports in addition to Particles
+        backend : str, optional, default='py3dmol'
+            Specify the backend package to visualize compounds
+            Currently supported: py3dmol, nglview
+        color_scheme : dict, optional
+            Specify coloring for non-elemental particles
+            keys are strings of the particle names
+            values are strings of the colors
+            i.e. {'_CGBEAD': 'blue'}
+        NOTE!: Only py3dmol will work with CG_Compounds
+        """
+        viz_pkg = {'nglview': self._visualize_nglview,
+                'py3dmol': self._visualize_py3dmol}
+        if run_from_ipython():
+            if backend.lower() in viz_pkg:
+                return viz_pkg[backend.lower()](show_ports=show_ports,
+                        color_scheme=color_scheme, show_atomistic=show_atomistic, scale=scale)
+            else:
+                raise RuntimeError("Unsupported visualization " +
+                        "backend ({}). ".format(backend) +
+                        "Currently supported backends include nglview and py3dmol")
+
+        else:
+            raise RuntimeError('Visualization is only supported in Jupyter '
+                               'Notebooks.')
+
+
+    def _visualize_py3dmol(self,
+            show_ports=False,
+            color_scheme={},
+            show_atomistic=False,
+            scale=1.0):
+        """
+        Visualize the Compound using py3Dmol.
+        Allows for visualization of a Compound within a Jupyter Notebook.
+        Modified to show atomistic elements (translucent) with larger CG beads.
+
+        Parameters
+        ----------
+        show_ports : bool, optional, default=False
+            Visualize Ports in addition to Particles
+        color_scheme : dict, optional
+            Specify coloring for non-elemental particles
+            keys are strings of the particle names
+            values are strings of the colors
+            i.e. {'_CGBEAD': 'blue'}
+        show_atomistic : show the atomistic structure stored in CG_Compound.atomistic
+
+        Returns
+        ------
+        view : py3Dmol.view
+        """
+        py3Dmol = import_("py3Dmol")
+
+        atom_names = []
+
+        if self.atomistic is not None and show_atomistic:
+            if isinstance(self.atomistic, AtomisticRecord):
+                atomistic = self.atomistic.to_compound()
+            else:
+                atomistic = CG_Compound.from_mbuild(self.atomistic)
+            for particle in atomistic.particles():
+                if not particle.name:
+                    particle.name = "UNK"
+                else:
+                    if (particle.name != 'Compound') and (particle.name != 'CG_Compound'):
+                        atom_names.append(particle.name)
+
+        coarse = CG_Compound.from_mbuild(self)
+        modified_color_scheme = {}
+        for name, color in color_scheme.items():
+            # Py3dmol does some element string conversions,
+            # first character is as-is, rest of the characters are lowercase
+            new_name = name[0] + name[1:].lower()
+            modified_color_scheme[new_name] = color
+            modified_color_scheme[name] = color
+
+        cg_names = []
+        for particle in coarse.particles():
+            if not particle.name:
+                particle.name = "UNK"
+            else:
+                if (particle.name != 'Compound') and (particle.name != 'CG_Compound'):
+                    cg_names.append(particle.name)
+
+
+        tmp_dir = tempfile.mkdtemp()
+
+        view = py3Dmol.view()
+
+        if atom_names:
+            atomistic.save(
+                os.path.join(tmp_dir, "atomistic_tmp.mol2"),
+                show_ports=show_ports,
+                overwrite=True,
+            )
+
+            # atomistic
+            with open(os.path.join(tmp_dir, "atomistic_tmp.mol2"), "r") as f:
+                view.addModel(f.read(), "mol2", keepH=True)
+
+            if cg_names:
+                opacity = 0.6
+            else:
+                opacity = 1.0
+
+            view.setStyle(
+                {
+                    "stick": {"radius": 0.2 * scale, "opacity": opacity, "color": "grey"},
+                    "sphere": {
+                        "scale": 0.3 * scale,
+                        "opacity": opacity,
+                        "colorscheme": modified_color_scheme,
+                    },
+                }
+            )
+
+        # coarse
+        if cg_names:
+            coarse.save(
+                os.path.join(tmp_dir, "coarse_tmp.mol2"),
+                show_ports=show_ports,
+                overwrite=True,
+            )
+            with open(os.path.join(tmp_dir, "coarse_tmp.mol2"), "r") as f:
+                view.addModel(f.read(), "mol2", keepH=True)
+
+            if self.atomistic is None:
+                scale = 0.3 * scale
+            else:
+                scale = 0.7 * scale
+
+            view.setStyle(
+                {"atom": cg_names},
+                {
+                    "stick": {"radius": 0.2 * scale, "opacity": 1, "color": "grey"},
+                    "sphere": {
+                        "scale": scale,
+                        "opacity": 1,
+                        "colorscheme": modified_color_scheme,
+                    },
+                },
+            )
+
+        view.zoomTo()
+
+        return view
+
+    def remove_coarse(self):
+        """
+        all coarse-grained particles are named starting with '_'
+        remove any particles whose names start with '_'
+        """
+        self.remove_mask(self._coarse_mask())
+        self._remove_ports()
+
+    def _coarse_mask(self):
+        """
+        Returns a boolean mask which is True for coarse-grained particles
+        """
+        mask = np.zeros(len(self._particle_list()), dtype=bool)
+        for name, inds in self._name_map().items():
+            if name[0] == "_":
+                mask[inds] = True
+        return mask
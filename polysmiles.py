@@ -1,5 +1,4 @@
 import deepsmiles
-import mbuild as mb
 
 
 def convert_smiles(smiles=False, deep=False):
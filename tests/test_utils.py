@@ -0,0 +1,480 @@
+import itertools
+import json
+import os
+import warnings
+
+import numpy as np
+import pytest
+
+import utils
+
+
+def random_beads(rng, n_beads, size, box):
+    """
+    Compact groups of particles scattered over an orthorhombic box and
+    wrapped into it, with their unwrapped coordinates
+    """
+    centers = rng.random((n_beads, 1, 3)) * box
+    unwrapped = centers + rng.normal(scale=0.05, size=(n_beads, size, 3))
+    return np.mod(unwrapped, box).reshape(-1, 3), unwrapped.reshape(-1, 3)
+
+
+def naive_msd(x):
+    """
+    msd of (T,...,3) coordinates from every pair of frames
+    """
+    n = len(x)
+    msd = np.zeros((n,) + x.shape[1:-1])
+    for lag in range(1, n):
+        msd[lag] = np.mean(np.sum((x[lag:] - x[:-lag]) ** 2, axis=-1), axis=0)
+    return msd
+
+
+def write_frame_cache(directory, position, box, typeid, types, bonds, mass=None):
+    """
+    Writes the files of a FrameCache without going through a gsd file
+    """
+    os.makedirs(directory)
+    if mass is not None:
+        np.save(os.path.join(directory, "mass.npy"), mass)
+    np.save(os.path.join(directory, "position.npy"), position)
+    np.save(os.path.join(directory, "typeid.npy"), typeid)
+    np.save(os.path.join(directory, "box.npy"), box)
+    np.save(os.path.join(directory, "step.npy"), np.arange(len(position)) * 100)
+    np.save(os.path.join(directory, "bonds.npy"), np.asarray(bonds).reshape(-1, 2))
+    with open(os.path.join(directory, "meta.json"), "w") as f:
+        json.dump({"types": types}, f)
+    return utils.FrameCache(directory)
+
+
+@pytest.mark.parametrize("method", ["image", "circular"])
+def test_bead_centers_wrapped(method):
+    rng = np.random.default_rng(0)
+    box = np.array([3.0, 4.0, 5.0])
+    xyz, unwrapped = random_beads(rng, 50, 4, box)
+    groups = np.arange(len(xyz)).reshape(50, 4).tolist()
+
+    centers = utils.bead_centers(xyz, groups, box=box, method=method)
+    expected = unwrapped.reshape(50, 4, 3).mean(axis=1)
+    # the center may be reported in any periodic image
+    diff = utils.minimum_image(centers - expected, box)
+    assert np.allclose(diff, 0, atol=1e-2 if method == "circular" else 1e-10)
+
+
+def test_bead_centers_frames_and_sizes():
+    rng = np.random.default_rng(1)
+    box = np.array([2.0, 2.0, 2.0, 0.2, 0.0, 0.1])
+    xyz = rng.random((3, 12, 3)) * 0.1 + 0.95
+    groups = [[0, 1, 2], [3], [4, 5, 6, 7, 8], [9, 10, 11]]
+
+    centers = utils.bead_centers(xyz, groups, box=box)
+    for f in range(3):
+        for b, group in enumerate(groups):
+            ref = xyz[f, group[0]]
+            diff = utils.minimum_image(xyz[f, group] - ref, box)
+            assert np.allclose(centers[f, b], ref + diff.mean(axis=0))
+    expected = [xyz[0, g].mean(axis=0) for g in groups]
+    assert np.allclose(utils.bead_centers(xyz[0], groups), expected)
+
+
+def test_pbc_bond_images():
+    rng = np.random.default_rng(2)
+    box = np.array([3.0, 4.0, 5.0])
+    xyz = rng.random((40, 3)) * box
+    bonds = rng.integers(0, 40, (100, 2))
+
+    spans, images, shifts = utils.pbc_bond_images(xyz, bonds, box)
+    lattice = np.array(list(itertools.product((-1, 0, 1), repeat=3)))
+    for (i, j), span, image, shift in zip(bonds, spans, images, shifts):
+        dist = np.linalg.norm(xyz[j] + lattice * box - xyz[i], axis=1)
+        nearest = lattice[np.argmin(dist)]
+        assert np.array_equal(image, -nearest)
+        assert np.allclose(shift, nearest * box)
+        assert span == nearest.any()
+
+    frames = np.stack([xyz, np.mod(xyz + 1.0, box)])
+    f_spans, f_images, _ = utils.pbc_bond_images(frames, bonds, [box, box])
+    assert np.array_equal(f_spans[0], spans)
+    assert np.array_equal(f_images[0], images)
+
+
+def test_msd_fft():
+    rng = np.random.default_rng(3)
+    x = np.cumsum(rng.normal(size=(30, 5, 3)), axis=0)
+    assert np.allclose(utils.msd_fft(x), naive_msd(x))
+    assert np.allclose(utils.msd_fft(x[:, 0]), naive_msd(x[:, 0]))
+
+
+@pytest.mark.parametrize("molecules", [False, True])
+def test_gsd_msd(tmp_path, molecules):
+    rng = np.random.default_rng(4)
+    box = np.array([4.0, 4.0, 4.0])
+    n_frames, n_particles = 25, 10
+    start = rng.random((n_particles, 3)) * box - box / 2
+    steps = rng.normal(scale=0.1, size=(n_frames, n_particles, 3))
+    steps[0] = 0
+    unwrapped = start + np.cumsum(steps, axis=0)
+    wrapped = np.mod(unwrapped + box / 2, box) - box / 2
+    typeid = np.tile(np.arange(n_particles) % 2, (n_frames, 1)).astype(np.uint8)
+    bonds = [(0, 1), (1, 2), (5, 6)]
+    mass = rng.uniform(1, 10, n_particles)
+    cache = write_frame_cache(
+        str(tmp_path / "cache"),
+        wrapped,
+        np.tile(np.r_[box, 0, 0, 0], (n_frames, 1)),
+        typeid,
+        ["A", "B"],
+        bonds,
+        mass,
+    )
+
+    result = utils.gsd_msd(cache, molecules=molecules, chunk_size=3)
+    assert np.allclose(result.time, np.arange(n_frames) * 100)
+    if molecules:
+        mol = utils.molecule_ids(n_particles, bonds)
+        centers = np.stack(
+            [
+                np.average(unwrapped[:, mol == m], axis=1, weights=mass[mol == m])
+                for m in range(mol.max() + 1)
+            ],
+            axis=1,
+        )
+        assert set(result.msd) == {"molecules"}
+        assert np.allclose(result.msd["molecules"], naive_msd(centers).mean(axis=1))
+    else:
+        msd = naive_msd(unwrapped)
+        assert np.allclose(result.msd["all"], msd.mean(axis=1))
+        assert np.allclose(result.msd["A"], msd[:, 0::2].mean(axis=1))
+        assert np.allclose(result.msd["B"], msd[:, 1::2].mean(axis=1))
+
+
+def test_type_amplitudes_direct():
+    rng = np.random.default_rng(5)
+    frac = rng.random((300, 3))
+    typeid = rng.integers(0, 3, 300)
+    waves = rng.integers(-4, 5, (250, 3))
+
+    amps = utils._type_amplitudes_direct(frac, typeid, 3, waves, chunk_size=64)
+    phase = np.exp(-2j * np.pi * frac @ waves.T)
+    expected = [phase[typeid == t].sum(axis=0) for t in range(3)]
+    assert np.allclose(amps, expected)
+
+
+def test_structure_factor_grid_matches_direct(tmp_path):
+    rng = np.random.default_rng(6)
+    n_grid, n_frames, n_particles = 32, 2, 2000
+    box = np.array([3.0, 3.5, 4.0, 0.0, 0.0, 0.0])
+    position = (rng.random((n_frames, n_particles, 3)) - 0.5) * box[:3]
+    typeid = rng.integers(0, 2, (n_frames, n_particles)).astype(np.uint8)
+    cache = write_frame_cache(
+        str(tmp_path / "cache"),
+        position,
+        np.tile(box, (n_frames, 1)),
+        typeid,
+        ["A", "B"],
+        [],
+    )
+
+    kwargs = dict(n_grid=n_grid, bins=8, pairs=[("A", "B")], weights={"A": 2.0})
+    grid = utils.gsd_structure_factor(cache, method="grid", **kwargs)
+    direct = utils.gsd_structure_factor(cache, method="direct", **kwargs)
+    assert np.allclose(grid.q, direct.q)
+    assert np.array_equal(grid.counts, direct.counts)
+    # up to the default q_max (half the Nyquist wave number) the deconvolved
+    # grid assignment is within 1% of the direct sum; S(q) is about 1 here
+    filled = direct.counts > 0
+    for key in ["total", ("A", "B")]:
+        error = np.abs(grid.sq[key] - direct.sq[key])[filled]
+        assert error.max() < 0.01
+
+    empty = utils.gsd_structure_factor(cache, start=n_frames, n_grid=n_grid)
+    assert not empty.counts.any()
+
+
+def test_chunked_record():
+    rng = np.random.default_rng(7)
+    xyz = rng.random((7, 3))
+    names = ["C", "H", "S", "C", "H", "H", "C"]
+    bonds = np.array([[0, 1], [0, 2], [6, 2], [3, 4], [3, 5]])
+    beads = [(0, 2, 6), (3, 4, 5)]
+    # two chunks with interleaved atoms, type codes in order of appearance
+    type_codes = {"C": 0, "H": 1, "S": 2}
+    chunks = [np.array([0, 1, 2, 6]), np.array([3, 4, 5])]
+    parts = []
+    for atoms in chunks:
+        local = {a: i for i, a in enumerate(atoms)}
+        chunk_bonds = [b for b in bonds if b[0] in local]
+        chunk_beads = [b for b in beads if b[0] in local]
+        parts.append(
+            (
+                atoms.astype(np.int32),
+                xyz[atoms],
+                np.array([type_codes[names[a]] for a in atoms], dtype=np.uint16),
+                np.array(chunk_bonds, dtype=np.int32),
+                np.concatenate(chunk_beads).astype(np.int32),
+                np.array([len(b) for b in chunk_beads], dtype=np.int32),
+            )
+        )
+
+    record = utils._chunked_record(parts, type_codes, 7, None, np.float32)
+    expected = utils.AtomisticRecord(xyz, names, bonds, beads, dtype=np.float32)
+    assert record.xyz.dtype == np.float32
+    assert np.array_equal(record.xyz, expected.xyz)
+    assert record.types == expected.types
+    assert record.names == names
+    assert np.array_equal(record.bonds, expected.bonds)
+    assert [g.tolist() for g in record.bead_groups()] == [list(b) for b in beads]
+
+
+def test_coarse_chunk_arrays_memory():
+    pybel = pytest.importorskip("openbabel.pybel")
+    import tracemalloc
+
+    from openbabel import openbabel as ob
+
+    mol = pybel.readstring("smi", "CCCCCCc1ccsc1")
+    mol.addh()
+    mol.make3D()
+    bead_list = [
+        ("_B", utils.features_dict["thiophene"]),
+        ("_S", utils.features_dict["alkyl_3"]),
+    ]
+
+    def peak(n_chunks, keep_atomistic):
+        chunks = ((None, pybel.Molecule(ob.OBMol(mol.OBMol))) for _ in range(n_chunks))
+        tracemalloc.start()
+        beads = utils._coarse_chunk_arrays(
+            chunks, bead_list, keep_atomistic=keep_atomistic
+        )
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak, beads
+
+    # a thiophene and two propyl beads per molecule
+    n_atoms = len(mol.atoms)
+    for keep_atomistic, per_atom in [(False, 0), (True, 64)]:
+        small, _ = peak(50, keep_atomistic)
+        large, beads = peak(200, keep_atomistic)
+        assert len(beads.names) == 3 * 200
+        # 150 more chunks may only add bead arrays and compact atom arrays,
+        # not the working memory of every chunk
+        assert large - small < 150 * (3 * 200 + n_atoms * per_atom)
+
+
+FORCEFIELDS = os.path.join(os.path.dirname(os.path.dirname(__file__)), "forcefields")
+
+# ethylthiophene typed as in forcefields/p3ht-aa.xml
+AA_TYPES = "C1 S1 C2 C3 H1 H1 C4 H2 H2 H2 C9 H7 C10 H7 H7".split()
+# fmt: off
+AA_BONDS = [
+    (0, 1), (0, 2), (2, 10), (10, 12), (12, 1), (0, 13), (10, 11), (12, 14),
+    (2, 3), (3, 4), (3, 5), (3, 6), (6, 7), (6, 8), (6, 9),
+]
+# fmt: on
+
+
+def test_forcefield_elements():
+    elements = utils.forcefield_elements(os.path.join(FORCEFIELDS, "p3ht-aa.xml"))
+    assert elements["C10"] == "C"
+    assert elements["S1"] == "S"
+    assert {elements[f"H{i}"] for i in range(1, 8)} == {"H"}
+
+
+def check_united_atoms(ua):
+    assert ua.heavy.tolist() == [0, 1, 2, 3, 6, 10, 12]
+    assert ua.owner.tolist() == [0, 1, 2, 3, 3, 3, 4, 4, 4, 4, 5, 5, 6, 0, 6]
+    names = np.array(ua.types)[ua.typeid].tolist()
+    assert names == ["CA", "S", "CA", "CT", "CT", "CA", "CA"]
+    expected = [13.02, 32.06, 12.01, 14.03, 15.03, 13.02, 13.02]
+    assert np.allclose(ua.mass, expected, atol=0.01)
+    bonds = [[0, 1], [0, 2], [2, 5], [5, 6], [6, 1], [2, 3], [3, 4]]
+    assert ua.bonds.tolist() == bonds
+
+
+def test_united_atom_map_forcefield_types():
+    pytest.importorskip("parmed")
+    elements = utils.forcefield_elements(os.path.join(FORCEFIELDS, "p3ht-aa.xml"))
+    aromatic = np.isin(np.arange(len(AA_TYPES)), [0, 2, 10, 12])
+    check_united_atoms(
+        utils.UnitedAtomMap(AA_TYPES, AA_BONDS, aromatic, type_elements=elements)
+    )
+    with pytest.raises(ValueError, match="C1"):
+        utils.UnitedAtomMap(AA_TYPES, AA_BONDS, aromatic)
+
+
+def test_united_atom_map_from_gsd_masses(tmp_path):
+    pytest.importorskip("parmed")
+    types = sorted(set(AA_TYPES))
+    elements = utils.forcefield_elements(os.path.join(FORCEFIELDS, "p3ht-aa.xml"))
+    masses = {"C": 12.0107, "S": 32.065, "H": 1.00784}
+    cache = write_frame_cache(
+        str(tmp_path / "cache"),
+        np.random.default_rng(8).random((1, len(AA_TYPES), 3)),
+        np.array([[5.0, 5.0, 5.0, 0, 0, 0]]),
+        np.array([[types.index(t) for t in AA_TYPES]], dtype=np.uint8),
+        types,
+        AA_BONDS,
+        np.array([masses[elements[t]] for t in AA_TYPES]),
+    )
+    # elements from the particle masses, aromatic carbons from their bonds
+    check_united_atoms(utils.UnitedAtomMap.from_gsd(cache))
+
+
+def test_perceive_bonds_unknown_names():
+    xyz = np.random.default_rng(9).random((len(AA_TYPES), 3))
+    with pytest.raises(ValueError, match="C1"):
+        utils.perceive_bonds(xyz, AA_TYPES)
+
+
+def test_perceive_bonds_warns_for_unknown_names():
+    pytest.importorskip("freud")
+    xyz = np.array([[0.0, 0.0, 0.0], [0.109, 0.0, 0.0], [0.5, 0.5, 0.5]])
+    with pytest.warns(UserWarning, match="C1"):
+        bonds = utils.perceive_bonds(xyz, ["C", "H", "C1"])
+    assert bonds.tolist() == [[0, 1]]
+    # beads are not bonded and not reported
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        utils.perceive_bonds(xyz, ["C", "H", "_B"])
+
+
+def test_excluded_pairs():
+    bonds = [(0, 1), (2, 1), (2, 3)]
+    n = 5
+    assert utils._excluded_pairs(n, bonds, ()).tolist() == []
+    assert utils._excluded_pairs(n, bonds, ("bond",)).tolist() == [1, 7, 13]
+    keys = utils._excluded_pairs(n, bonds, ("bond", "angle"))
+    pairs = sorted(divmod(int(k), n) for k in keys)
+    assert pairs == [(0, 1), (0, 2), (1, 2), (1, 3), (2, 3)]
+    with pytest.raises(ValueError, match="dihedral"):
+        utils._excluded_pairs(n, bonds, ("bond", "dihedral"))
+
+
+@pytest.mark.parametrize("pair", [("A", "B"), ("A", "A")])
+def test_gsd_partial_rdf(tmp_path, pair):
+    pytest.importorskip("freud")
+    rng = np.random.default_rng(10)
+    n_frames, n_particles, L = 3, 60, 4.0
+    position = (rng.random((n_frames, n_particles, 3)) - 0.5) * L
+    typeid = np.tile(np.arange(n_particles) % 3 == 0, (n_frames, 1))
+    bonds = np.column_stack((np.arange(0, 59), np.arange(1, 60)))
+    cache = write_frame_cache(
+        str(tmp_path / "cache"),
+        position,
+        np.tile([L, L, L, 0, 0, 0], (n_frames, 1)),
+        typeid.astype(np.uint8),
+        ["A", "B"],
+        bonds,
+    )
+    rmax, bins = 1.5, 15
+    rdf = utils.gsd_partial_rdf(
+        cache, *pair, rmax=rmax, bins=bins, exclusions=("bond",)
+    )
+
+    # only the A-B (or A-A) pairs which are not bonded
+    names = np.array(["A", "B"])[typeid[0].astype(int)]
+    A = np.flatnonzero(names == pair[0])
+    B = np.flatnonzero(names == pair[1])
+    bonded = {tuple(b) for b in bonds} | {tuple(b[::-1]) for b in bonds}
+    counts = np.zeros(bins)
+    for x in position:
+        for i in A:
+            for j in B:
+                if i == j or (i, j) in bonded:
+                    continue
+                d = np.linalg.norm(utils.minimum_image(x[j] - x[i], [L, L, L]))
+                if d < rmax:
+                    counts[int(d / rmax * bins)] += 1
+    edges = np.linspace(0, rmax, bins + 1)
+    shells = 4 / 3 * np.pi * (edges[1:] ** 3 - edges[:-1] ** 3)
+    expected = counts / (n_frames * len(A) * len(B) / L ** 3 * shells)
+    assert np.allclose(rdf.rdf, expected)
+
+
+def bond_list(compound):
+    return sorted(sorted(bond) for bond in compound.bond_array().tolist())
+
+
+def test_nested_compound_caches():
+    mb = pytest.importorskip("mbuild")
+    from cg_compound import CG_Compound
+
+    root, mid, leaf = CG_Compound(), CG_Compound(), CG_Compound()
+    c, h1, h2, s, o = (
+        mb.Particle(name=name, pos=[i, 0, 0])
+        for i, name in enumerate(["C", "H", "H", "S", "O"])
+    )
+    leaf.add([c, h1, h2])
+    mid.add([leaf, s])
+    root.add([mid, o])
+    for pair in [(c, h1), (c, h2), (c, s), (s, o)]:
+        root.add_bond(pair)
+    # fill the caches of every level
+    for comp in (root, mid, leaf):
+        comp.get_name_inds("H"), comp.bond_array()
+
+    root.remove_hydrogens()
+    assert [p.name for p in root.particles()] == ["C", "S", "O"]
+    assert mid.get_name_inds("H").tolist() == []
+    assert leaf.get_name_inds("C").tolist() == [0]
+    assert bond_list(mid) == [[0, 1]]
+    assert bond_list(root) == [[0, 1], [1, 2]]
+    assert root.n_bonds == 2
+
+    # changes through a lower level reach every ancestor
+    n = mb.Particle(name="N")
+    leaf.add(n)
+    assert root.get_name_inds("N").tolist() == [1]
+    assert mid.get_name_inds("S").tolist() == [2]
+    root.add_bond((c, n))
+    assert bond_list(mid) == [[0, 1], [0, 2]]
+
+    mask = np.array([p.name == "N" for p in root.particles()])
+    root.remove_mask(mask)
+    assert [p.name for p in mid.particles()] == ["C", "S"]
+    assert bond_list(mid) == [[0, 1]]
+    inds = root.get_name_inds("C")
+    inds[:] = 5
+    assert root.get_name_inds("C").tolist() == [0]
+
+
+def test_decorrelated_frames_none(tmp_path):
+    cache = write_frame_cache(
+        str(tmp_path / "cache"),
+        np.zeros((6, 2, 3)),
+        np.tile([3.0, 3.0, 3.0, 0, 0, 0], (6, 1)),
+        np.zeros((6, 2), dtype=np.uint8),
+        ["A"],
+        [],
+    )
+    frames, decorr = utils._decorrelated_frames(
+        cache, cache, range(1, 5), None, "A", "A"
+    )
+    assert list(frames) == [1, 2, 3, 4]
+    assert decorr == 1
+    with pytest.raises(ValueError, match="decorrelate"):
+        utils._decorrelated_frames(cache, cache, range(1, 5), 1, "A", "A")
+
+
+def test_gsd_nematic_order_empty_range(tmp_path):
+    position = np.tile([[0, 0, 0], [0, 0, 0.5], [0, 0, 1.0]], (3, 1, 1))
+    cache = write_frame_cache(
+        str(tmp_path / "cache"),
+        position,
+        np.tile([3.0, 3.0, 3.0, 0, 0, 0], (3, 1)),
+        np.zeros((3, 3), dtype=np.uint8),
+        ["_B"],
+        [[0, 1], [1, 2]],
+    )
+    result = utils.gsd_nematic_order(cache, per_molecule=True, n_bins=(2, 2, 2))
+    assert np.allclose(result.S2, 1)
+    assert np.allclose(np.abs(result.director[:, 2]), 1)
+
+    result = utils.gsd_nematic_order(
+        cache, per_molecule=True, n_bins=(2, 2, 2), start=2, stop=1
+    )
+    assert result.S2.shape == (0,)
+    assert result.director.shape == (0, 3)
+    assert result.Q.shape == (0, 3, 3)
+    assert result.molecule_S2.shape == (0, 1)
+    assert result.local_S2.shape == (0, 2, 2, 2)
@@ -1,20 +1,72 @@
+import hashlib
+import importlib
+import inspect
+import itertools
+import json
 import os
+import queue
 import re
+import shutil
 import tempfile
-from collections import OrderedDict, defaultdict
-from copy import deepcopy
-
-import freud
-import gsd
-import gsd.hoomd
-import gsd.pygsd
-import mbuild as mb
+import threading
+import xml.etree.ElementTree as ET
+from collections import defaultdict, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from warnings import warn
+
 import numpy as np
-from openbabel import pybel
-from mbuild.exceptions import MBuildError
-from mbuild.utils.io import import_, run_from_ipython
-from oset import oset as OrderedSet
-from parmed.periodic_table import Element
+
+
+class _LazyModule:
+    """
+    Stands in for a module and imports it (and submodules) on first use, so
+    importing utils does not pay for dependencies which are not needed.
+    """
+
+    def __init__(self, name, submodules=()):
+        self._name = name
+        self._submodules = submodules
+
+    def __getattr__(self, attr):
+        module = importlib.import_module(self._name)
+        for submodule in self._submodules:
+            importlib.import_module(f"{self._name}.{submodule}")
+        return getattr(module, attr)
+
+
+freud = _LazyModule("freud")
+gsd = _LazyModule("gsd", submodules=("hoomd", "pygsd"))
+mb = _LazyModule("mbuild")
+ob = _LazyModule("openbabel.openbabel")
+pybel = _LazyModule("openbabel.pybel")
+
+
+def __getattr__(name):
+    # CG_Compound subclasses mbuild.Compound, so it is only imported when used
+    if name == "CG_Compound":
+        from cg_compound import CG_Compound
+
+        return CG_Compound
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# store trajectory-scale arrays as float32 coordinates, int32 indices and
+# uint8/uint16 type ids; sums are still accumulated in float64
+COMPACT_DTYPES = False
+
+
+def _float_dtype():
+    return np.float32 if COMPACT_DTYPES else np.float64
+
+
+def _index_dtype():
+    return np.int32 if COMPACT_DTYPES else np.int64
+
+
+def _typeid_dtype(n_types):
+    if not COMPACT_DTYPES:
+        return None
+    return np.uint8 if n_types < 256 else np.uint16
 
 
 def mb_to_freud_box(box):
@@ -43,6 +95,109 @@ def mb_to_freud_box(box):
     return freud.box.Box(*box_list)
 
 
+def _is_freud_box(box):
+    """
+    Checks for a freud.box.Box without importing freud for other boxes
+    """
+    return type(box).__module__.split(".")[0] == "freud"
+
+
+def box_matrix(box):
+    """
+    Returns the box matrix, whose columns are the box vectors.
+
+    Parameters
+    ----------
+    box : mbuild.box.Box, freud.box.Box, or np.ndarray
+        Arrays can be box lengths (3,) or a hoomd box [Lx, Ly, Lz, xy, xz, yz] (6,),
+        or a stack of either (F,3) or (F,6) for one box per frame.
+
+    Returns
+    -------
+    np.ndarray (3,3) or (F,3,3)
+    """
+    if _is_freud_box(box):
+        return box.to_matrix()
+    if hasattr(box, "lengths"):
+        return mb_to_freud_box(box).to_matrix()
+
+    box = np.asarray(box, dtype=float)
+    matrix = np.zeros(box.shape[:-1] + (3, 3))
+    Lx, Ly, Lz = box[..., 0], box[..., 1], box[..., 2]
+    matrix[..., 0, 0] = Lx
+    matrix[..., 1, 1] = Ly
+    matrix[..., 2, 2] = Lz
+    if box.shape[-1] == 6:
+        xy, xz, yz = box[..., 3], box[..., 4], box[..., 5]
+        matrix[..., 0, 1] = xy * Ly
+        matrix[..., 0, 2] = xz * Lz
+        matrix[..., 1, 2] = yz * Lz
+    return matrix
+
+
+def minimum_image(vectors, box):
+    """
+    Applies the minimum image convention to displacement vectors.
+
+    Parameters
+    ----------
+    vectors : np.ndarray (...,3), displacement vectors
+    box : box accepted by box_matrix()
+        If one box per frame is given, vectors must be (F,M,3).
+
+    Returns
+    -------
+    np.ndarray (...,3)
+    """
+    return _minimum_image(vectors, box_matrix(box))
+
+
+def _minimum_image(vectors, matrix):
+    frac = vectors @ np.linalg.inv(matrix).swapaxes(-1, -2)
+    frac -= np.round(frac)
+    return frac @ matrix.swapaxes(-1, -2)
+
+
+def pbc_bond_images(xyz, bonds, box):
+    """
+    Finds which bonds span the periodic boundary for a whole bond array.
+
+    Parameters
+    ----------
+    xyz : np.ndarray (N,3) or (F,N,3), particle coordinates
+    bonds : np.ndarray (M,2), particle indices of each bond
+    box : box accepted by box_matrix(), one per frame for (F,N,3) coordinates
+
+    Returns
+    -------
+    spans : np.ndarray (M,) or (F,M) of bool, True if the bond spans the boundary
+    images : np.ndarray (M,3) or (F,M,3) of int, periodic image of the second
+        particle relative to the first
+    shifts : np.ndarray (M,3) or (F,M,3), vector which moves the second particle
+        of each bond to its real-space position next to the first
+    """
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    xyz = np.asarray(xyz, dtype=float)
+    matrix = box_matrix(box)
+    diff = xyz[..., bonds[:, 1], :] - xyz[..., bonds[:, 0], :]
+    frac = diff @ np.linalg.inv(matrix).swapaxes(-1, -2)
+    images = np.round(frac).astype(int)
+    shifts = -images @ matrix.swapaxes(-1, -2)
+    return images.any(axis=-1), images, shifts
+
+
+def _freud_box(box):
+    """
+    Returns a freud.box.Box given an mbuild.box.Box, a freud.box.Box or
+    a hoomd box array [Lx, Ly, Lz, xy, xz, yz].
+    """
+    if _is_freud_box(box):
+        return box
+    if hasattr(box, "lengths"):
+        return mb_to_freud_box(box)
+    return freud.box.Box.from_box(np.asarray(box, dtype=float))
+
+
 def bin_distribution(vals, nbins, start=None, stop=None):
     """
     Calculates a distribution given an array of data
@@ -92,15 +247,36 @@ def get_decorr(acorr):
     return np.argmin(acorr > 0)
 
 
-def error_analysis(data):
+def error_analysis(data, axis=None):
     """
-    Returns the standard and relative error given a dataset in a 1D numpy array
+    Returns the standard and relative error given a dataset in a 1D numpy array.
+    If axis is given, the errors are calculated along that axis of an N-D array.
     """
-    serr = np.std(data) / np.sqrt(len(data))
-    rel_err = np.abs(100 * serr / np.average(data))
+    n = len(data) if axis is None else np.shape(data)[axis]
+    serr = np.std(data, axis=axis) / np.sqrt(n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rel_err = np.abs(100 * serr / np.average(data, axis=axis))
     return (serr, rel_err)
 
 
+def decorrelation_time(values):
+    """
+    Returns the decorrelation time of a 1D series in number of samples, found
+    from the first zero of its autocorrelation (at least 1)
+    """
+    values = np.asarray(values, dtype=float)
+    if np.var(values) == 0:
+        return 1
+    acorr = autocorr1D(values)
+    if np.all(acorr > 0):
+        warn(
+            "Series never decorrelates; using half its length as the "
+            "decorrelation time."
+        )
+        return max(len(acorr), 1)
+    return max(int(get_decorr(acorr)), 1)
+
+
 def get_angle(a, b, c):
     """
     Calculates the angle between three points a-b-c
@@ -208,7 +384,530 @@ def get_molecules(snapshot):
     return result
 
 
-def gsd_rdf(gsdfile, A_name, B_name, start=0, stop=None, rmax=None, bins=50):
+Frame = namedtuple("Frame", ["step", "box", "types", "typeid", "position", "image"])
+
+
+class _GSDReader:
+    """
+    Reads frames of a gsd trajectory file as Frame tuples
+    """
+
+    def __init__(self, gsdfile):
+        self._file = gsd.pygsd.GSDFile(open(gsdfile, "rb"))
+        self._traj = gsd.hoomd.HOOMDTrajectory(self._file)
+        self._bonds = None
+        self._mass = None
+
+    def __len__(self):
+        return len(self._traj)
+
+    def __getitem__(self, i):
+        snap = self._traj[i]
+        types = list(snap.particles.types)
+        # gsd.hoomd fills missing chunks from frame 0 (or with zeros); images
+        # are often only written in frame 0, so only use this frame's own
+        image = None
+        if self._file.chunk_exists(frame=i % len(self), name="particles/image"):
+            image = snap.particles.image
+        return Frame(
+            snap.configuration.step,
+            np.asarray(snap.configuration.box, dtype=float),
+            types,
+            np.asarray(snap.particles.typeid, dtype=_typeid_dtype(len(types))),
+            snap.particles.position,
+            image,
+        )
+
+    @property
+    def bonds(self):
+        """
+        np.ndarray (B,2), bonds in the first frame
+        """
+        if self._bonds is None:
+            bonds = np.asarray(self._traj[0].bonds.group, dtype=_index_dtype())
+            self._bonds = bonds.reshape(-1, 2)
+        return self._bonds
+
+    @property
+    def mass(self):
+        """
+        np.ndarray (N,), particle masses in the first frame
+        """
+        if self._mass is None:
+            self._mass = np.asarray(self._traj[0].particles.mass, dtype=float)
+        return self._mass
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _open_frames(source):
+    """
+    Returns a frame reader for a gsd filename or a FrameCache. Use it as a
+    context manager; a FrameCache is left open.
+    """
+    if isinstance(source, FrameCache):
+        return source
+    return _GSDReader(source)
+
+
+# frames read ahead by trajectory analyses, see _iter_frames()
+PREFETCH_DEPTH = 2
+PREFETCH_BYTES = 2 ** 28
+
+
+def _load_frame(reader, i):
+    """
+    Reads frame i, copying memory-mapped positions so the disk read happens
+    in the calling thread
+    """
+    frame = reader[i]
+    if isinstance(frame.position, np.memmap):
+        frame = frame._replace(
+            position=np.array(frame.position), typeid=np.array(frame.typeid)
+        )
+    return frame
+
+
+def _iter_frames(reader, frames, depth=None, max_bytes=None):
+    """
+    Yields the Frame for each index in frames. Frames are read ahead by a
+    background thread so reading overlaps with the analysis of the previous
+    frames.
+
+    Parameters
+    ----------
+    reader : frame reader from _open_frames()
+    frames : iterable of int, frame indices
+    depth : int, largest number of frames read ahead (default PREFETCH_DEPTH)
+        If 0, frames are read in the calling thread.
+    max_bytes : int, largest size of the positions read ahead
+        (default PREFETCH_BYTES). At least one frame is always read ahead.
+    """
+    depth = PREFETCH_DEPTH if depth is None else depth
+    max_bytes = PREFETCH_BYTES if max_bytes is None else max_bytes
+    if depth < 1:
+        for i in frames:
+            yield reader[i]
+        return
+
+    done = object()
+    ready = queue.Queue()
+    space = threading.Condition()
+    # number and size of the frames in ready
+    queued = [0, 0]
+    stop = threading.Event()
+
+    def has_space(size):
+        if stop.is_set() or queued[0] == 0:
+            return True
+        return queued[0] < depth and queued[1] + size <= max_bytes
+
+    def produce():
+        try:
+            for i in frames:
+                frame = _load_frame(reader, i)
+                size = np.asarray(frame.position).nbytes
+                with space:
+                    space.wait_for(lambda: has_space(size))
+                    if stop.is_set():
+                        return
+                    queued[0] += 1
+                    queued[1] += size
+                ready.put((frame, size))
+            ready.put((done, 0))
+        except Exception as e:
+            ready.put((e, 0))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            frame, size = ready.get()
+            if frame is done:
+                return
+            if isinstance(frame, Exception):
+                raise frame
+            with space:
+                queued[0] -= 1
+                queued[1] -= size
+                space.notify()
+            yield frame
+    finally:
+        stop.set()
+        with space:
+            space.notify()
+        thread.join()
+
+
+def iter_frames(gsdfile, start=0, stop=None, stride=1, depth=None, max_bytes=None):
+    """
+    Iterates over the frames of a trajectory, reading ahead in a background
+    thread.
+
+    Parameters
+    ----------
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+    start, stop, stride : int, frames to use, following python slicing
+        (default 0, None, 1)
+    depth : int, largest number of frames read ahead (default PREFETCH_DEPTH)
+    max_bytes : int, largest size of the positions read ahead
+        (default PREFETCH_BYTES)
+
+    Yields
+    ------
+    Frame, namedtuple of step, box, types, typeid, position and image
+    """
+    with _open_frames(gsdfile) as reader:
+        frames = range(len(reader))[start:stop:stride]
+        yield from _iter_frames(reader, frames, depth, max_bytes)
+
+
+def _file_fingerprint(filename, n_bytes=2 ** 20):
+    """
+    Returns a hash of the file's size, modification time, and its first and
+    last n_bytes. Used to key caches without reading large files in full.
+    """
+    stat = os.stat(filename)
+    sha = hashlib.sha1(f"{stat.st_size} {stat.st_mtime_ns}".encode())
+    with open(filename, "rb") as f:
+        sha.update(f.read(n_bytes))
+        if stat.st_size > n_bytes:
+            f.seek(max(stat.st_size - n_bytes, n_bytes))
+            sha.update(f.read(n_bytes))
+    return sha.hexdigest()
+
+
+def _mapping_arrays(mapping):
+    """
+    Returns (bead groups, bead names, CG bonds) given a CG_Compound made by
+    coarse() or bead_inds as built in coarse()
+    """
+    groups = _bead_groups(mapping)
+    if isinstance(getattr(mapping, "atomistic", None), AtomisticRecord):
+        names = [p.name for p in mapping.particles()]
+        bonds = mapping.bond_array()
+    else:
+        names = [b[2] for b in mapping]
+        bonds = np.empty((0, 2), dtype=int)
+    return groups, names, bonds
+
+
+class FrameCache:
+    """
+    On-disk cache of the positions, boxes and type ids of a gsd trajectory.
+    Positions are stored as a (n_frames, N, 3) array which is memory-mapped,
+    so frames are read without decoding the gsd file again. The cache can
+    store the trajectory mapped onto coarse-grained beads.
+
+    Create (or reopen) a cache with FrameCache.build() and pass it in place
+    of the gsd filename to gsd_rdf(), CG_Compound.from_gsd() and the other
+    trajectory analysis functions.
+
+    Attributes
+    ----------
+    position : np.memmap (n_frames, N, 3), scaled coordinates
+    box : np.ndarray (n_frames, 6), scaled hoomd boxes
+    step : np.ndarray (n_frames,), timestep of each frame
+    typeid : np.memmap (n_frames, N)
+    types : list of str
+    bonds : np.ndarray (B,2)
+    mass : np.ndarray (N,), particle (or bead) masses
+    """
+
+    def __init__(self, directory):
+        """
+        Parameters
+        ----------
+        directory : str, a cache directory written by FrameCache.build()
+        """
+        self.directory = directory
+        with open(os.path.join(directory, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        self.types = self.meta["types"]
+        self.position = np.load(
+            os.path.join(directory, "position.npy"), mmap_mode="r"
+        )
+        self.typeid = np.load(os.path.join(directory, "typeid.npy"), mmap_mode="r")
+        self.box = np.load(os.path.join(directory, "box.npy"))
+        self.step = np.load(os.path.join(directory, "step.npy"))
+        self.bonds = np.load(os.path.join(directory, "bonds.npy"))
+        mass = os.path.join(directory, "mass.npy")
+        # caches written before masses were stored have unit masses
+        if os.path.exists(mass):
+            self.mass = np.load(mass)
+        else:
+            self.mass = np.ones(self.position.shape[1])
+
+    @classmethod
+    def build(
+        cls,
+        gsdfile,
+        cache_dir=None,
+        dtype=np.float32,
+        mapping=None,
+        scale=1.0,
+        overwrite=False,
+    ):
+        """
+        Extracts a gsd trajectory into a cache, or opens the existing cache
+        if the file and options have not changed.
+
+        Parameters
+        ----------
+        gsdfile : str, filename of the gsd trajectory
+        cache_dir : str (default None)
+            Directory which holds caches. If None, ".frame_cache" next to gsdfile.
+        dtype : numpy dtype of the stored positions (default np.float32)
+        mapping : CG_Compound made by coarse(), or bead_inds (default None)
+            If given, the bead centers are stored instead of the particles.
+        scale : float, scaling factor multiplied to coordinates (default 1.0)
+        overwrite : bool, rebuild the cache even if it exists (default False)
+
+        Returns
+        -------
+        FrameCache
+        """
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                os.path.dirname(os.path.abspath(gsdfile)), ".frame_cache"
+            )
+        dtype = np.dtype(dtype)
+
+        key = hashlib.sha1(_file_fingerprint(gsdfile).encode())
+        key.update(f"{dtype.str} {float(scale)!r}".encode())
+        if mapping is not None:
+            groups, names, cg_bonds = _mapping_arrays(mapping)
+            atoms, offsets, _ = _flatten_groups(groups)
+            key.update(atoms.tobytes() + offsets.tobytes())
+            key.update(" ".join(names).encode())
+        name = os.path.splitext(os.path.basename(gsdfile))[0]
+        directory = os.path.join(cache_dir, f"{name}-{key.hexdigest()[:16]}")
+
+        if os.path.exists(os.path.join(directory, "meta.json")) and not overwrite:
+            return cls(directory)
+
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=cache_dir)
+        with _GSDReader(gsdfile) as reader:
+            first = reader[0]
+            if mapping is None:
+                types = first.types
+                n_particles = len(first.position)
+                bonds = reader.bonds
+                mass = reader.mass
+            else:
+                types = sorted(set(names))
+                n_particles = len(groups)
+                bonds = cg_bonds
+                bead_typeid = np.array([types.index(n) for n in names])
+                mass = np.add.reduceat(reader.mass[atoms], offsets)
+            typeid_dtype = np.uint8 if len(types) < 256 else np.uint16
+
+            shape = (len(reader), n_particles)
+            position = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, "position.npy"),
+                mode="w+",
+                dtype=dtype,
+                shape=shape + (3,),
+            )
+            typeid = np.lib.format.open_memmap(
+                os.path.join(tmp_dir, "typeid.npy"),
+                mode="w+",
+                dtype=typeid_dtype,
+                shape=shape,
+            )
+            box = np.empty((len(reader), 6))
+            step = np.empty(len(reader), dtype=np.uint64)
+            frames = _iter_frames(reader, range(len(reader)))
+            for i, frame in enumerate(frames):
+                step[i] = frame.step
+                box[i] = frame.box
+                box[i, :3] *= scale
+                xyz = frame.position * scale
+                if mapping is None:
+                    position[i] = xyz
+                    typeid[i] = frame.typeid
+                else:
+                    position[i] = bead_centers(xyz, groups, box=box[i])
+                    typeid[i] = bead_typeid
+            position.flush()
+            typeid.flush()
+            del position, typeid
+
+        np.save(os.path.join(tmp_dir, "box.npy"), box)
+        np.save(os.path.join(tmp_dir, "step.npy"), step)
+        np.save(os.path.join(tmp_dir, "mass.npy"), mass)
+        np.save(os.path.join(tmp_dir, "bonds.npy"), np.asarray(bonds, _index_dtype()))
+        meta = {
+            "source": os.path.abspath(gsdfile),
+            "types": list(types),
+            "scale": float(scale),
+            "mapped": mapping is not None,
+        }
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        if os.path.exists(directory):
+            shutil.rmtree(directory)
+        os.replace(tmp_dir, directory)
+        return cls(directory)
+
+    @property
+    def key(self):
+        """
+        str, name of the cache directory, unique to the source and options
+        """
+        return os.path.basename(os.path.normpath(self.directory))
+
+    def __len__(self):
+        return len(self.position)
+
+    def __getitem__(self, i):
+        return Frame(
+            self.step[i],
+            self.box[i],
+            self.types,
+            self.typeid[i],
+            self.position[i],
+            None,
+        )
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+def _legacy_frames(n_frames, start=0, stop=None, stride=1):
+    """
+    Frame indices used by gsd_rdf: stop defaults to the last frame (exclusive)
+    and negative starts count back from the last frame.
+    """
+    if stop is None:
+        stop = n_frames - 1
+    if start < 0:
+        start += n_frames - 1
+    return range(start, stop, stride)
+
+
+def _type_positions(frame, A_name, B_name):
+    """
+    Positions of the particles named A_name and B_name in a Frame
+    """
+    A_pos = frame.position[frame.typeid == frame.types.index(A_name)]
+    if A_name == B_name:
+        return A_pos
+    B_pos = frame.position[frame.typeid == frame.types.index(B_name)]
+    return np.concatenate((A_pos, B_pos))
+
+
+def gsd_log(gsdfile, name):
+    """
+    Reads a logged quantity of every frame in a gsd file
+
+    Parameters
+    ----------
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+    name : str, name of the log entry, with or without the "log/" prefix
+        e.g., "md/compute/ThermodynamicQuantities/potential_energy"
+
+    Returns
+    -------
+    np.ndarray (n_frames, ...), the value in each frame. Frames where the
+    quantity was not written repeat the last written value.
+    """
+    if isinstance(gsdfile, FrameCache):
+        gsdfile = gsdfile.meta["source"]
+    if not name.startswith("log/"):
+        name = "log/" + name
+
+    f = gsd.pygsd.GSDFile(open(gsdfile, "rb"))
+    values = []
+    last = None
+    for i in range(f.nframes):
+        if f.chunk_exists(frame=i, name=name):
+            last = f.read_chunk(frame=i, name=name)
+        if last is None:
+            f.close()
+            raise KeyError(f"{name} not found in {gsdfile}")
+        values.append(last)
+    f.close()
+    return np.array(values)
+
+
+def _rdf_peak(frame, A_name, B_name, rmax, bins):
+    """
+    Height of the highest peak of the rdf of a single Frame
+    """
+    box = freud.box.Box(*frame.box)
+    pos = _type_positions(frame, A_name, B_name)
+    rdf = freud.density.RDF(bins, rmax)
+    rdf.compute(freud.locality.AABBQuery.from_system((box, pos)))
+    return np.max(rdf.rdf)
+
+
+def _decorrelated_frames(
+    reader, gsdfile, frames, decorrelate, A_name, B_name, rmax=None, n_probe=100
+):
+    """
+    Returns (independent frames, decorrelation time in frames).
+
+    The decorrelation time is estimated from a per-frame observable:
+    decorrelate="rdf" uses the height of the A-B rdf peak of up to n_probe
+    evenly spaced frames, any other string is read as a log quantity with
+    gsd_log(). Only every decorrelation time-th frame is kept. If decorrelate
+    is None every frame is kept.
+    """
+    if decorrelate is not None and not isinstance(decorrelate, str):
+        raise ValueError(
+            "decorrelate must be None, 'rdf' or the name of a log quantity, "
+            f"not {decorrelate!r}."
+        )
+    frames = range(len(reader))[frames.start : frames.stop : frames.step]
+    if decorrelate is None or len(frames) < 2:
+        return frames, 1
+
+    if decorrelate == "rdf":
+        probe = max(len(frames) // n_probe, 1)
+        probe_frames = frames[::probe]
+        if rmax is None:
+            rmax = max(reader[0].box[:3]) / 2 - 1
+        values = [
+            _rdf_peak(frame, A_name, B_name, rmax, 50)
+            for frame in _iter_frames(reader, probe_frames)
+        ]
+    else:
+        probe = 1
+        log = gsd_log(gsdfile, decorrelate)
+        if log.ndim > 1:
+            raise ValueError(f"{decorrelate} is not a scalar quantity.")
+        values = log[list(frames)]
+    tau = decorrelation_time(values) * probe
+    return frames[::tau], tau * frames.step
+
+
+def gsd_rdf(
+    gsdfile,
+    A_name,
+    B_name,
+    start=0,
+    stop=None,
+    rmax=None,
+    bins=50,
+    stride=1,
+    decorrelate=None,
+):
     """
     This function calculates the radial distribution function given
     a gsd file and the names of the particles. By default it will calculate
@@ -216,7 +915,7 @@ def gsd_rdf(gsdfile, A_name, B_name, start=0, stop=None, rmax=None, bins=50):
 
     Parameters
     ----------
-    gsdfile : str, filename of the gsd trajectory
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
     A_name, B_name : str, name(s) of particles between which to calculate the rdf
         (found in gsd.hoomd.Snapshot.particles.types)
     start : int, which frame to start accumulating the rdf (default 0)
@@ -225,43 +924,34 @@ def gsd_rdf(gsdfile, A_name, B_name, start=0, stop=None, rmax=None, bins=50):
         If none is given, the function will default to the last frame.
     rmax : float, maximum radius to consider. (default None)
         If none is given, it'll be the minimum box length / 4
-    rdf : freud.density.RDF, if provided, this function will accumulate an average rdf,
-        otherwise it will provide the rdf only for the given compound. (default None)
     bins : int, number of bins to use when calculating the distribution.
+    stride : int, use every stride-th frame (default 1)
+    decorrelate : str, only use statistically independent frames (default None)
+        Either "rdf", to estimate the decorrelation time from the rdf peak
+        height, or the name of a scalar log quantity in the gsd file
+        (e.g., "md/compute/ThermodynamicQuantities/potential_energy").
+        See gsd_rdf_errors() for the number of samples and uncertainties.
 
     Returns
     -------
     freud.density.RDF
     """
-    f = gsd.pygsd.GSDFile(open(gsdfile, "rb"))
-    t = gsd.hoomd.HOOMDTrajectory(f)
-    snap = t[0]
-    if rmax is None:
-        rmax = max(snap.configuration.box[:3]) / 2 - 1
+    with _open_frames(gsdfile) as reader:
+        if rmax is None:
+            rmax = max(reader[0].box[:3]) / 2 - 1
 
-    rdf = freud.density.RDF(bins, rmax)
+        rdf = freud.density.RDF(bins, rmax)
 
-    if stop is None:
-        stop = len(t) - 1
-    if start < 0:
-        start += len(t) - 1
-    for frame in range(start, stop):
-        snap = t[frame]
-        box = freud.box.Box(*snap.configuration.box)
-        A_pos = snap.particles.position[
-                snap.particles.typeid == snap.particles.types.index(A_name)
-                ]
-        pos = A_pos
-        if A_name != B_name:
-            B_pos = snap.particles.position[
-                    snap.particles.typeid == snap.particles.types.index(B_name)
-                    ]
-            pos = np.concatenate((A_pos, B_pos))
-
-        n_query = freud.locality.AABBQuery.from_system((
-            box, pos
-        ))
-        rdf.compute(n_query, reset=False)
+        frames = _legacy_frames(len(reader), start, stop, stride)
+        if decorrelate is not None:
+            frames, _ = _decorrelated_frames(
+                reader, gsdfile, frames, decorrelate, A_name, B_name, rmax
+            )
+        for frame in _iter_frames(reader, frames):
+            box = freud.box.Box(*frame.box)
+            pos = _type_positions(frame, A_name, B_name)
+            n_query = freud.locality.AABBQuery.from_system((box, pos))
+            rdf.compute(n_query, reset=False)
     return rdf
 
 
@@ -310,238 +1000,3322 @@ def get_compound_rdf(compound, A_name, B_name, rmax=None, bins=50, rdf=None):
     return rdf
 
 
-def map_good_on_bad(good_mol, bad_mol):
+RDFErrors = namedtuple(
+    "RDFErrors", ["bin_centers", "rdf", "serr", "rel_err", "n_samples", "decorr"]
+)
+
+
+def gsd_rdf_errors(
+    gsdfile,
+    A_name,
+    B_name,
+    start=0,
+    stop=None,
+    rmax=None,
+    bins=50,
+    decorrelate="rdf",
+):
     """
-    This function takes a correctly-typed (good) and a poorly-typed (bad)
-    pybel molecule and transfers the bond and atom typing from the good to
-    the bad molecule but retains the atom positions.
-    It assumes that both molecules have the same number of particles and
-    they maintain their order.
-    Changes:
-    atom- type, isaromatic
-    bond- order, isaromatic
+    Calculates the rdf from the statistically independent frames of a
+    trajectory along with its uncertainty.
 
     Parameters
     ----------
-    good_mol, bad_mol : pybel.Molecule
+    gsdfile, A_name, B_name, start, stop, rmax, bins : see gsd_rdf()
+    decorrelate : str, observable used to find the decorrelation time
+        (default "rdf"). See gsd_rdf(). If None, every frame is used as an
+        independent sample (decorr is 1).
 
     Returns
     -------
-    pybel.Molecule
+    RDFErrors, namedtuple of
+        bin_centers : np.ndarray (bins,)
+        rdf : np.ndarray (bins,), mean rdf of the independent frames
+        serr, rel_err : np.ndarray (bins,), standard and relative (%) error
+            of each bin from error_analysis()
+        n_samples : int, number of independent frames used
+        decorr : int, decorrelation time in frames
     """
+    with _open_frames(gsdfile) as reader:
+        if rmax is None:
+            rmax = max(reader[0].box[:3]) / 2 - 1
+        rdf = freud.density.RDF(bins, rmax)
 
-    for i in range(1, good_mol.OBMol.NumAtoms()):
-        good_atom = good_mol.OBMol.GetAtom(i)
-        bad_atom = bad_mol.OBMol.GetAtom(i)
-        bad_atom.SetType(good_atom.GetType())
-        bad_atom.SetAromatic(good_atom.IsAromatic())
-
-    for i in range(1, good_mol.OBMol.NumBonds()):
-        good_bond = good_mol.OBMol.GetBond(i)
-        bad_bond = bad_mol.OBMol.GetBond(i)
-        bad_bond.SetBondOrder(good_bond.GetBondOrder())
-        bad_bond.SetAromatic(good_bond.IsAromatic())
+        frames = _legacy_frames(len(reader), start, stop)
+        frames, decorr = _decorrelated_frames(
+            reader, gsdfile, frames, decorrelate, A_name, B_name, rmax
+        )
+        rdfs = []
+        for frame in _iter_frames(reader, frames):
+            box = freud.box.Box(*frame.box)
+            pos = _type_positions(frame, A_name, B_name)
+            rdf.compute(freud.locality.AABBQuery.from_system((box, pos)))
+            rdfs.append(np.array(rdf.rdf))
+    rdfs = np.array(rdfs)
+    serr, rel_err = error_analysis(rdfs, axis=0)
+    return RDFErrors(
+        np.array(rdf.bin_centers), rdfs.mean(axis=0), serr, rel_err, len(rdfs), decorr
+    )
+
+
+RDFBlocks = namedtuple(
+    "RDFBlocks", ["bin_centers", "rdf", "serr", "lower", "upper", "blocks"]
+)
+
+
+def gsd_rdf_blocks(
+    gsdfile,
+    A_name,
+    B_name,
+    start=0,
+    stop=None,
+    rmax=None,
+    bins=50,
+    stride=1,
+    n_blocks=5,
+    n_boot=1000,
+    ci=95,
+    seed=None,
+):
+    """
+    Calculates the rdf of a trajectory with block error bars in a single read.
+    The frames are split into n_blocks consecutive blocks and the rdf of each
+    block is kept while streaming; the block standard error and a bootstrap
+    confidence band (resampling blocks) are found from those.
 
-    return bad_mol
+    Parameters
+    ----------
+    gsdfile, A_name, B_name, start, stop, rmax, bins, stride : see gsd_rdf()
+    n_blocks : int, number of blocks of frames (default 5)
+    n_boot : int, number of bootstrap resamples (default 1000)
+    ci : float, width of the confidence band in percent (default 95)
+    seed : int, seed of the bootstrap random number generator (default None)
 
+    Returns
+    -------
+    RDFBlocks, namedtuple of
+        bin_centers : np.ndarray (bins,)
+        rdf : np.ndarray (bins,), mean rdf over all frames
+        serr : np.ndarray (bins,), standard error of the block rdfs
+        lower, upper : np.ndarray (bins,), bounds of the confidence band
+        blocks : np.ndarray (n_blocks, bins), rdf of each block
+    """
+    with _open_frames(gsdfile) as reader:
+        if rmax is None:
+            rmax = max(reader[0].box[:3]) / 2 - 1
+        rdf = freud.density.RDF(bins, rmax)
 
-def save_mol_to_file(good_mol, filename):
+        frames = _legacy_frames(len(reader), start, stop, stride)
+        if len(frames) < n_blocks:
+            raise ValueError(f"Need at least {n_blocks} frames for {n_blocks} blocks.")
+        block_frames = np.array_split(np.array(frames), n_blocks)
+        blocks = []
+        for block in block_frames:
+            for i, frame in enumerate(_iter_frames(reader, block)):
+                box = freud.box.Box(*frame.box)
+                pos = _type_positions(frame, A_name, B_name)
+                n_query = freud.locality.AABBQuery.from_system((box, pos))
+                rdf.compute(n_query, reset=i == 0)
+            blocks.append(np.array(rdf.rdf))
+    blocks = np.array(blocks)
+    weights = [len(block) for block in block_frames]
+
+    rng = np.random.default_rng(seed)
+    resample = rng.integers(n_blocks, size=(n_boot, n_blocks))
+    boot = blocks[resample].mean(axis=1)
+    lower, upper = np.percentile(boot, [(100 - ci) / 2, (100 + ci) / 2], axis=0)
+    return RDFBlocks(
+        np.array(rdf.bin_centers),
+        np.average(blocks, axis=0, weights=weights),
+        error_analysis(blocks, axis=0)[0],
+        lower,
+        upper,
+        blocks,
+    )
+
+
+def _excluded_pairs(n_particles, bonds, exclusions):
     """
-    This function takes a correctly-typed (good) pybel molecule and saves
-    the bond and atom typing to a file for later use.
+    Keys i * n_particles + j (i < j) of the particle pairs excluded from pair
+    interactions as by hoomd neighbor list exclusions: "bond" (1-2 pairs),
+    and "angle" or "1-3" (1-3 pairs). Returns a sorted np.ndarray.
+    """
+    unknown = set(exclusions) - {"bond", "angle", "1-3"}
+    if unknown:
+        raise ValueError(
+            f"Exclusions {sorted(unknown)} are not supported; use 'bond', "
+            "'angle' or '1-3'."
+        )
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    pairs = [np.empty((0, 2), dtype=np.int64)]
+    if "bond" in exclusions:
+        pairs.append(bonds)
+    if {"angle", "1-3"} & set(exclusions):
+        pairs.append(angles_from_bonds(bonds)[:, [0, 2]])
+    pairs = np.sort(np.concatenate(pairs), axis=1)
+    return np.unique(pairs[:, 0] * n_particles + pairs[:, 1])
+
+
+def gsd_partial_rdf(
+    gsdfile,
+    A_name,
+    B_name,
+    start=0,
+    stop=None,
+    stride=1,
+    rmax=None,
+    bins=50,
+    exclusions=(),
+):
+    """
+    Calculates the partial radial distribution function g_AB(r) of a
+    trajectory: the density of B particles around A particles. Unlike
+    gsd_rdf(), which for A != B finds the rdf of all A and B particles
+    together, only A-B pairs are counted. Pairs excluded from the pair
+    interactions (e.g. bonded neighbors) can be left out, so the rdf matches
+    the one a pair potential acts on.
 
     Parameters
     ----------
-    good_mol : pybel.Molecule
-    filename : str, name of file
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+    A_name, B_name : str, names of the particles (found in
+        gsd.hoomd.Snapshot.particles.types)
+    start, stop, stride : int, frames to use, following python slicing
+        (default 0, None, 1)
+    rmax : float, maximum radius to consider (default None)
+        If None, half the largest box length minus 1, as in gsd_rdf().
+    bins : int, number of bins (default 50)
+    exclusions : tuple of str, bonded pairs to leave out, as hoomd neighbor
+        list exclusions: "bond", "angle" or "1-3" (default ())
 
-    use map_file_on_bad() to use this file
+    Returns
+    -------
+    freud.density.RDF
     """
+    with _open_frames(gsdfile) as reader:
+        first = reader[0]
+        if rmax is None:
+            rmax = max(first.box[:3]) / 2 - 1
+        n_particles = len(first.position)
+        excluded = _excluded_pairs(n_particles, reader.bonds, exclusions)
+        rdf = freud.density.RDF(bins, rmax)
 
-    with open(filename, "w") as f:
-        for i in range(1, good_mol.OBMol.NumAtoms()):
-            good_atom = good_mol.OBMol.GetAtom(i)
-            f.write(f"{good_atom.GetType()}   {good_atom.IsAromatic()}\n")
-
-        for i in range(1, good_mol.OBMol.NumBonds()):
-            good_bond = good_mol.OBMol.GetBond(i)
-            f.write(f"{good_bond.GetBO()}   {good_bond.IsAromatic()}\n")
+        frames = range(len(reader))[start:stop:stride]
+        for frame in _iter_frames(reader, frames):
+            A = np.flatnonzero(frame.typeid == frame.types.index(A_name))
+            B = np.flatnonzero(frame.typeid == frame.types.index(B_name))
+            box = freud.box.Box(*frame.box)
+            A_pos, B_pos = frame.position[A], frame.position[B]
+            query = freud.locality.AABBQuery(box, B_pos)
+            nlist = query.query(
+                A_pos, dict(r_max=rmax, exclude_ii=A_name == B_name)
+            ).toNeighborList()
+            if len(excluded):
+                i = A[nlist.query_point_indices].astype(np.int64)
+                j = B[nlist.point_indices].astype(np.int64)
+                keys = np.minimum(i, j) * n_particles + np.maximum(i, j)
+                nlist.filter(~np.isin(keys, excluded))
+            rdf.compute((box, B_pos), query_points=A_pos, neighbors=nlist, reset=False)
+    return rdf
 
 
-def map_file_on_bad(filename, bad_mol):
+def _type_amplitudes_grid(frac, typeid, n_types, n_grid):
     """
-    This function takes a filename containing correctly-typed and a poorly-typed (bad)
-    pybel molecule and transfers the bond and atom typing from the good to
-    the bad molecule but retains the atom positions.
-    It assumes that both molecules have the same number of particles and
-    they maintain their order.
-    Changes:
-    atom- type, isaromatic
-    bond- order, isaromatic
+    Fourier transform of the density of each type assigned to an n_grid^3
+    grid from fractional coordinates. Particles are spread over the 27
+    nearest grid points (triangular shaped cloud) and the transform is
+    divided by the window of the assignment, which leaves aliasing errors
+    below 1% in S(q) up to half the Nyquist wave number.
+    Returns (np.ndarray (n_types, n, n, n) complex, integer wave vectors
+    (n, n, n, 3))
+    """
+    u = frac * n_grid
+    center = np.rint(u).astype(int)
+    d = u - center
+    # weights of the grid points at offsets -1, 0, 1 along each axis
+    axis_weights = np.stack(
+        (0.5 * (0.5 - d) ** 2, 0.75 - d ** 2, 0.5 * (0.5 + d) ** 2)
+    )
+    rho = np.zeros(n_types * n_grid ** 3)
+    for i, j, k in itertools.product(range(3), repeat=3):
+        cell = (center + np.array([i, j, k]) - 1) % n_grid
+        flat = np.ravel_multi_index(cell.T, (n_grid,) * 3) + typeid * n_grid ** 3
+        weight = axis_weights[i, :, 0] * axis_weights[j, :, 1] * axis_weights[k, :, 2]
+        rho += np.bincount(flat, weight, minlength=n_types * n_grid ** 3)
+    rho = rho.reshape((n_types,) + (n_grid,) * 3)
+
+    m = np.rint(np.fft.fftfreq(n_grid) * n_grid)
+    waves = np.stack(np.meshgrid(m, m, m, indexing="ij"), axis=-1)
+    window = np.prod(np.sinc(waves / n_grid) ** 3, axis=-1)
+    return np.fft.fftn(rho, axes=(1, 2, 3)) / window, waves
+
+
+def _type_amplitudes_direct(frac, typeid, n_types, waves, chunk_size=1024):
+    """
+    Fourier amplitudes of each type at integer wave vectors waves (K,3)
+    summed directly over the particles, in blocks of chunk_size particles
+    and wave vectors.
+    Returns np.ndarray (n_types, K) complex
+    """
+    amps = np.zeros((n_types, len(waves)), dtype=complex)
+    onehot = np.eye(n_types)[typeid]
+    for j in range(0, len(frac), chunk_size):
+        block = frac[j : j + chunk_size]
+        members = onehot[j : j + chunk_size].T
+        for i in range(0, len(waves), chunk_size):
+            phase = np.exp(-2j * np.pi * block @ waves[i : i + chunk_size].T)
+            amps[:, i : i + chunk_size] += members @ phase
+    return amps
+
+
+def _wave_vectors(matrix, q_max):
+    """
+    Integer wave vectors (K,3) of the reciprocal lattice of the box with
+    0 < |q| <= q_max
+    """
+    reciprocal = 2 * np.pi * np.linalg.inv(matrix)
+    n_max = np.ceil(q_max * np.linalg.norm(matrix, axis=0) / (2 * np.pi)).astype(int)
+    ranges = [np.arange(-n, n + 1) for n in n_max]
+    waves = np.stack(np.meshgrid(*ranges, indexing="ij"), axis=-1).reshape(-1, 3)
+    q = np.linalg.norm(waves @ reciprocal, axis=1)
+    return waves[(q > 0) & (q <= q_max)]
+
+
+SQResult = namedtuple("SQResult", ["q", "sq", "counts"])
+
+
+def gsd_structure_factor(
+    gsdfile,
+    start=0,
+    stop=None,
+    stride=1,
+    method="grid",
+    n_grid=64,
+    q_max=None,
+    bins=100,
+    pairs=None,
+    weights=None,
+):
+    """
+    Calculates the static structure factor S(q), averaged over frames of a
+    trajectory and over the directions of q.
+
+    S(q) is found per frame from the Fourier amplitudes of each particle type,
+    either by assigning the density to a grid and taking its FFT
+    (method="grid") or by summing over the particles at each reciprocal lattice vector
+    (method="direct"). The direct sum is exact but its cost grows with
+    q_max^3 * N, so keep q_max small.
 
     Parameters
     ----------
-    filename : str, generated using save_mol_to_file()
-    bad_mol : pybel.Molecule
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+    start, stop, stride : int, frames to use, following python slicing
+        (default 0, None, 1)
+    method : str, "grid" or "direct" (default "grid")
+    n_grid : int, number of grid points along each box vector (default 64)
+    q_max : float, largest q (default None)
+        If None, half the Nyquist wave number of the grid along the shortest
+        box vector.
+    bins : int, number of q bins (default 100)
+    pairs : list of tuples of str, type pairs of the partial structure factors
+        to calculate, e.g. [("_B", "_B"), ("_B", "_S")] (default None)
+    weights : dict, scattering length (form factor) of each type, e.g.
+        {"_B": 1.0, "_S": 0.5} (default None). If None, all are 1.
 
     Returns
     -------
-    pybel.Molecule
+    SQResult, namedtuple of
+        q : np.ndarray (bins,), bin centers
+        sq : dict of np.ndarray (bins,), the weighted total S(q) under "total"
+            and each partial S_AB(q) under (A, B)
+        counts : np.ndarray (bins,), number of q vectors in each bin
     """
-    with open(filename, "r") as f:
-        lines = f.readlines()
-    atoms = []
-    bonds = []
-    for line in lines:
-        one, two = line.split()
-        if not one.isdigit():
-            atoms.append((one, two))
-        else:
-            bonds.append((one, two))
+    if method not in ("grid", "direct"):
+        raise ValueError(f"method must be 'grid' or 'direct', not {method}.")
+    pairs = [tuple(pair) for pair in pairs or []]
+
+    with _open_frames(gsdfile) as reader:
+        types = reader[0].types
+        f = np.ones(len(types))
+        if weights is not None:
+            f = np.array([weights.get(t, 0.0) for t in types], dtype=float)
+        if q_max is None:
+            lengths = np.linalg.norm(box_matrix(reader[0].box), axis=0)
+            q_max = np.pi * n_grid / lengths.max() / 2
+        edges = np.linspace(0, q_max, bins + 1)
+
+        sums = {key: np.zeros(bins) for key in ["total"] + pairs}
+        counts = np.zeros(bins)
+        frames = range(len(reader))[start:stop:stride]
+        for frame in _iter_frames(reader, frames):
+            matrix = box_matrix(frame.box)
+            frac = np.asarray(frame.position, dtype=float) @ np.linalg.inv(matrix).T
+            typeid = np.asarray(frame.typeid, dtype=int)
+            if method == "grid":
+                amps, waves = _type_amplitudes_grid(frac, typeid, len(types), n_grid)
+                amps = amps.reshape(len(types), -1)
+                waves = waves.reshape(-1, 3)
+            else:
+                waves = _wave_vectors(matrix, q_max)
+                amps = _type_amplitudes_direct(frac, typeid, len(types), waves)
+            q = np.linalg.norm(waves @ (2 * np.pi * np.linalg.inv(matrix)), axis=1)
+            in_range = (q > 0) & (q <= q_max)
+            which = np.digitize(q[in_range], edges[1:-1])
+            amps = amps[:, in_range]
+            n = np.bincount(typeid, minlength=len(types))
+
+            total = np.abs(f @ amps) ** 2 / np.sum(f ** 2 * n)
+            sums["total"] += np.bincount(which, total, minlength=bins)
+            for a, b in pairs:
+                i, j = types.index(a), types.index(b)
+                partial = np.real(amps[i] * amps[j].conj()) / np.sqrt(n[i] * n[j])
+                sums[(a, b)] += np.bincount(which, partial, minlength=bins)
+            counts += np.bincount(which, minlength=bins)
+
+    with np.errstate(invalid="ignore"):
+        sq = {key: s / counts for key, s in sums.items()}
+    return SQResult((edges[1:] + edges[:-1]) / 2, sq, counts / max(len(frames), 1))
+
+
+def _histogram(vals, nbins, bin_range=None):
+    """
+    Same layout as bin_distribution(): np.ndarray (nbins,2) of bin centers
+    and counts
+    """
+    counts, edges = np.histogram(vals, bins=nbins, range=bin_range)
+    return np.column_stack(((edges[1:] + edges[:-1]) / 2, counts))
 
-    for i in range(1, bad_mol.OBMol.NumAtoms()):
-        bad_atom = bad_mol.OBMol.GetAtom(i)
-        bad_atom.SetType(atoms[i - 1][0])
-        if atoms[i - 1][1] == "True":
-            bad_atom.SetAromatic()
-        else:
-            bad_atom.UnsetAromatic()
 
-    for i in range(1, bad_mol.OBMol.NumBonds()):
-        bad_bond = bad_mol.OBMol.GetBond(i)
-        bad_bond.SetBO(int(bonds[i - 1][0]))
-        if bonds[i - 1][1] == "True":
-            bad_bond.SetAromatic()
-        else:
-            bad_bond.UnsetAromatic()
+def angles_from_bonds(bonds):
+    """
+    Finds every angle (i, j, k) with center j from a bond array
 
-    return bad_mol
+    Parameters
+    ----------
+    bonds : np.ndarray (B,2), particle indices of each bond
+
+    Returns
+    -------
+    np.ndarray (M,3), particle indices of each angle
+    """
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    # (center, neighbor) pairs sorted by center
+    edges = np.concatenate((bonds, bonds[:, ::-1]))
+    edges = edges[np.lexsort((edges[:, 1], edges[:, 0]))]
+    if len(edges) == 0:
+        return np.empty((0, 3), dtype=int)
+    max_degree = np.bincount(edges[:, 0]).max()
+
+    angles = []
+    index = np.arange(len(edges))
+    for shift in range(1, max_degree):
+        first = index[:-shift]
+        second = first + shift
+        same = edges[first, 0] == edges[second, 0]
+        angles.append(
+            np.column_stack(
+                (
+                    edges[first[same], 1],
+                    edges[first[same], 0],
+                    edges[second[same], 1],
+                )
+            )
+        )
+    if not angles:
+        return np.empty((0, 3), dtype=int)
+    return np.concatenate(angles)
+
+
+def _match_names(names, pattern):
+    """
+    Boolean mask of the rows of names (M,K) which match pattern
+    in either direction
+    """
+    pattern = np.asarray(pattern)
+    return np.all(names == pattern, axis=1) | np.all(names == pattern[::-1], axis=1)
+
+
+def gsd_bond_distribution(
+    gsdfile,
+    A_name,
+    B_name,
+    start=0,
+    stop=None,
+    stride=1,
+    nbins=50,
+    bin_range=None,
+    decorrelate=None,
+):
+    """
+    Calculates the distribution of the lengths of A-B bonds over a trajectory.
+
+    Parameters
+    ----------
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+    A_name, B_name : str, particle names of the bonded pair
+    start, stop, stride : int, frames to use, following python slicing
+        (default 0, None, 1)
+    nbins : int, number of bins (default 50)
+    bin_range : tuple of floats, (min, max) of the bins (default None)
+        If None, the range of the bond lengths is used.
+    decorrelate : str, only use statistically independent frames (default None)
+        See gsd_rdf(); "rdf" uses the rdf of the A-B rdf.
+
+    Returns
+    -------
+    np.ndarray (nbins,2), where the first column is the mean value of the bin and
+    the second column is number of values which fell into that bin
+    """
+    with _open_frames(gsdfile) as reader:
+        first = reader[0]
+        names = np.array(first.types)[first.typeid]
+        bonds = reader.bonds
+        bonds = bonds[_match_names(names[bonds], (A_name, B_name))]
+        if len(bonds) == 0:
+            raise ValueError(f"No {A_name}-{B_name} bonds found.")
+
+        lengths = []
+        frames = range(len(reader))[start:stop:stride]
+        if decorrelate is not None:
+            frames, _ = _decorrelated_frames(
+                reader, gsdfile, frames, decorrelate, A_name, B_name
+            )
+        for frame in _iter_frames(reader, frames):
+            vectors = frame.position[bonds[:, 1]] - frame.position[bonds[:, 0]]
+            vectors = minimum_image(vectors, frame.box)
+            lengths.append(np.linalg.norm(vectors, axis=1))
+    return _histogram(np.concatenate(lengths), nbins, bin_range)
+
+
+def gsd_angle_distribution(
+    gsdfile,
+    A_name,
+    B_name,
+    C_name,
+    start=0,
+    stop=None,
+    stride=1,
+    nbins=50,
+    bin_range=None,
+    decorrelate=None,
+):
+    """
+    Calculates the distribution of A-B-C angles (B is the center) over a
+    trajectory.
+
+    Parameters
+    ----------
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+    A_name, B_name, C_name : str, particle names of the angle
+    start, stop, stride : int, frames to use, following python slicing
+        (default 0, None, 1)
+    nbins : int, number of bins (default 50)
+    bin_range : tuple of floats, (min, max) of the bins in radians (default None)
+        If None, the range of the angles is used.
+    decorrelate : str, only use statistically independent frames (default None)
+        See gsd_rdf(); "rdf" uses the A-C rdf.
+
+    Returns
+    -------
+    np.ndarray (nbins,2), where the first column is the mean value of the bin and
+    the second column is number of values which fell into that bin
+    """
+    with _open_frames(gsdfile) as reader:
+        first = reader[0]
+        names = np.array(first.types)[first.typeid]
+        angles = angles_from_bonds(reader.bonds)
+        angles = angles[_match_names(names[angles], (A_name, B_name, C_name))]
+        if len(angles) == 0:
+            raise ValueError(f"No {A_name}-{B_name}-{C_name} angles found.")
+
+        values = []
+        frames = range(len(reader))[start:stop:stride]
+        if decorrelate is not None:
+            frames, _ = _decorrelated_frames(
+                reader, gsdfile, frames, decorrelate, A_name, C_name
+            )
+        for frame in _iter_frames(reader, frames):
+            pos = frame.position
+            ba = minimum_image(pos[angles[:, 0]] - pos[angles[:, 1]], frame.box)
+            bc = minimum_image(pos[angles[:, 2]] - pos[angles[:, 1]], frame.box)
+            cos = np.sum(ba * bc, axis=1) / (
+                np.linalg.norm(ba, axis=1) * np.linalg.norm(bc, axis=1)
+            )
+            values.append(np.arccos(np.clip(cos, -1, 1)))
+    return _histogram(np.concatenate(values), nbins, bin_range)
+
+
+def molecule_ids(n_particles, bonds):
+    """
+    Labels the connected molecules of a bond network
+
+    Parameters
+    ----------
+    n_particles : int
+    bonds : np.ndarray (B,2), particle indices of each bond
+
+    Returns
+    -------
+    np.ndarray (n_particles,), molecule index of each particle, numbered
+    0, 1, ... in order of each molecule's lowest particle index
+    """
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    labels = np.arange(n_particles)
+    while True:
+        old = labels
+        labels = labels.copy()
+        np.minimum.at(labels, bonds[:, 0], labels[bonds[:, 1]])
+        np.minimum.at(labels, bonds[:, 1], labels[bonds[:, 0]])
+        labels = labels[labels]
+        if np.array_equal(labels, old):
+            break
+    return np.unique(labels, return_inverse=True)[1].astype(_index_dtype())
+
+
+class Chains:
+    """
+    Per-molecule conformational properties calculated with segmented numpy
+    reductions. Particles are sorted by molecule once; each property is then
+    found for every chain at once.
+
+    The particles of each chain are used in index order, so they should be
+    numbered along the chain (as in polymers built with mbuild). Select
+    backbone particles with mask to leave out side chains.
+    """
+
+    def __init__(self, mol, mask=None):
+        """
+        Parameters
+        ----------
+        mol : np.ndarray (N,), molecule index of each particle (molecule_ids())
+        mask : np.ndarray (N,) of bool, particles to use (default None)
+            If None, all particles are used.
+        """
+        mol = np.asarray(mol)
+        inds = np.arange(len(mol)) if mask is None else np.flatnonzero(mask)
+        self.order = inds[np.argsort(mol[inds], kind="stable")]
+        sorted_mol = mol[self.order]
+        self.starts = np.flatnonzero(np.r_[True, sorted_mol[1:] != sorted_mol[:-1]])
+        self.counts = np.diff(np.r_[self.starts, len(self.order)])
+        self.segment = np.repeat(np.arange(len(self.starts)), self.counts)
+        # bond i joins sorted particles i and i+1 of the same chain
+        self.bond_segment = self.segment[:-1][self.segment[1:] == self.segment[:-1]]
+        self._bonds = np.flatnonzero(self.segment[1:] == self.segment[:-1])
+
+    @property
+    def n_chains(self):
+        return len(self.starts)
+
+    def unwrap(self, xyz, box, image=None):
+        """
+        Returns the sorted, unwrapped coordinates of the chains
+
+        Parameters
+        ----------
+        xyz : np.ndarray (N,3), wrapped coordinates
+        box : box accepted by box_matrix()
+        image : np.ndarray (N,3) of int, periodic images (default None)
+            If None or all zero (images were not written), each chain is
+            unwrapped by joining consecutive particles through the minimum
+            image.
+
+        Returns
+        -------
+        np.ndarray (n,3), coordinates in chain order
+        """
+        matrix = box_matrix(box)
+        x = np.asarray(xyz, dtype=_float_dtype())[self.order]
+        if image is not None and np.any(image):
+            return x + np.asarray(image)[self.order] @ matrix.T
+        steps = np.zeros_like(x)
+        steps[1:] = _minimum_image(x[1:] - x[:-1], matrix)
+        steps[self.starts] = 0
+        path = np.cumsum(steps, axis=0)
+        path -= path[self.starts][self.segment]
+        return x[self.starts][self.segment] + path
+
+    def radius_of_gyration(self, x):
+        """
+        np.ndarray (n_chains,), radius of gyration of each chain given
+        unwrapped, sorted coordinates x from unwrap()
+        """
+        com = np.add.reduceat(x, self.starts) / self.counts[:, None]
+        sq = np.sum((x - com[self.segment]) ** 2, axis=1)
+        return np.sqrt(np.add.reduceat(sq, self.starts) / self.counts)
+
+    def end_to_end(self, x):
+        """
+        np.ndarray (n_chains,), end-to-end distance of each chain given
+        unwrapped, sorted coordinates x from unwrap()
+        """
+        ends = self.starts + self.counts - 1
+        return np.linalg.norm(x[ends] - x[self.starts], axis=1)
+
+    def bond_correlation(self, x, max_lag=20):
+        """
+        Ensemble average of the bond vector autocorrelation <u_i . u_(i+k)>
+        along the chains
+
+        Parameters
+        ----------
+        x : np.ndarray (n,3), unwrapped, sorted coordinates from unwrap()
+        max_lag : int, largest separation k in bonds (default 20)
+
+        Returns
+        -------
+        (np.ndarray (max_lag+1,), float), the correlation at k = 0..max_lag
+        (nan where no chain is long enough) and the mean bond length
+        """
+        bonds = x[self._bonds + 1] - x[self._bonds]
+        lengths = np.linalg.norm(bonds, axis=1)
+        u = bonds / lengths[:, None]
+        acf = np.full(max_lag + 1, np.nan)
+        for k in range(min(max_lag + 1, len(u))):
+            same = self.bond_segment[k:] == self.bond_segment[: len(u) - k]
+            if same.any():
+                dots = np.sum(u[k:] * u[: len(u) - k], axis=1)
+                acf[k] = dots[same].mean()
+        return acf, lengths.mean()
+
+
+def persistence_length(acf, bond_length):
+    """
+    Estimates the persistence length by fitting C(k) = exp(-k b / lp) to the
+    bond autocorrelation up to its first non-positive value
+
+    Parameters
+    ----------
+    acf : np.ndarray (K,), bond autocorrelation from Chains.bond_correlation()
+    bond_length : float, mean bond length b
+
+    Returns
+    -------
+    float
+    """
+    acf = np.asarray(acf)
+    positive = np.isfinite(acf) & (acf > 0)
+    n = np.argmin(positive) if not positive.all() else len(acf)
+    if n < 2:
+        return np.nan
+    slope = np.polyfit(np.arange(n), np.log(acf[:n]), 1)[0]
+    return -bond_length / slope if slope < 0 else np.inf
+
+
+ChainTrajectory = namedtuple(
+    "ChainTrajectory",
+    ["rg", "ree", "bond_acf", "bond_length", "mean_rg", "mean_ree", "lp"],
+)
+
+
+def gsd_chain_properties(gsdfile, start=0, stop=None, stride=1, types=None, max_lag=20):
+    """
+    Calculates the radius of gyration, end-to-end distance and bond vector
+    autocorrelation of every chain in every frame of a trajectory.
+    Molecules are found from the bonds of the first frame.
+
+    Parameters
+    ----------
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+    start, stop, stride : int, frames to use, following python slicing
+        (default 0, None, 1)
+    types : list of str, particle types to use, e.g. ["_B"] for the
+        backbone (default None). If None, all particles are used.
+    max_lag : int, largest bond separation of the autocorrelation (default 20)
+        It is reduced to fit the longest chain.
+
+    Returns
+    -------
+    ChainTrajectory, namedtuple of
+        rg, ree : np.ndarray (n_frames, n_chains)
+        bond_acf : np.ndarray (n_frames, max_lag+1)
+        bond_length : np.ndarray (n_frames,), mean bond length
+        mean_rg, mean_ree : float, ensemble averages
+        lp : float, persistence length from the averaged autocorrelation
+    """
+    with _open_frames(gsdfile) as reader:
+        first = reader[0]
+        mol = molecule_ids(len(first.position), reader.bonds)
+        mask = None
+        if types is not None:
+            mask = np.isin(np.array(first.types)[first.typeid], types)
+        chains = Chains(mol, mask)
+        max_lag = max(min(max_lag, chains.counts.max() - 2), 0)
+
+        rg, ree, acf, bond_length = [], [], [], []
+        frames = range(len(reader))[start:stop:stride]
+        for frame in _iter_frames(reader, frames):
+            x = chains.unwrap(frame.position, frame.box, frame.image)
+            rg.append(chains.radius_of_gyration(x))
+            ree.append(chains.end_to_end(x))
+            frame_acf, length = chains.bond_correlation(x, max_lag)
+            acf.append(frame_acf)
+            bond_length.append(length)
+    rg, ree, acf, bond_length = map(np.array, (rg, ree, acf, bond_length))
+    lp = persistence_length(np.nanmean(acf, axis=0), bond_length.mean())
+    return ChainTrajectory(rg, ree, acf, bond_length, rg.mean(), ree.mean(), lp)
+
+
+def msd_fft(x):
+    """
+    Mean squared displacement averaged over all time origins with the FFT
+    algorithm, O(T log T) per particle instead of O(T^2)
+
+    Parameters
+    ----------
+    x : np.ndarray (T,3) or (T,P,3), unwrapped coordinates of P particles
+        in T equally spaced frames
+
+    Returns
+    -------
+    np.ndarray (T,) or (T,P), msd at each lag of 0..T-1 frames
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    lags = (n - np.arange(n)).reshape((n,) + (1,) * (x.ndim - 2))
+
+    # S2: position autocorrelation, zero padded to avoid circular wrap
+    ft = np.fft.rfft(x, n=2 * n, axis=0)
+    s2 = np.fft.irfft(ft * ft.conj(), axis=0)[:n].sum(axis=-1) / lags
+
+    # S1: mean of r(k)^2 + r(k+m)^2 over origins k
+    sq = np.sum(x ** 2, axis=-1)
+    total = 2 * sq.sum(axis=0)
+    head = np.cumsum(sq, axis=0)
+    tail = np.cumsum(sq[::-1], axis=0)
+    removed = np.zeros_like(sq)
+    removed[1:] = head[:-1] + tail[:-1]
+    s1 = (total - removed) / lags
+    return s1 - 2 * s2
+
+
+MSDResult = namedtuple("MSDResult", ["time", "msd"])
+
+
+def gsd_msd(
+    gsdfile,
+    start=0,
+    stop=None,
+    stride=1,
+    molecules=False,
+    chunk_size=256,
+    tmp_dir=None,
+):
+    """
+    Calculates the mean squared displacement of each particle type (or of
+    molecule centers) over a trajectory.
+
+    The trajectory is read once and the continuous coordinates are written to
+    a temporary memory-mapped file; the msd is then found with msd_fft() for
+    chunk_size particles at a time, so memory is bounded by
+    n_frames * chunk_size. Coordinates are unwrapped with the image flags of
+    each frame, or between consecutive frames through the minimum image if the
+    frame has none (e.g., for a FrameCache, or when images were only written
+    in the first frame).
+
+    Parameters
+    ----------
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+    start, stop, stride : int, frames to use, following python slicing
+        (default 0, None, 1). Frames should be equally spaced in time.
+    molecules : bool, use the center of mass of each molecule instead of
+        the particles (default False)
+    chunk_size : int, number of particles per FFT batch (default 256)
+    tmp_dir : str, directory for the temporary file (default None)
+
+    Returns
+    -------
+    MSDResult, namedtuple of
+        time : np.ndarray (n_frames,), lag in timesteps
+        msd : dict of np.ndarray (n_frames,), averaged over the particles of
+            each type and over "all" particles (or "molecules")
+    """
+    with _open_frames(gsdfile) as reader:
+        first = reader[0]
+        if molecules:
+            chains = Chains(molecule_ids(len(first.position), reader.bonds))
+            mass = np.asarray(reader.mass, dtype=float)[chains.order, None]
+            chain_mass = np.add.reduceat(mass, chains.starts)
+            groups = {"molecules": np.arange(chains.n_chains)}
+            n_particles = chains.n_chains
+        else:
+            names = np.array(first.types)[first.typeid]
+            groups = {name: np.flatnonzero(names == name) for name in first.types}
+            groups["all"] = np.arange(len(names))
+            n_particles = len(names)
+
+        frames = range(len(reader))[start:stop:stride]
+        steps = np.empty(len(frames))
+        fd, path = tempfile.mkstemp(dir=tmp_dir, suffix=".npy")
+        os.close(fd)
+        try:
+            xyz = np.lib.format.open_memmap(
+                path,
+                mode="w+",
+                dtype=_float_dtype(),
+                shape=(len(frames), n_particles, 3),
+            )
+            last = last_pos = None
+            for t, frame in enumerate(_iter_frames(reader, frames)):
+                steps[t] = frame.step
+                matrix = box_matrix(frame.box)
+                pos = np.asarray(frame.position, dtype=_float_dtype())
+                if frame.image is not None and np.any(frame.image):
+                    x = pos + np.asarray(frame.image) @ matrix.T
+                elif last is None:
+                    x = pos
+                else:
+                    x = last + _minimum_image(pos - last_pos, matrix)
+                last, last_pos = x, pos
+                if molecules:
+                    xs = x[chains.order] * mass
+                    x = np.add.reduceat(xs, chains.starts) / chain_mass
+                xyz[t] = x
+            xyz.flush()
+
+            sums = {name: np.zeros(len(frames)) for name in groups}
+            for i in range(0, n_particles, chunk_size):
+                msd = msd_fft(xyz[:, i : i + chunk_size])
+                for name, inds in groups.items():
+                    inds = inds[(inds >= i) & (inds < i + chunk_size)]
+                    sums[name] += msd[:, inds - i].sum(axis=1)
+            del xyz
+        finally:
+            os.remove(path)
+
+    result = {
+        name: sums[name] / max(len(inds), 1) for name, inds in groups.items()
+    }
+    return MSDResult(steps - steps[0], result)
+
+
+def diffusion_coefficient(time, msd, fit_range=(0.1, 0.5), dim=3):
+    """
+    Diffusion coefficient from a linear fit of the msd, msd = 2 dim D t
+
+    Parameters
+    ----------
+    time : np.ndarray (T,), lag times
+    msd : np.ndarray (T,)
+    fit_range : tuple of floats, fraction of the lags to fit (default (0.1, 0.5))
+        Short lags are ballistic and long lags have few time origins.
+    dim : int, dimensionality (default 3)
+
+    Returns
+    -------
+    float
+    """
+    n = len(time)
+    fit = slice(int(fit_range[0] * n), max(int(fit_range[1] * n), 2))
+    slope = np.polyfit(time[fit], msd[fit], 1)[0]
+    return slope / (2 * dim)
+
+
+RDFResult = namedtuple("RDFResult", ["bin_centers", "rdf", "counts"])
+
+
+def _bound_params(func, *args, **kwargs):
+    """
+    All arguments but the first (the trajectory) of a call to func, with
+    defaults filled in, so equivalent calls give the same cache key
+    """
+    bound = inspect.signature(func).bind(None, *args, **kwargs)
+    bound.apply_defaults()
+    params = bound.arguments
+    params.pop(next(iter(params)))
+    return dict(params)
+
+
+class ResultCache:
+    """
+    On-disk cache of analysis results. Each result is stored as an npz file
+    keyed by the input trajectory and all parameters of the analysis, so
+    repeated calls return immediately. When the cache grows larger than
+    max_bytes the least recently used results are removed.
+
+    Example
+    -------
+    >>> results = ResultCache()
+    >>> rdf = results.rdf("traj.gsd", "_S", "_S", start=1)
+    >>> plt.plot(rdf.bin_centers, rdf.rdf)
+    """
+
+    def __init__(self, directory=".result_cache", max_bytes=2 ** 28):
+        """
+        Parameters
+        ----------
+        directory : str, directory which holds the results
+            (default ".result_cache")
+        max_bytes : int, size limit of the cache in bytes (default 256 MiB)
+        """
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def rdf(self, gsdfile, A_name, B_name, **kwargs):
+        """
+        Cached gsd_rdf(). Parameters are the same.
+
+        Returns
+        -------
+        RDFResult, namedtuple of bin_centers, rdf and counts (the raw pair
+        counts in each bin)
+        """
+        params = _bound_params(gsd_rdf, A_name, B_name, **kwargs)
+
+        def compute():
+            rdf = gsd_rdf(gsdfile, **params)
+            return {
+                "bin_centers": np.asarray(rdf.bin_centers),
+                "rdf": np.asarray(rdf.rdf),
+                "counts": np.asarray(rdf.bin_counts),
+            }
+
+        return RDFResult(**self._get("gsd_rdf", gsdfile, params, compute))
+
+    def bond_distribution(self, gsdfile, A_name, B_name, **kwargs):
+        """
+        Cached gsd_bond_distribution(). Parameters are the same.
+
+        Returns
+        -------
+        np.ndarray (nbins,2)
+        """
+        params = _bound_params(gsd_bond_distribution, A_name, B_name, **kwargs)
+
+        def compute():
+            return {"hist": gsd_bond_distribution(gsdfile, **params)}
+
+        return self._get("gsd_bond_distribution", gsdfile, params, compute)["hist"]
+
+    def angle_distribution(self, gsdfile, A_name, B_name, C_name, **kwargs):
+        """
+        Cached gsd_angle_distribution(). Parameters are the same.
+
+        Returns
+        -------
+        np.ndarray (nbins,2)
+        """
+        params = _bound_params(
+            gsd_angle_distribution, A_name, B_name, C_name, **kwargs
+        )
+
+        def compute():
+            return {"hist": gsd_angle_distribution(gsdfile, **params)}
+
+        return self._get("gsd_angle_distribution", gsdfile, params, compute)["hist"]
+
+    def key(self, name, source, params):
+        """
+        Returns the cache key of analysis name run on source with params
+
+        Parameters
+        ----------
+        name : str, name of the analysis
+        source : str, filename of the gsd trajectory, or a FrameCache
+        params : dict, all other arguments of the analysis
+
+        Returns
+        -------
+        str
+        """
+        if isinstance(source, FrameCache):
+            fingerprint = source.key
+        else:
+            fingerprint = _file_fingerprint(source)
+        params = json.dumps(params, sort_keys=True, default=repr)
+        sha = hashlib.sha1(f"{name} {fingerprint} {params}".encode())
+        return f"{name}-{sha.hexdigest()[:16]}"
+
+    def _get(self, name, source, params, compute):
+        path = os.path.join(self.directory, self.key(name, source, params) + ".npz")
+        if os.path.exists(path):
+            # mark as recently used
+            os.utime(path)
+            with np.load(path) as f:
+                return {k: f[k] for k in f.files}
+
+        result = compute()
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            np.savez(f, **result)
+        os.replace(tmp, path)
+        self.evict()
+        return result
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache is smaller
+        than max_bytes
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz") and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        """
+        Removes all results from the cache
+        """
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                os.remove(entry.path)
+
+
+def forcefield_bonded_coeffs(forcefield):
+    """
+    Reads the harmonic bond and angle parameters of a foyer forcefield xml,
+    named by type as in gsd files written by mbuild (e.g., "_B-_S", "_B-_B-_S")
+
+    Parameters
+    ----------
+    forcefield : str, filename of the forcefield xml
+
+    Returns
+    -------
+    (dict, dict), bond coefficients {name: {"k": k, "r0": r0}} and angle
+    coefficients {name: {"k": k, "t0": t0}}
+    """
+    root = ET.parse(forcefield).getroot()
+    bonds = {}
+    for bond in root.iter("Bond"):
+        ends = sorted((bond.get("class1"), bond.get("class2")))
+        coeffs = dict(k=float(bond.get("k")), r0=float(bond.get("length")))
+        bonds["-".join(ends)] = coeffs
+    angles = {}
+    for angle in root.iter("Angle"):
+        a, c = sorted((angle.get("class1"), angle.get("class3")))
+        coeffs = dict(k=float(angle.get("k")), t0=float(angle.get("angle")))
+        angles["-".join((a, angle.get("class2"), c))] = coeffs
+    return bonds, angles
+
+
+def forcefield_elements(forcefield):
+    """
+    Reads the element of each atom type of a foyer forcefield xml, e.g.
+    {"C1": "C", "S1": "S", "H1": "H", ...} for forcefields/p3ht-aa.xml
+
+    Parameters
+    ----------
+    forcefield : str, filename of the forcefield xml
+
+    Returns
+    -------
+    dict of str, element symbol of each type name
+    """
+    root = ET.parse(forcefield).getroot()
+    return {
+        atom_type.get("name"): atom_type.get("element")
+        for atom_type in root.iter("Type")
+        if atom_type.get("element")
+    }
+
+
+def _table_potential(r, rmin, rmax, r_grid, V, F):
+    """
+    Pair potential function for hoomd.md.pair.table
+    """
+    return np.interp(r, r_grid, V), np.interp(r, r_grid, F)
+
+
+def _ibi_run(args):
+    """
+    Runs one short CPU hoomd simulation of a state point with tabulated pair
+    potentials and returns the rdf of each pair on the IBI grid. Runs in a
+    worker process.
+    """
+    from mbuild.utils.io import import_
+
+    state, potentials, r, settings = args
+    hoomd = import_("hoomd")
+    import hoomd.md
+
+    hoomd.context.initialize("--mode=cpu --notice-level=0")
+    with hoomd.context.SimulationContext():
+        system = hoomd.init.read_gsd(state.gsdfile, frame=-1)
+        nl = hoomd.md.nlist.cell()
+        nl.reset_exclusions(exclusions=list(settings["exclusions"]))
+        table = hoomd.md.pair.table(width=len(r), nlist=nl)
+        for pair in (
+            (a, b) for a in system.particles.types for b in system.particles.types
+        ):
+            V = potentials.get(tuple(sorted(pair)), np.zeros_like(r))
+            F = -np.gradient(V, r)
+            table.pair_coeff.set(
+                *pair,
+                func=_table_potential,
+                rmin=r[0],
+                rmax=r[-1],
+                coeff=dict(r_grid=r, V=V, F=F),
+            )
+        if settings["bond_coeffs"]:
+            harmonic = hoomd.md.bond.harmonic()
+            for name, coeffs in settings["bond_coeffs"].items():
+                harmonic.bond_coeff.set(name, **coeffs)
+        if settings["angle_coeffs"]:
+            harmonic = hoomd.md.angle.harmonic()
+            for name, coeffs in settings["angle_coeffs"].items():
+                harmonic.angle_coeff.set(name, **coeffs)
+
+        _all = hoomd.group.all()
+        hoomd.md.integrate.mode_standard(dt=settings["dt"])
+        hoomd.md.integrate.nvt(group=_all, kT=state.kT, tau=settings["tau"])
+        hoomd.run(settings["n_equil"])
+        traj = os.path.join(settings["workdir"], "traj.gsd")
+        hoomd.dump.gsd(
+            traj,
+            period=settings["period"],
+            group=_all,
+            phase=0,
+            overwrite=True,
+        )
+        hoomd.run(settings["n_steps"])
+
+    rdfs = {}
+    for pair in state.targets:
+        rdf = gsd_partial_rdf(
+            traj,
+            *pair,
+            rmax=r[-1],
+            bins=settings["rdf_bins"],
+            exclusions=settings["exclusions"],
+        )
+        rdfs[pair] = np.interp(r, rdf.bin_centers, rdf.rdf)
+    return rdfs
+
+
+def ibi_targets(gsdfile, pairs, r_cut, exclusions=("bond", "angle"), **kwargs):
+    """
+    Target rdfs for IBI from a reference (e.g. mapped atomistic) trajectory,
+    calculated as the IBI simulations calculate theirs: partial rdfs with
+    the same exclusions
+
+    Parameters
+    ----------
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+    pairs : list of tuples of str, e.g. from CG_Compound.find_pairs()
+    r_cut : float, cutoff of the pair potentials
+    exclusions : tuple of str, as passed to IBI (default ("bond", "angle"))
+    kwargs : passed to gsd_partial_rdf(), e.g. start, stride and bins
+
+    Returns
+    -------
+    dict {(A, B): np.ndarray (bins,2)} of r, g(r), the targets of a StatePoint
+    """
+    targets = {}
+    for pair in pairs:
+        rdf = gsd_partial_rdf(
+            gsdfile, *pair, rmax=r_cut, exclusions=exclusions, **kwargs
+        )
+        targets[tuple(pair)] = np.column_stack((rdf.bin_centers, rdf.rdf))
+    return targets
+
+
+StatePoint = namedtuple("StatePoint", ["gsdfile", "targets", "kT"])
+StatePoint.__doc__ = """
+A state point used in IBI: a gsd file holding the starting coarse-grained
+configuration (with bonds), the target partial rdf of each pair
+{(A, B): np.ndarray (n,2) of r, g(r)} (see ibi_targets()), and the
+temperature kT
+"""
+
+
+class IBI:
+    """
+    Iterative Boltzmann Inversion of tabulated coarse-grained pair potentials.
+
+    Each iteration runs a short CPU hoomd simulation of every state point
+    (in parallel, one process each), computes the rdf of each pair and
+    updates the potentials as
+
+        V_(i+1)(r) = V_i(r) + alpha * kT * ln(g_i(r) / g_target(r))
+
+    averaged over the state points which target that pair. g is the partial
+    rdf of the pair (gsd_partial_rdf()) without the pairs excluded from the
+    pair potential, so each V_AB is fitted to the correlations it controls.
+    Bonds and angles are held fixed with harmonic parameters, e.g. from
+    forcefield_bonded_coeffs(). Target rdfs should be calculated the same
+    way, with ibi_targets() and the same exclusions.
+
+    Example
+    -------
+    >>> bonds, angles = forcefield_bonded_coeffs("forcefields/p3ht-cg.xml")
+    >>> targets = ibi_targets("mapped.gsd", cg_box.find_pairs(), r_cut=1.2)
+    >>> ibi = IBI([StatePoint("start.gsd", targets, 1.0)], r_cut=1.2,
+    ...           bond_coeffs=bonds, angle_coeffs=angles)
+    >>> ibi.run(n_iterations=20)
+    >>> ibi.save_tables("ibi", forcefield="forcefields/p3ht-cg.xml")
+    """
+
+    def __init__(
+        self,
+        states,
+        r_cut,
+        r_min=0.0,
+        n_bins=200,
+        alpha=0.5,
+        bond_coeffs=None,
+        angle_coeffs=None,
+        exclusions=("bond", "angle"),
+        dt=0.001,
+        tau=1.0,
+        n_equil=1e4,
+        n_steps=1e5,
+        period=1e3,
+        workdir="ibi",
+        n_procs=None,
+    ):
+        """
+        Parameters
+        ----------
+        states : list of StatePoint
+        r_cut : float, cutoff of the pair potentials
+        r_min : float, start of the potential table (default 0.0)
+        n_bins : int, number of points in the potential table (default 200)
+        alpha : float, damping of the potential update (default 0.5)
+        bond_coeffs : dict, hoomd harmonic bond parameters by bond type
+            {name: {"k": k, "r0": r0}} (default None)
+        angle_coeffs : dict, hoomd harmonic angle parameters by angle type
+            {name: {"k": k, "t0": t0}} (default None)
+        exclusions : tuple of str, hoomd neighbor list exclusions, also left
+            out of the rdfs: "bond", "angle" or "1-3" (default ("bond", "angle"))
+        dt, tau : float, hoomd time step and nvt coupling (default 0.001, 1.0)
+        n_equil, n_steps : int, steps run before and while sampling the rdf
+            (default 1e4, 1e5)
+        period : int, steps between sampled frames (default 1e3)
+        workdir : str, directory for the simulation files (default "ibi")
+        n_procs : int, number of state points run at once (default None)
+            If None, the number of processors.
+        """
+        self.states = states
+        self.r = np.linspace(r_min, r_cut, n_bins + 1)[1:]
+        self.alpha = alpha
+        self.workdir = workdir
+        self.n_procs = n_procs
+        # raises for exclusions the rdfs cannot leave out
+        _excluded_pairs(0, [], exclusions)
+        self.settings = dict(
+            bond_coeffs=bond_coeffs or {},
+            angle_coeffs=angle_coeffs or {},
+            exclusions=exclusions,
+            dt=dt,
+            tau=tau,
+            n_equil=int(n_equil),
+            n_steps=int(n_steps),
+            period=int(period),
+            rdf_bins=n_bins,
+        )
+        self.targets = [
+            {
+                tuple(sorted(pair)): np.interp(self.r, *np.asarray(g).T, left=0)
+                for pair, g in state.targets.items()
+            }
+            for state in states
+        ]
+        self.potentials = self._initial_potentials()
+        self.rdfs = None
+        self.fitness = []
+
+    @property
+    def pairs(self):
+        """
+        list of tuples of pair names with a target rdf
+        """
+        return sorted({pair for targets in self.targets for pair in targets})
+
+    def _initial_potentials(self):
+        """
+        Boltzmann inversion of the target rdfs, averaged over state points
+        """
+        potentials = {}
+        for pair in self.pairs:
+            with np.errstate(divide="ignore"):
+                V = [
+                    -state.kT * np.log(targets[pair])
+                    for state, targets in zip(self.states, self.targets)
+                    if pair in targets
+                ]
+            potentials[pair] = self._finish_potential(np.mean(V, axis=0))
+        return potentials
+
+    def _finish_potential(self, V):
+        """
+        Replaces the undefined region at short range (g(r) = 0) with a
+        repulsive wall (capped at 100 kT) and shifts the potential to zero
+        at r_cut
+        """
+        V = np.array(V, dtype=float)
+        defined = np.isfinite(V)
+        if not defined.any():
+            return np.zeros_like(V)
+        first = np.argmax(defined)
+        V[first:][~defined[first:]] = 0
+        kT = max(state.kT for state in self.states)
+        r = self.r
+        wall = V[first] + kT * ((r[first] / r[:first]) ** 12 - 1)
+        V[:first] = np.minimum(wall, 100 * kT)
+        return V - V[-1]
+
+    def step(self):
+        """
+        Runs one IBI iteration and updates the potentials
+
+        Returns
+        -------
+        float, fitness of the rdfs before the update (see rdf_fitness())
+        """
+        os.makedirs(self.workdir, exist_ok=True)
+        jobs = []
+        for i, state in enumerate(self.states):
+            settings = dict(self.settings, workdir=os.path.join(self.workdir, str(i)))
+            os.makedirs(settings["workdir"], exist_ok=True)
+            jobs.append((state, self.potentials, self.r, settings))
+        with ProcessPoolExecutor(max_workers=self.n_procs) as pool:
+            self.rdfs = list(pool.map(_ibi_run, jobs))
+
+        fitness = max(
+            rdf_fitness(self.r, rdfs[pair], targets[pair])
+            for rdfs, targets in zip(self.rdfs, self.targets)
+            for pair in targets
+        )
+        self.fitness.append(fitness)
+
+        for pair in self.pairs:
+            dV = []
+            for state, targets, rdfs in zip(self.states, self.targets, self.rdfs):
+                if pair not in targets:
+                    continue
+                g, target = rdfs[pair], targets[pair]
+                valid = (g > 0) & (target > 0)
+                correction = np.zeros_like(g)
+                correction[valid] = state.kT * np.log(g[valid] / target[valid])
+                dV.append(correction)
+            V = self.potentials[pair] + self.alpha * np.mean(dV, axis=0)
+            self.potentials[pair] = V - V[-1]
+        return fitness
+
+    def run(self, n_iterations=10, tolerance=0.01):
+        """
+        Runs IBI iterations until the rdfs of all pairs and state points
+        match their targets within tolerance
+
+        Parameters
+        ----------
+        n_iterations : int, maximum number of iterations (default 10)
+        tolerance : float, convergence criterion on rdf_fitness() (default 0.01)
+
+        Returns
+        -------
+        bool, whether IBI converged
+        """
+        for _ in range(n_iterations):
+            if self.step() < tolerance:
+                return True
+        return False
+
+    def tables(self):
+        """
+        Returns the tabulated potentials and forces
+
+        Returns
+        -------
+        dict {(A, B): np.ndarray (n_bins,3)} of r, V(r), F(r)
+        """
+        return {
+            pair: np.column_stack((self.r, V, -np.gradient(V, self.r)))
+            for pair, V in self.potentials.items()
+        }
+
+    def save_tables(self, directory, forcefield=None):
+        """
+        Writes each table as "A-B.txt" with columns r, V, F (the format read
+        by hoomd.md.pair.table.set_from_file). If a foyer forcefield xml is
+        given it is copied alongside the tables.
+
+        Parameters
+        ----------
+        directory : str
+        forcefield : str, filename of a forcefield xml (default None)
+        """
+        os.makedirs(directory, exist_ok=True)
+        for pair, table in self.tables().items():
+            filename = os.path.join(directory, "-".join(pair) + ".txt")
+            np.savetxt(filename, table, header="r V F")
+        if forcefield is not None:
+            shutil.copy(forcefield, directory)
+
+
+def rdf_fitness(r, rdf, target):
+    """
+    Relative difference between an rdf and its target,
+    integral (g - g_target)^2 dr / integral g_target^2 dr
+
+    Parameters
+    ----------
+    r : np.ndarray (n,), bin centers
+    rdf, target : np.ndarray (n,)
+
+    Returns
+    -------
+    float, 0 when the rdfs are identical
+    """
+    dr = np.gradient(r)
+    return np.sum((rdf - target) ** 2 * dr) / np.sum(target ** 2 * dr)
+
+
+TEMPLATE_VERSION = 1
+
+
+class TypingTemplate:
+    """
+    Atom and bond typing taken from a correctly-typed (good) pybel molecule
+    stored as arrays so it can be saved, loaded in one read, and transferred
+    onto any number of poorly-typed (bad) molecules with the same particle and
+    bond order.
+
+    Attributes
+    ----------
+    type_names : np.ndarray (T,), unique OpenBabel atom type strings
+    type_codes : np.ndarray (N,), index into type_names for each atom
+    atom_aromatic : np.ndarray (N,) of bool
+    bond_atoms : np.ndarray (B,2), 0-indexed atom indices of each bond
+    bond_orders : np.ndarray (B,)
+    bond_aromatic : np.ndarray (B,) of bool
+    legacy : bool, read from the original text format, which holds every atom
+        but the last and every bond but the first
+    """
+
+    def __init__(
+        self,
+        type_names,
+        type_codes,
+        atom_aromatic,
+        bond_atoms,
+        bond_orders,
+        bond_aromatic,
+        legacy=False,
+    ):
+        self.type_names = np.asarray(type_names, dtype=str)
+        self.type_codes = np.asarray(type_codes, dtype=np.int32)
+        self.atom_aromatic = np.asarray(atom_aromatic, dtype=bool)
+        self.bond_atoms = np.asarray(bond_atoms, dtype=np.int32).reshape(-1, 2)
+        self.bond_orders = np.asarray(bond_orders, dtype=np.int8)
+        self.bond_aromatic = np.asarray(bond_aromatic, dtype=bool)
+        self.legacy = legacy
+        # python lists are cached so repeated application does no conversions
+        self._atom_types = self.type_names[self.type_codes].tolist()
+        self._atom_arom = self.atom_aromatic.tolist()
+        self._bond_orders = self.bond_orders.tolist()
+        self._bond_arom = self.bond_aromatic.tolist()
+
+    @property
+    def n_atoms(self):
+        return len(self.type_codes)
+
+    @property
+    def n_bonds(self):
+        return len(self.bond_orders)
+
+    @classmethod
+    def from_mol(cls, good_mol):
+        """
+        Create a template from a correctly-typed pybel molecule.
+
+        Parameters
+        ----------
+        good_mol : pybel.Molecule
+
+        Returns
+        -------
+        TypingTemplate
+        """
+        obmol = good_mol.OBMol
+        # OBMol atoms are 1-indexed, bonds are 0-indexed
+        atoms = [obmol.GetAtom(i) for i in range(1, obmol.NumAtoms() + 1)]
+        bonds = [obmol.GetBond(i) for i in range(obmol.NumBonds())]
+
+        type_names, type_codes = np.unique(
+            [atom.GetType() for atom in atoms], return_inverse=True
+        )
+        return cls(
+            type_names,
+            type_codes,
+            [atom.IsAromatic() for atom in atoms],
+            [(b.GetBeginAtomIdx() - 1, b.GetEndAtomIdx() - 1) for b in bonds],
+            [b.GetBondOrder() for b in bonds],
+            [b.IsAromatic() for b in bonds],
+        )
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a template written by TypingTemplate.save() (or save_mol_to_file).
+        Text files written by older versions of save_mol_to_file are also read.
+
+        Parameters
+        ----------
+        filename : str, name of file
+
+        Returns
+        -------
+        TypingTemplate
+        """
+        try:
+            data = np.load(filename, allow_pickle=False)
+        except (OSError, ValueError):
+            return cls._load_text(filename)
+        with data:
+            version = int(data["version"])
+            if version > TEMPLATE_VERSION:
+                raise ValueError(
+                    f"{filename} is template version {version}, but only versions "
+                    f"up to {TEMPLATE_VERSION} are supported."
+                )
+            return cls(
+                data["type_names"],
+                data["type_codes"],
+                data["atom_aromatic"],
+                data["bond_atoms"],
+                data["bond_orders"],
+                data["bond_aromatic"],
+            )
+
+    @classmethod
+    def _load_text(cls, filename):
+        """
+        Read the original text format: one "type aromatic" line per atom followed
+        by one "order aromatic" line per bond. Bond atom indices are not stored in
+        this format, so they are left empty. The old writer skipped the last atom
+        and the first bond, so the template is applied with the same offsets.
+        """
+        with open(filename, "r") as f:
+            lines = f.readlines()
+        atoms = []
+        bonds = []
+        for line in lines:
+            one, two = line.split()
+            if not one.isdigit():
+                atoms.append((one, two == "True"))
+            else:
+                bonds.append((int(one), two == "True"))
+        type_names, type_codes = np.unique(
+            [a[0] for a in atoms], return_inverse=True
+        )
+        return cls(
+            type_names,
+            type_codes,
+            [a[1] for a in atoms],
+            np.empty((0, 2)),
+            [b[0] for b in bonds],
+            [b[1] for b in bonds],
+            legacy=True,
+        )
+
+    def save(self, filename):
+        """
+        Save the template as a compressed numpy archive (.npz).
+
+        Parameters
+        ----------
+        filename : str, name of file
+        """
+        # np.savez appends .npz to names without it, write to the handle
+        # so the file name given is the one on disk
+        with open(filename, "wb") as f:
+            np.savez_compressed(
+                f,
+                version=np.int32(TEMPLATE_VERSION),
+                type_names=self.type_names,
+                type_codes=self.type_codes,
+                atom_aromatic=self.atom_aromatic,
+                bond_atoms=self.bond_atoms,
+                bond_orders=self.bond_orders,
+                bond_aromatic=self.bond_aromatic,
+            )
+
+    def apply(self, bad_mols):
+        """
+        Transfer the typing onto one or many pybel molecules, e.g. every frame
+        of a trajectory. The atom positions are retained.
+        Changes:
+        atom- type, isaromatic
+        bond- order, isaromatic
+
+        Parameters
+        ----------
+        bad_mols : pybel.Molecule or iterable of pybel.Molecule
+
+        Returns
+        -------
+        pybel.Molecule, or list of pybel.Molecule if an iterable was given
+        """
+        if hasattr(bad_mols, "OBMol"):
+            return self._apply(bad_mols)
+        return [self._apply(mol) for mol in bad_mols]
+
+    def _apply(self, bad_mol):
+        obmol = bad_mol.OBMol
+        # legacy templates hold atoms 1..N-1 and bonds 1..B-1
+        n_atoms = self.n_atoms + self.legacy
+        n_bonds = self.n_bonds + self.legacy
+        if obmol.NumAtoms() != n_atoms or obmol.NumBonds() != n_bonds:
+            raise ValueError(
+                f"Template is for {n_atoms} atoms and {n_bonds} bonds, but "
+                f"molecule has {obmol.NumAtoms()} atoms and {obmol.NumBonds()} bonds."
+            )
+        bonds = [obmol.GetBond(i) for i in range(self.legacy, n_bonds)]
+        if len(self.bond_atoms):
+            bond_atoms = np.array(
+                [(b.GetBeginAtomIdx() - 1, b.GetEndAtomIdx() - 1) for b in bonds],
+                dtype=np.int32,
+            ).reshape(-1, 2)
+            same = (bond_atoms == self.bond_atoms).all(axis=1)
+            flipped = (bond_atoms[:, ::-1] == self.bond_atoms).all(axis=1)
+            bad = np.flatnonzero(~(same | flipped))
+            if len(bad):
+                raise ValueError(
+                    f"Bond {bad[0]} joins atoms {tuple(bond_atoms[bad[0]])} in the "
+                    f"molecule, but atoms {tuple(self.bond_atoms[bad[0]])} in the "
+                    "template. The molecule must have the template's bond order."
+                )
+
+        for i, (atom_type, aromatic) in enumerate(
+            zip(self._atom_types, self._atom_arom), 1
+        ):
+            atom = obmol.GetAtom(i)
+            atom.SetType(atom_type)
+            if aromatic:
+                atom.SetAromatic()
+            else:
+                atom.UnsetAromatic()
+
+        for bond, order, aromatic in zip(bonds, self._bond_orders, self._bond_arom):
+            bond.SetBondOrder(order)
+            if aromatic:
+                bond.SetAromatic()
+            else:
+                bond.UnsetAromatic()
+
+        # keep openbabel from re-perceiving aromaticity from the bad geometry
+        obmol.SetAromaticPerceived()
+        return bad_mol
+
+
+def map_good_on_bad(good_mol, bad_mol):
+    """
+    This function takes a correctly-typed (good) and a poorly-typed (bad)
+    pybel molecule and transfers the bond and atom typing from the good to
+    the bad molecule but retains the atom positions.
+    It assumes that both molecules have the same number of particles and
+    they maintain their order.
+    Changes:
+    atom- type, isaromatic
+    bond- order, isaromatic
+
+    To map the same typing onto many molecules, create a TypingTemplate once
+    and use TypingTemplate.apply().
+
+    Parameters
+    ----------
+    good_mol : pybel.Molecule
+    bad_mol : pybel.Molecule or list of pybel.Molecule
+
+    Returns
+    -------
+    pybel.Molecule (or list of pybel.Molecule)
+    """
+    return TypingTemplate.from_mol(good_mol).apply(bad_mol)
+
+
+def save_mol_to_file(good_mol, filename):
+    """
+    This function takes a correctly-typed (good) pybel molecule and saves
+    the bond and atom typing to a file for later use.
+    The file is a versioned numpy archive (see TypingTemplate).
+
+    Parameters
+    ----------
+    good_mol : pybel.Molecule
+    filename : str, name of file
+
+    use map_file_on_bad() or TypingTemplate.load() to use this file
+    """
+    TypingTemplate.from_mol(good_mol).save(filename)
+
+
+def map_file_on_bad(filename, bad_mol):
+    """
+    This function takes a filename containing correctly-typed and a poorly-typed (bad)
+    pybel molecule and transfers the bond and atom typing from the good to
+    the bad molecule but retains the atom positions.
+    It assumes that both molecules have the same number of particles and
+    they maintain their order.
+    Changes:
+    atom- type, isaromatic
+    bond- order, isaromatic
+
+    Parameters
+    ----------
+    filename : str, generated using save_mol_to_file()
+    bad_mol : pybel.Molecule or list of pybel.Molecule
+
+    Returns
+    -------
+    pybel.Molecule (or list of pybel.Molecule)
+    """
+    return TypingTemplate.load(filename).apply(bad_mol)
+
+
+def pybel_to_arrays(pybel_mol):
+    """
+    Reads the atoms and bonds of a pybel molecule into numpy arrays.
+
+    Parameters
+    ----------
+    pybel_mol : pybel.Molecule
+
+    Returns
+    -------
+    dict with keys
+        "xyz" : np.ndarray (N,3), coordinates in nm
+        "atomic_numbers" : np.ndarray (N,)
+        "types" : list of str, OpenBabel atom types
+        "aromatic" : np.ndarray (N,) of bool
+        "residues" : np.ndarray (N,), residue index of each atom (-1 if none)
+        "bonds" : np.ndarray (B,2), 0-indexed atom indices of each bond
+        "bond_orders" : np.ndarray (B,)
+    """
+    obmol = pybel_mol.OBMol
+    # OBMol atoms are 1-indexed, bonds are 0-indexed
+    atoms = [obmol.GetAtom(i) for i in range(1, obmol.NumAtoms() + 1)]
+    bonds = [obmol.GetBond(i) for i in range(obmol.NumBonds())]
+
+    residues = []
+    for atom in atoms:
+        residue = atom.GetResidue()
+        residues.append(-1 if residue is None else residue.GetIdx())
+
+    # coordinates are in Angstrom
+    xyz = np.array([(a.GetX(), a.GetY(), a.GetZ()) for a in atoms], dtype=float)
+    bond_array = np.array(
+        [(b.GetBeginAtomIdx(), b.GetEndAtomIdx()) for b in bonds], dtype=int
+    )
+    return {
+        "xyz": xyz.reshape(-1, 3) / 10,
+        "atomic_numbers": np.array([a.GetAtomicNum() for a in atoms], dtype=int),
+        "types": [a.GetType() for a in atoms],
+        "aromatic": np.array([a.IsAromatic() for a in atoms], dtype=bool),
+        "residues": np.array(residues, dtype=int),
+        "bonds": bond_array.reshape(-1, 2) - 1,
+        "bond_orders": np.array([b.GetBondOrder() for b in bonds], dtype=int),
+    }
+
+
+def update_pybel_coords(pybel_mol, xyz):
+    """
+    Writes new coordinates into an existing pybel molecule in place, e.g. to
+    reuse one molecule (and its typing) for every frame of a trajectory
+    instead of converting each frame with to_pybel().
+
+    Parameters
+    ----------
+    pybel_mol : pybel.Molecule
+    xyz : np.ndarray (N,3), coordinates in nm in the same atom order
+
+    Returns
+    -------
+    pybel.Molecule
+    """
+    obmol = pybel_mol.OBMol
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3) * 10
+    if len(xyz) != obmol.NumAtoms():
+        raise ValueError(
+            f"Got {len(xyz)} coordinates for a molecule with {obmol.NumAtoms()} atoms."
+        )
+    for i, (x, y, z) in enumerate(xyz.tolist(), 1):
+        obmol.GetAtom(i).SetVector(x, y, z)
+    return pybel_mol
+
+
+def _pybel_names(arrays, use_element=True):
+    """
+    Particle names for the atoms read by pybel_to_arrays(): the element if
+    use_element is True and the element is known, otherwise the atom type.
+    """
+    if not use_element:
+        return list(arrays["types"])
+
+    from parmed.periodic_table import Element
+
+    elements = {}
+    for number in np.unique(arrays["atomic_numbers"]):
+        try:
+            elements[number] = Element[number]
+        except (KeyError, IndexError):
+            elements[number] = None
+    names = []
+    for i, (number, atom_type) in enumerate(
+        zip(arrays["atomic_numbers"], arrays["types"])
+    ):
+        if elements[number] is None:
+            warn(
+                "No element detected for atom at index "
+                "{} with number {}, type {}".format(i + 1, number, atom_type)
+            )
+            names.append(atom_type)
+        else:
+            names.append(elements[number])
+    return names
+
+
+def _pybel_box(pybel_mol):
+    """
+    Returns an mbuild.box.Box from the unitcell of a pybel molecule, or None
+    """
+    if not hasattr(pybel_mol, "unitcell"):
+        warn("No unitcell detected for pybel.Molecule {}".format(pybel_mol))
+        return None
+    return mb.box.Box(
+        lengths=[
+            pybel_mol.unitcell.GetA() / 10,
+            pybel_mol.unitcell.GetB() / 10,
+            pybel_mol.unitcell.GetC() / 10,
+        ],
+        angles=[
+            pybel_mol.unitcell.GetAlpha(),
+            pybel_mol.unitcell.GetBeta(),
+            pybel_mol.unitcell.GetGamma(),
+        ],
+    )
+
+
+def has_number(string):
+    """
+    Returns True if string contains a number.
+    Else returns False.
+    """
+    return bool(re.search("[0-9]", string))
+
+
+def has_common_member(set_a, tup):
+    """
+    return True if set_a (set) and tup (tuple) share a common member
+    else return False
+    """
+    set_b = set(tup)
+    return set_a & set_b
+
+
+def _bead_groups(bead_inds):
+    """
+    Accepts bead_inds as built in coarse(), (group, smarts, name) tuples,
+    a plain list of atom index groups, an AtomisticRecord, or a CG_Compound
+    made by coarse() and returns the index groups.
+    """
+    atomistic = getattr(bead_inds, "atomistic", None)
+    if isinstance(atomistic, AtomisticRecord):
+        bead_inds = atomistic
+    if isinstance(bead_inds, AtomisticRecord):
+        return bead_inds.bead_groups()
+    return [
+        b[0] if len(b) == 3 and not np.isscalar(b[0]) else b for b in bead_inds
+    ]
+
+
+def _flatten_groups(groups):
+    """
+    Flattens a list of index groups for use with np.add.reduceat.
+
+    Returns
+    -------
+    atoms : np.ndarray, concatenated indices of all groups
+    offsets : np.ndarray, index into atoms where each group starts
+    counts : np.ndarray, number of indices in each group
+    """
+    counts = np.array([len(group) for group in groups], dtype=int)
+    if np.any(counts == 0):
+        raise ValueError("Bead groups must not be empty.")
+    atoms = np.fromiter(
+        (i for group in groups for i in group), dtype=int, count=counts.sum()
+    )
+    offsets = np.cumsum(counts) - counts
+    return atoms, offsets, counts
+
+
+def bead_centers(xyz, bead_inds, box=None, method="image"):
+    """
+    Calculates the center of every bead in one or many frames. If a box is
+    given, the coordinates can be wrapped: beads which span the periodic
+    boundary are handled without unwrapping first.
+
+    Parameters
+    ----------
+    xyz : np.ndarray (N,3) or (F,N,3), particle coordinates
+    bead_inds : list of index groups, or bead_inds as built in coarse()
+    box : box accepted by box_matrix() (default None)
+        If None, the plain average of each bead is used.
+    method : str, "image" or "circular" (default "image")
+        "image" averages the minimum image vectors from the first atom of
+        each bead, "circular" takes the circular mean of the fractional
+        coordinates along each box vector.
+
+    Returns
+    -------
+    np.ndarray (n_beads,3) or (F,n_beads,3)
+    """
+    xyz = np.asarray(xyz)
+    dtype = xyz.dtype if xyz.dtype == np.float32 else np.float64
+    atoms, offsets, counts = _flatten_groups(_bead_groups(bead_inds))
+    pos = xyz[..., atoms, :]
+    counts = counts[:, None]
+
+    def bead_sum(values):
+        return np.add.reduceat(values, offsets, axis=-2, dtype=np.float64)
+
+    if box is None:
+        return (bead_sum(pos) / counts).astype(dtype)
+
+    matrix = box_matrix(box)
+    if method == "image":
+        ref = pos[..., offsets, :]
+        ref_inds = np.repeat(np.arange(len(offsets)), counts[:, 0])
+        diff = _minimum_image(pos - ref[..., ref_inds, :], matrix)
+        return (ref + bead_sum(diff) / counts).astype(dtype)
+    elif method == "circular":
+        frac = pos @ np.linalg.inv(matrix).swapaxes(-1, -2)
+        theta = 2 * np.pi * frac
+        cos = bead_sum(np.cos(theta)) / counts
+        sin = bead_sum(np.sin(theta)) / counts
+        center = np.arctan2(sin, cos) / (2 * np.pi)
+        return (center @ matrix.swapaxes(-1, -2)).astype(dtype)
+    raise ValueError(f"Unknown method {method}. Use 'image' or 'circular'.")
+
+
+def gsd_bead_centers(
+    gsdfile,
+    bead_inds,
+    start=0,
+    stop=None,
+    stride=1,
+    scale=1.0,
+    method="image",
+    chunk_size=100,
+):
+    """
+    Maps the (wrapped) frames of an atomistic gsd trajectory onto bead centers
+    without unwrapping. The particle order must match the one used to find
+    bead_inds, e.g. from CG_Compound.from_gsd() and coarse().
+
+    Parameters
+    ----------
+    gsdfile : str, filename of the gsd trajectory, or an unmapped FrameCache
+    bead_inds : list of index groups, or the CG_Compound made by coarse()
+    start, stop, stride : int, frames to use, following python slicing
+        (default 0, None, 1)
+    scale : float, scaling factor multiplied to coordinates (default 1.0)
+    method : str, see bead_centers() (default "image")
+    chunk_size : int, number of frames mapped at once (default 100)
+
+    Returns
+    -------
+    np.ndarray (F,n_beads,3)
+    """
+    groups = _bead_groups(bead_inds)
+
+    centers = []
+    with _open_frames(gsdfile) as reader:
+        frames = range(len(reader))[start:stop:stride]
+        for i in range(0, len(frames), chunk_size):
+            chunk = list(_iter_frames(reader, frames[i : i + chunk_size]))
+            xyz = np.stack([frame.position for frame in chunk]) * scale
+            boxes = np.stack([frame.box for frame in chunk])
+            boxes[:, :3] *= scale
+            centers.append(bead_centers(xyz, groups, box=boxes, method=method))
+    return np.concatenate(centers)
+
+
+def ring_normals(xyz, bead_inds, box=None):
+    """
+    Calculates the unit normal of the best-fit plane of each bead's atoms,
+    e.g. of thiophene rings.
+
+    Parameters
+    ----------
+    xyz : np.ndarray (N,3), particle coordinates
+    bead_inds : list of index groups, or bead_inds as built in coarse()
+    box : box accepted by box_matrix() (default None)
+        If given, beads which span the periodic boundary are handled.
+
+    Returns
+    -------
+    np.ndarray (n_beads,3)
+    """
+    atoms, offsets, counts = _flatten_groups(_bead_groups(bead_inds))
+    pos = np.asarray(xyz, dtype=_float_dtype())[atoms]
+    owner = np.repeat(np.arange(len(offsets)), counts)
+    diff = pos - pos[offsets][owner]
+    if box is not None:
+        diff = minimum_image(diff, box)
+    diff -= (np.add.reduceat(diff, offsets) / counts[:, None])[owner]
+    outer = diff[:, :, None] * diff[:, None, :]
+    cov = np.add.reduceat(outer, offsets, dtype=np.float64)
+    # eigenvector of the smallest eigenvalue
+    return np.linalg.eigh(cov)[1][:, :, 0]
+
+
+StackingResult = namedtuple(
+    "StackingResult", ["cluster_sizes", "distribution", "stacked_fraction"]
+)
+
+
+def gsd_stacking(
+    gsdfile,
+    r_max,
+    name="_B",
+    mapping=None,
+    max_angle=30,
+    intramolecular=False,
+    start=0,
+    stop=None,
+    stride=1,
+):
+    """
+    Finds clusters of pi-stacked rings (e.g. the thiophene beads "_B" of
+    P3HT) in each frame of a trajectory.
+
+    Two rings are stacked if their centers are within r_max and, when ring
+    normals are known, their normals are within max_angle of each other.
+    Stacked pairs are clustered with freud.cluster.Cluster.
+
+    Parameters
+    ----------
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+        Either a coarse-grained trajectory, or an atomistic one with mapping.
+    r_max : float, largest center-center distance of a stacked pair
+    name : str, name of the ring beads (default "_B")
+    mapping : CG_Compound made by coarse() or bead_inds (default None)
+        If given, gsdfile is atomistic; ring centers and normals are found
+        from the atoms of each bead named name. Otherwise only the distance
+        criterion is used.
+    max_angle : float, largest angle between stacked ring normals in degrees
+        (default 30)
+    intramolecular : bool, whether rings of the same molecule can stack
+        (default False)
+    start, stop, stride : int, frames to use, following python slicing
+        (default 0, None, 1)
+
+    Returns
+    -------
+    StackingResult, namedtuple of
+        cluster_sizes : list of np.ndarray, size of every cluster of two or
+            more rings in each frame
+        distribution : np.ndarray (max_size+1,), mean number of clusters of
+            each size per frame
+        stacked_fraction : np.ndarray (n_frames,), fraction of rings in a
+            cluster in each frame
+    """
+    min_dot = np.cos(np.radians(max_angle))
+    cluster = freud.cluster.Cluster()
+
+    with _open_frames(gsdfile) as reader:
+        first = reader[0]
+        mol = molecule_ids(len(first.position), reader.bonds)
+        if mapping is None:
+            rings = np.flatnonzero(np.array(first.types)[first.typeid] == name)
+            ring_mol = mol[rings]
+        else:
+            groups, names, _ = _mapping_arrays(mapping)
+            groups = [g for g, n in zip(groups, names) if n == name]
+            ring_mol = mol[[g[0] for g in groups]]
+        if len(ring_mol) == 0:
+            raise ValueError(f"No {name} beads found.")
+
+        sizes, fraction = [], []
+        frames = range(len(reader))[start:stop:stride]
+        for frame in _iter_frames(reader, frames):
+            box = freud.box.Box(*frame.box)
+            if mapping is None:
+                pos = frame.position[rings]
+                normals = None
+            else:
+                pos = bead_centers(frame.position, groups, box=frame.box)
+                normals = ring_normals(frame.position, groups, box=frame.box)
+            pos = box.wrap(np.asarray(pos, dtype=np.float32))
+
+            query = freud.locality.AABBQuery(box, pos)
+            nlist = query.query(
+                pos, dict(r_max=r_max, exclude_ii=True)
+            ).toNeighborList()
+            i, j = nlist.query_point_indices, nlist.point_indices
+            keep = np.ones(len(i), dtype=bool)
+            if not intramolecular:
+                keep &= ring_mol[i] != ring_mol[j]
+            if normals is not None:
+                dots = np.einsum("ij,ij->i", normals[i], normals[j])
+                keep &= np.abs(dots) >= min_dot
+            nlist.filter(keep)
+
+            cluster.compute((box, pos), neighbors=nlist)
+            counts = np.bincount(cluster.cluster_idx)
+            counts = counts[counts > 1]
+            sizes.append(counts)
+            fraction.append(counts.sum() / len(pos))
+
+    max_size = max((s.max() for s in sizes if len(s)), default=1)
+    distribution = np.zeros(max_size + 1)
+    for s in sizes:
+        distribution += np.bincount(s, minlength=max_size + 1)
+    distribution /= max(len(sizes), 1)
+    return StackingResult(sizes, distribution, np.array(fraction))
+
+
+def order_tensor(vectors, groups=None, n_groups=None):
+    """
+    Calculates the nematic order tensor Q = <3/2 u u - 1/2 I> of a set of
+    vectors, for all of them or for each group
+
+    Parameters
+    ----------
+    vectors : np.ndarray (M,3), e.g. bond vectors or ring normals
+        (need not be normalized)
+    groups : np.ndarray (M,) of int, group of each vector (default None)
+        If None, one tensor of all vectors is returned.
+    n_groups : int, number of groups (default groups.max() + 1)
+
+    Returns
+    -------
+    np.ndarray (3,3) or (n_groups,3,3), nan for empty groups
+    """
+    u = vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+    uu = 1.5 * u[:, :, None] * u[:, None, :] - 0.5 * np.eye(3)
+    if groups is None:
+        return uu.mean(axis=0)
+    if n_groups is None:
+        n_groups = groups.max() + 1
+    Q = np.zeros((n_groups, 3, 3))
+    np.add.at(Q, groups, uu)
+    with np.errstate(invalid="ignore"):
+        return Q / np.bincount(groups, minlength=n_groups)[:, None, None]
+
+
+def nematic_order(Q):
+    """
+    Returns the order parameter S2 (largest eigenvalue) and director
+    (its eigenvector) of one or many order tensors
+
+    Parameters
+    ----------
+    Q : np.ndarray (...,3,3), from order_tensor()
+
+    Returns
+    -------
+    (np.ndarray (...), np.ndarray (...,3)), nan where Q is nan
+    """
+    Q = np.asarray(Q)
+    valid = np.all(np.isfinite(Q), axis=(-2, -1))
+    S2 = np.full(Q.shape[:-2], np.nan)
+    director = np.full(Q.shape[:-1], np.nan)
+    values, vecs = np.linalg.eigh(Q[valid])
+    S2[valid] = values[:, -1]
+    director[valid] = vecs[:, :, -1]
+    return S2, director
+
+
+def local_order_tensor(centers, vectors, box, n_bins=(4, 4, 4)):
+    """
+    Order tensors of the vectors in each cell of a grid over the box
+
+    Parameters
+    ----------
+    centers : np.ndarray (M,3), position of each vector (e.g. bond midpoint)
+    vectors : np.ndarray (M,3)
+    box : box accepted by box_matrix()
+    n_bins : tuple of int, number of cells along each box vector
+        (default (4, 4, 4))
+
+    Returns
+    -------
+    np.ndarray (*n_bins,3,3), nan for empty cells
+    """
+    n_bins = tuple(n_bins)
+    frac = centers @ np.linalg.inv(box_matrix(box)).T
+    cell = np.floor(frac * n_bins).astype(int) % n_bins
+    flat = np.ravel_multi_index(cell.T, n_bins)
+    Q = order_tensor(vectors, flat, int(np.prod(n_bins)))
+    return Q.reshape(n_bins + (3, 3))
+
+
+NematicResult = namedtuple(
+    "NematicResult", ["S2", "director", "Q", "molecule_S2", "local_S2"]
+)
+
+
+def gsd_nematic_order(
+    gsdfile,
+    name="_B",
+    mapping=None,
+    per_molecule=False,
+    n_bins=None,
+    start=0,
+    stop=None,
+    stride=1,
+):
+    """
+    Calculates the nematic order of backbone segments in each frame of a
+    trajectory: the name-name bond vectors of a coarse-grained trajectory, or
+    the ring normals of the beads named name of an atomistic trajectory.
+
+    Parameters
+    ----------
+    gsdfile : str, filename of the gsd trajectory, or a FrameCache
+    name : str, name of the backbone beads (default "_B")
+    mapping : CG_Compound made by coarse() or bead_inds (default None)
+        If given, gsdfile is atomistic and the ring normals of the beads
+        (see ring_normals()) are used instead of bond vectors.
+    per_molecule : bool, also find S2 of each molecule (default False)
+    n_bins : tuple of int, cells along each box vector of the local order
+        map (default None). If None, no map is made.
+    start, stop, stride : int, frames to use, following python slicing
+        (default 0, None, 1). An empty range gives arrays with n_frames 0.
+
+    Returns
+    -------
+    NematicResult, namedtuple of
+        S2 : np.ndarray (n_frames,)
+        director : np.ndarray (n_frames,3)
+        Q : np.ndarray (n_frames,3,3)
+        molecule_S2 : np.ndarray (n_frames,n_molecules) or None
+        local_S2 : np.ndarray (n_frames,*n_bins) or None
+    """
+    with _open_frames(gsdfile) as reader:
+        first = reader[0]
+        mol = molecule_ids(len(first.position), reader.bonds)
+        if mapping is None:
+            names = np.array(first.types)[first.typeid]
+            bonds = reader.bonds
+            bonds = bonds[_match_names(names[bonds], (name, name))]
+            if len(bonds) == 0:
+                raise ValueError(f"No {name}-{name} bonds found.")
+            vec_mol = mol[bonds[:, 0]]
+        else:
+            groups, names, _ = _mapping_arrays(mapping)
+            groups = [g for g, n in zip(groups, names) if n == name]
+            if len(groups) == 0:
+                raise ValueError(f"No {name} beads found.")
+            vec_mol = mol[[g[0] for g in groups]]
+        vec_mol = np.unique(vec_mol, return_inverse=True)[1]
+        n_molecules = vec_mol.max() + 1
+
+        Q, molecule_Q, local_Q = [], [], []
+        frames = range(len(reader))[start:stop:stride]
+        for frame in _iter_frames(reader, frames):
+            pos = np.asarray(frame.position, dtype=_float_dtype())
+            if mapping is None:
+                vectors = minimum_image(pos[bonds[:, 1]] - pos[bonds[:, 0]], frame.box)
+                centers = pos[bonds[:, 0]] + vectors / 2
+            else:
+                vectors = ring_normals(pos, groups, box=frame.box)
+                centers = bead_centers(pos, groups, box=frame.box)
+            Q.append(order_tensor(vectors))
+            if per_molecule:
+                molecule_Q.append(order_tensor(vectors, vec_mol))
+            if n_bins is not None:
+                local_Q.append(local_order_tensor(centers, vectors, frame.box, n_bins))
+
+    # reshape so an empty frame range gives empty arrays of the right shape
+    Q = np.reshape(Q, (-1, 3, 3))
+    S2, director = nematic_order(Q)
+    molecule_S2 = local_S2 = None
+    if per_molecule:
+        molecule_Q = np.reshape(molecule_Q, (-1, n_molecules, 3, 3))
+        molecule_S2 = nematic_order(molecule_Q)[0]
+    if n_bins is not None:
+        local_Q = np.reshape(local_Q, (-1,) + tuple(n_bins) + (3, 3))
+        local_S2 = nematic_order(local_Q)[0]
+    return NematicResult(S2, director, Q, molecule_S2, local_S2)
+
+
+def perceive_bonds(xyz, elements, box=None, tolerance=0.045, min_distance=0.04):
+    """
+    Finds bonds from interatomic distances: two atoms are bonded if they are
+    closer than the sum of their covalent radii plus a tolerance. Neighbors are
+    found with a freud AABBQuery, so this scales linearly with the number of
+    atoms.
+
+    Parameters
+    ----------
+    xyz : np.ndarray (N,3), coordinates in nm
+    elements : list of str (N,), element symbols. Particles without an entry in
+        covalent_radii are not bonded; a warning lists them unless they are
+        coarse-grained beads (names starting with "_"), and a ValueError is
+        raised if fewer than two atoms are left.
+    box : box accepted by box_matrix() (default None)
+        If given, bonds across the periodic boundary are found.
+    tolerance : float, added to the sum of covalent radii in nm (default 0.045)
+    min_distance : float, pairs closer than this are not bonded (default 0.04)
+
+    Returns
+    -------
+    np.ndarray (B,2), sorted particle indices of each bond
+    """
+    xyz = np.asarray(xyz, dtype=float).reshape(-1, 3)
+    names, inverse = np.unique(np.asarray(elements, dtype=str), return_inverse=True)
+    radii = np.array([covalent_radii.get(name, np.nan) for name in names])[inverse]
+    atoms = np.flatnonzero(~np.isnan(radii))
+    unknown = [n for n in names if n not in covalent_radii and not n.startswith("_")]
+    if unknown:
+        message = (
+            f"No covalent radius for particle names {unknown}. Map them to "
+            "elements, e.g. with type_elements=forcefield_elements(forcefield)."
+        )
+        if len(atoms) < 2:
+            raise ValueError(message)
+        warn(message + " These particles are not bonded.")
+    if len(atoms) < 2:
+        return np.empty((0, 2), dtype=int)
+    radii = radii[atoms]
+    points = xyz[atoms]
+    r_max = 2 * radii.max() + tolerance
+
+    if box is None:
+        # a cube large enough that no periodic image is within r_max
+        lo = points.min(axis=0)
+        hi = points.max(axis=0)
+        freud_box = freud.box.Box.cube((hi - lo).max() + 3 * r_max)
+        points = points - (hi + lo) / 2
+    else:
+        freud_box = _freud_box(box)
+        points = freud_box.wrap(points)
+
+    aq = freud.locality.AABBQuery(freud_box, points)
+    nlist = aq.query(points, dict(r_max=r_max, exclude_ii=True)).toNeighborList()
+    i = nlist.query_point_indices
+    j = nlist.point_indices
+    d = nlist.distances
+    bonded = (i < j) & (d > min_distance) & (d < radii[i] + radii[j] + tolerance)
+
+    bonds = np.column_stack((atoms[i[bonded]], atoms[j[bonded]]))
+    return bonds[np.lexsort((bonds[:, 1], bonds[:, 0]))]
+
+
+def cg_comp(comp, bead_inds):
+    """
+    given an mbuild compound (or AtomisticRecord) and bead_inds(list of tup)
+    return coarse-grained mbuild compound
+
+    if comp.box is set, the bead centers are found using the minimum image
+    convention so comp does not need to be unwrapped.
+    """
+    from cg_compound import CG_Compound
+
+    cg_compound = CG_Compound()
+    cg_compound.box = comp.box
+
+    centers = bead_centers(comp.xyz, bead_inds, box=comp.box)
+    beads = []
+    for (_, smarts, bead_name), avg_xyz in zip(bead_inds, centers):
+        bead = mb.Particle(name=bead_name, pos=avg_xyz)
+        bead.smarts_string = smarts
+        beads.append(bead)
+    cg_compound.add(beads)
+    return cg_compound
+
+
+def cg_bonds(comp, cg_compound, beads):
+    """
+    add bonds based on bonding in aa compound (or AtomisticRecord)
+    return bonded mbuild compound
+
+    two beads are bonded if any atom in one is bonded to any atom in the other.
+    """
+    bead_bonds = _bead_bonds(comp.bond_array(), beads)
+    particles = cg_compound._particle_list()
+    for i, j in bead_bonds.tolist():
+        cg_compound.add_bond((particles[i], particles[j]))
+    return cg_compound
+
+
+def _bead_bonds(bonds, beads):
+    """
+    Returns the bead index pairs (M,2) of beads bonded through any atom bond
+    """
+    if len(bonds) == 0 or len(beads) == 0:
+        return np.empty((0, 2), dtype=int)
+
+    # table of the beads each atom belongs to, -1 where unused
+    # (ring beads can share atoms so an atom can be in more than one bead)
+    atoms, _, counts = _flatten_groups(_bead_groups(beads))
+    bead_ids = np.repeat(np.arange(len(counts)), counts)
+    order = np.argsort(atoms, kind="stable")
+    atoms = atoms[order]
+    bead_ids = bead_ids[order]
+    slot = np.arange(len(atoms)) - np.searchsorted(atoms, atoms)
+    n_atoms = max(atoms.max(), bonds.max()) + 1
+    membership = np.full((n_atoms, slot.max() + 1), -1)
+    membership[atoms, slot] = bead_ids
+
+    bead_bonds = []
+    for slot_i in range(membership.shape[1]):
+        for slot_j in range(membership.shape[1]):
+            bead_i = membership[bonds[:, 0], slot_i]
+            bead_j = membership[bonds[:, 1], slot_j]
+            bonded = (bead_i >= 0) & (bead_j >= 0) & (bead_i != bead_j)
+            bead_bonds.append(np.column_stack((bead_i[bonded], bead_j[bonded])))
+    return np.unique(np.sort(np.concatenate(bead_bonds), axis=1), axis=0)
+
+
+def num2str(num):
+    """
+    Returns a capital letter for positive integers up to 701
+    e.g. num2str(0) = 'A'
+    """
+    if num < 26:
+        return chr(num + 65)
+    return "".join([chr(num // 26 + 64), chr(num % 26 + 65)])
+
+
+def _smarts_matches(mol, smarts_strings):
+    """
+    Runs each distinct SMARTS pattern once on mol and returns a dict of
+    SMARTS string: list of 0-indexed atom index tuples
+    """
+    matches = {}
+    for smart_str in smarts_strings:
+        if smart_str not in matches:
+            groups = pybel.Smarts(smart_str).findall(mol)
+            matches[smart_str] = [tuple(i - 1 for i in group) for group in groups]
+    return matches
+
+
+def _select_beads(bead_list, matches):
+    """
+    Chooses the beads of bead_list from SMARTS matches as in coarse()
+
+    Returns
+    -------
+    bead_inds : list of (group, smarts, name) tuples
+    seen : set of the atom indices in a bead
+    """
+    seen = set()
+    bead_inds = []
+    for bead_name, smart_str in bead_list:
+        if not matches[smart_str]:
+            print(f"{smart_str} not found in compound!")
+        for group in matches[smart_str]:
+            # smart strings for rings can share atoms
+            # add bead regardless of whether it was seen
+            if has_number(smart_str):
+                seen.update(group)
+                bead_inds.append((group, smart_str, bead_name))
+            # alkyl chains should be exclusive
+            elif not has_common_member(seen, group):
+                seen.update(group)
+                bead_inds.append((group, smart_str, bead_name))
+    return bead_inds, seen
+
+
+def _coarse_from_beads(mol, arrays, bead_inds, atomistic_dtype):
+    """
+    Builds the CG_Compound of bead_inds given pybel_to_arrays(mol)
+    """
+    atomistic = AtomisticRecord(
+        arrays["xyz"],
+        _pybel_names(arrays),
+        arrays["bonds"],
+        bead_inds=bead_inds,
+        box=_pybel_box(mol),
+        dtype=atomistic_dtype,
+    )
+    cg_compound = cg_comp(atomistic, bead_inds)
+    cg_compound = cg_bonds(atomistic, cg_compound, bead_inds)
+
+    cg_compound.atomistic = atomistic
+
+    return cg_compound
+
+
+def coarse(mol, bead_list, atomistic_dtype=None):
+    """
+    Creates a coarse-grained (CG) compound given a starting structure and
+    smart strings for desired beads.
+
+    Parameters
+    ----------
+    mol : pybel.Molecule
+    bead_list : list of tuples of strings, desired bead name
+    followed by SMARTS string of that bead
+    atomistic_dtype : numpy dtype of the coordinates stored in
+    CG_Compound.atomistic (default None, see AtomisticRecord)
+
+    Returns
+    -------
+    CG_Compound
+    """
+    matches = _smarts_matches(mol, [smart_str for _, smart_str in bead_list])
+    bead_inds, seen = _select_beads(bead_list, matches)
+
+    n_atoms = mol.OBMol.NumHvyAtoms()
+    if n_atoms != len(seen):
+        print(
+            "WARNING: Some atoms have been left out of coarse-graining!"
+        )  # TODO make this more informative
+
+    return _coarse_from_beads(mol, pybel_to_arrays(mol), bead_inds, atomistic_dtype)
+
+
+def _component_chunks(n_atoms, bonds, chunk_atoms):
+    """
+    Groups the connected components of a bond network, in order of their
+    lowest atom index, into chunks of at most chunk_atoms atoms (a single
+    larger component makes its own chunk). Yields sorted atom index arrays.
+    """
+    mol = molecule_ids(n_atoms, bonds)
+    order = np.argsort(mol, kind="stable")
+    sizes = np.bincount(mol)
+    ends = np.cumsum(sizes)
+    start = 0
+    chunk_end = 0
+    for end in ends:
+        if end - start > chunk_atoms and chunk_end > start:
+            yield order[start:chunk_end]
+            start = chunk_end
+        chunk_end = end
+    if chunk_end > start:
+        yield order[start:chunk_end]
+
+
+def _pybel_chunks(mol, chunk_atoms):
+    """
+    Splits a pybel molecule into pybel molecules of groups of its connected
+    components (see _component_chunks()). Yields (atom indices, molecule).
+    """
+    obmol = mol.OBMol
+    bonds = np.array(
+        [
+            (obmol.GetBond(i).GetBeginAtomIdx(), obmol.GetBond(i).GetEndAtomIdx())
+            for i in range(obmol.NumBonds())
+        ],
+        dtype=int,
+    ).reshape(-1, 2)
+    for atoms in _component_chunks(obmol.NumAtoms(), bonds - 1, chunk_atoms):
+        atoms = np.sort(atoms)
+        selection = ob.OBBitVec()
+        for i in atoms.tolist():
+            selection.SetBitOn(i + 1)
+        sub = ob.OBMol()
+        # atoms are copied in index order
+        obmol.CopySubstructure(sub, selection, None, 0)
+        yield atoms, pybel.Molecule(sub)
+
+
+_ChunkedBeads = namedtuple(
+    "_ChunkedBeads",
+    ["centers", "names", "smarts", "bonds", "n_seen", "n_heavy", "atomistic"],
+)
+
+
+def _coarse_chunk_arrays(
+    chunks, bead_list, box=None, keep_atomistic=False, atomistic_dtype=None
+):
+    """
+    Maps each (atom indices, pybel.Molecule) chunk onto beads as in coarse()
+    and returns the beads of all chunks as a _ChunkedBeads namedtuple. Between
+    chunks only the bead arrays are kept and, if keep_atomistic, compact
+    numpy arrays of each chunk's atoms, which become an AtomisticRecord.
+    """
+    if atomistic_dtype is None:
+        atomistic_dtype = _float_dtype()
+    smarts_list = [smart_str for _, smart_str in bead_list]
+    centers, bead_names, bead_smarts, cg_bonds_list = [], [], [], []
+    # per chunk: atom indices, coordinates, type codes, bonds, bead atoms
+    # and bead sizes, all as numpy arrays
+    parts = []
+    type_codes = {}
+    n_atoms = n_beads = n_seen = n_heavy = 0
+    for atoms, chunk in chunks:
+        arrays = pybel_to_arrays(chunk)
+        matches = _smarts_matches(chunk, smarts_list)
+        chunk_beads, seen = _select_beads(bead_list, matches)
+        n_seen += len(seen)
+        n_heavy += chunk.OBMol.NumHvyAtoms()
+
+        groups = [group for group, _, _ in chunk_beads]
+        if groups:
+            centers.append(bead_centers(arrays["xyz"], groups, box=box))
+        bead_names += [name for _, _, name in chunk_beads]
+        bead_smarts += [smarts for _, smarts, _ in chunk_beads]
+        cg_bonds_list.append(_bead_bonds(arrays["bonds"], groups) + n_beads)
+
+        if atoms is None:
+            atoms = np.arange(n_atoms, n_atoms + len(arrays["xyz"]))
+        if keep_atomistic:
+            atoms = np.asarray(atoms, dtype=np.int32)
+            codes = [
+                type_codes.setdefault(name, len(type_codes))
+                for name in _pybel_names(arrays)
+            ]
+            flat, _, sizes = _flatten_groups(groups)
+            parts.append(
+                (
+                    atoms,
+                    arrays["xyz"].astype(atomistic_dtype),
+                    np.array(codes, dtype=np.uint16),
+                    atoms[arrays["bonds"]],
+                    atoms[flat],
+                    sizes.astype(np.int32),
+                )
+            )
+        n_atoms += len(arrays["xyz"])
+        n_beads += len(chunk_beads)
+
+    atomistic = None
+    if keep_atomistic:
+        atomistic = _chunked_record(parts, type_codes, n_atoms, box, atomistic_dtype)
+    return _ChunkedBeads(
+        np.concatenate(centers) if centers else np.empty((0, 3)),
+        bead_names,
+        bead_smarts,
+        np.concatenate(cg_bonds_list) if cg_bonds_list else np.empty((0, 2), int),
+        n_seen,
+        n_heavy,
+        atomistic,
+    )
+
+
+def _chunked_record(parts, type_codes, n_atoms, box, dtype):
+    """
+    Assembles the AtomisticRecord of the per-chunk arrays kept by
+    _coarse_chunk_arrays()
+    """
+    types = sorted(type_codes)
+    remap = np.empty(max(len(types), 1), dtype=np.uint16)
+    remap[[type_codes[t] for t in types]] = np.arange(len(types))
+
+    xyz = np.empty((n_atoms, 3), dtype=dtype)
+    typeid = np.empty(n_atoms, dtype=np.uint8 if len(types) < 256 else np.uint16)
+    for atoms, chunk_xyz, codes, _, _, _ in parts:
+        xyz[atoms] = chunk_xyz
+        typeid[atoms] = remap[codes]
+
+    def joined(k, shape):
+        arrays = [part[k] for part in parts]
+        if not arrays:
+            return np.empty(shape, dtype=np.int32)
+        return np.concatenate(arrays).astype(np.int32).reshape(shape)
+
+    bonds = joined(3, (-1, 2))
+    bead_atoms = joined(4, -1)
+    bead_offsets = np.append(0, np.cumsum(joined(5, -1))).astype(np.int32)
+    return AtomisticRecord.from_arrays(
+        xyz, types, typeid, bonds, bead_atoms, bead_offsets, box=box
+    )
+
+
+def coarse_chunked(
+    mol,
+    bead_list,
+    chunk_atoms=10000,
+    box=None,
+    keep_atomistic=False,
+    atomistic_dtype=None,
+):
+    """
+    Coarse-grains a large system piece by piece: each chunk of whole
+    molecules is SMARTS matched and mapped on its own and the beads and bonds
+    are appended to the output with global index offsets. Only arrays are
+    kept between chunks, so peak memory is set by the largest chunk instead
+    of the whole system. The beads are those coarse() finds (no bead can span
+    two molecules), ordered chunk by chunk.
+
+    Parameters
+    ----------
+    mol : pybel.Molecule, or an iterable of pybel.Molecule
+        A single molecule is split into its connected components. An
+        iterable (e.g. pybel.readfile("sdf", "blend.sdf")) is streamed and
+        each item is one chunk; atom indices follow the iteration order.
+    bead_list : list of tuples of strings, see coarse()
+    chunk_atoms : int, largest number of atoms in a chunk when splitting
+        a single molecule (default 10000)
+    box : mbuild.box.Box (default None)
+        If None, the unitcell of mol (if it is a single molecule).
+    keep_atomistic : bool, store the atomistic structure in
+        CG_Compound.atomistic as in coarse() (default False)
+        The atoms of each chunk are kept as compact arrays (coordinates in
+        atomistic_dtype, 16 bit type codes, int32 bonds), so memory then grows
+        with the number of atoms by roughly the size of the AtomisticRecord.
+    atomistic_dtype : numpy dtype, see coarse() (default None)
+
+    Returns
+    -------
+    CG_Compound
+    """
+    if isinstance(mol, pybel.Molecule):
+        if box is None:
+            box = _pybel_box(mol)
+        chunks = _pybel_chunks(mol, chunk_atoms)
+        n_heavy = mol.OBMol.NumHvyAtoms()
+    else:
+        chunks = ((None, chunk) for chunk in mol)
+        n_heavy = None
+
+    beads = _coarse_chunk_arrays(
+        chunks, bead_list, box, keep_atomistic, atomistic_dtype
+    )
+    if beads.n_seen != (beads.n_heavy if n_heavy is None else n_heavy):
+        print("WARNING: Some atoms have been left out of coarse-graining!")
+
+    from cg_compound import CG_Compound
+
+    cg_compound = CG_Compound.from_arrays(
+        beads.centers, beads.names, bonds=beads.bonds, box=box
+    )
+    for particle, smarts in zip(cg_compound.particles(), beads.smarts):
+        particle.smarts_string = smarts
+    if keep_atomistic:
+        cg_compound.atomistic = beads.atomistic
+    return cg_compound
+
+
+MappingCandidate = namedtuple("MappingCandidate", ["compound", "left_out", "overlaps"])
+
+
+def coarse_candidates(mol, candidates, atomistic_dtype=None, build=True):
+    """
+    Coarse-grains mol with several candidate bead lists. Every distinct
+    SMARTS string in the candidates is matched only once, and the molecule
+    is read into arrays only once, so comparing mappings is much faster than
+    calling coarse() for each.
+
+    Example
+    -------
+    >>> candidates = {
+    ...     "alkyl_3": [("_B", features_dict["thiophene"]),
+    ...                 ("_S", features_dict["alkyl_3"])],
+    ...     "split": [("_B", features_dict["splitring1"]),
+    ...               ("_R", features_dict["splitring2"]),
+    ...               ("_S", features_dict["alkyl_3"])],
+    ... }
+    >>> for name, c in coarse_candidates(mol, candidates).items():
+    ...     print(name, len(c.left_out), len(c.overlaps))
+
+    Parameters
+    ----------
+    mol : pybel.Molecule
+    candidates : dict (or list) of bead_lists as passed to coarse()
+    atomistic_dtype : numpy dtype, see coarse() (default None)
+    build : bool, whether to build the CG_Compounds (default True)
+        If False, only the coverage is reported.
+
+    Returns
+    -------
+    dict (or list, matching candidates) of MappingCandidate, namedtuple of
+        compound : CG_Compound, as made by coarse() (None if build is False)
+        left_out : np.ndarray, indices of heavy atoms in no bead
+        overlaps : np.ndarray, indices of atoms in more than one bead
+    """
+    keys = list(candidates) if isinstance(candidates, dict) else None
+    bead_lists = list(candidates.values()) if keys is not None else candidates
+
+    all_smarts = [smart_str for bead_list in bead_lists for _, smart_str in bead_list]
+    matches = _smarts_matches(mol, all_smarts)
+    arrays = pybel_to_arrays(mol)
+    heavy = np.flatnonzero(arrays["atomic_numbers"] > 1)
+
+    results = []
+    for bead_list in bead_lists:
+        bead_inds, seen = _select_beads(bead_list, matches)
+        counts = np.bincount(
+            [i for group, _, _ in bead_inds for i in group],
+            minlength=len(arrays["xyz"]),
+        )
+        compound = None
+        if build:
+            compound = _coarse_from_beads(mol, arrays, bead_inds, atomistic_dtype)
+        results.append(
+            MappingCandidate(
+                compound,
+                heavy[~np.isin(heavy, list(seen))],
+                np.flatnonzero(counts > 1),
+            )
+        )
+    if keys is not None:
+        return dict(zip(keys, results))
+    return results
+
+
+def _bead_frames(cg_xyz, references, box=None):
+    """
+    Builds an orthonormal frame for every bead from the vectors to its two
+    reference beads. Beads without references get the identity, and beads
+    with one reference (or collinear references) get a frame whose second
+    axis is the coordinate axis most perpendicular to the first.
+
+    Parameters
+    ----------
+    cg_xyz : np.ndarray (M,3) or (F,M,3), bead coordinates
+    references : np.ndarray (M,2), bead indices (-1 if none)
+    box : box accepted by box_matrix() (default None)
+
+    Returns
+    -------
+    np.ndarray (M,3,3) or (F,M,3,3), the frame vectors are the columns
+    """
+    has_j = references[:, 0] >= 0
+    has_k = references[:, 1] >= 0
+    v1 = cg_xyz[..., references[:, 0], :] - cg_xyz
+    v2 = cg_xyz[..., references[:, 1], :] - cg_xyz
+    if box is not None:
+        v1 = minimum_image(v1, box)
+        v2 = minimum_image(v2, box)
+
+    # beads without a first reference use the x axis
+    v1 = np.where(has_j[:, None], v1, [1.0, 0.0, 0.0])
+    e1 = v1 / np.linalg.norm(v1, axis=-1, keepdims=True)
+
+    u = v2 - np.sum(v2 * e1, axis=-1, keepdims=True) * e1
+    u_norm = np.linalg.norm(u, axis=-1, keepdims=True)
+    fallback = np.eye(3)[np.argmin(np.abs(e1), axis=-1)]
+    fallback -= np.sum(fallback * e1, axis=-1, keepdims=True) * e1
+    fallback /= np.linalg.norm(fallback, axis=-1, keepdims=True)
+    use_u = has_k[:, None] & (u_norm > 1e-6 * np.linalg.norm(v2, axis=-1)[..., None])
+    e2 = np.where(use_u, u / np.where(u_norm > 0, u_norm, 1), fallback)
+    e3 = np.cross(e1, e2)
+    return np.stack((e1, e2, e3), axis=-1)
+
+
+class Backmapper:
+    """
+    Rebuilds atomistic coordinates from coarse-grained coordinates.
+    Each atom is stored relative to the center of the bead it belongs to, in
+    a frame of reference built from the vectors to two neighboring beads.
+    Backmapping then applies one rigid-body transform per bead to all of its
+    atoms for every frame at once.
+
+    Use Backmapper.from_compound() with a CG_Compound made by coarse().
+
+    Attributes
+    ----------
+    local_xyz : np.ndarray (N,3), atom coordinates in the frame of their bead
+    owner : np.ndarray (N,), bead index of each atom
+    references : np.ndarray (n_beads,2), beads used to build each bead frame
+    types : tuple of str, atom type names
+    typeid : np.ndarray (N,)
+    bonds : np.ndarray (B,2), atom indices of each bond
+    """
+
+    def __init__(self, local_xyz, owner, references, types, typeid, bonds):
+        self.local_xyz = np.asarray(local_xyz, dtype=_float_dtype())
+        self.owner = np.asarray(owner, dtype=_index_dtype())
+        self.references = np.asarray(references, dtype=_index_dtype())
+        self.types = tuple(types)
+        self.typeid = np.asarray(typeid, dtype=_typeid_dtype(len(self.types)))
+        self.bonds = np.asarray(bonds, dtype=_index_dtype()).reshape(-1, 2)
+
+    @property
+    def n_atoms(self):
+        return len(self.owner)
+
+    @property
+    def n_beads(self):
+        return len(self.references)
+
+    @classmethod
+    def from_compound(cls, cg_compound):
+        """
+        Parameters
+        ----------
+        cg_compound : CG_Compound made by coarse(), the atomistic structure
+            and bead mapping are read from cg_compound.atomistic
+
+        Returns
+        -------
+        Backmapper
+        """
+        record = cg_compound.atomistic
+        if not isinstance(record, AtomisticRecord):
+            raise ValueError(
+                "cg_compound.atomistic must be an AtomisticRecord made by coarse()."
+            )
+        cg_xyz = cg_compound.xyz
+        box = cg_compound.box
+        n_beads = len(cg_xyz)
+
+        references = _bead_references(n_beads, cg_compound.bond_array())
+        owner = _atom_owners(record, cg_xyz, box)
+
+        frames = _bead_frames(cg_xyz, references, box)
+        diff = record.xyz - cg_xyz[owner]
+        if box is not None:
+            diff = minimum_image(diff, box)
+        # rotate into the bead frame: R^T d
+        local_xyz = np.einsum("nji,nj->ni", frames[owner], diff)
+        return cls(
+            local_xyz, owner, references, record.types, record.typeid, record.bonds
+        )
 
+    def _tile(self, n_cg):
+        """
+        Index arrays for a system of identical copies of the mapped molecule
+        """
+        if n_cg % self.n_beads != 0:
+            raise ValueError(
+                f"{n_cg} beads is not a multiple of the {self.n_beads} beads "
+                "in the mapped molecule."
+            )
+        n_copies = n_cg // self.n_beads
+        bead_offsets = np.repeat(np.arange(n_copies) * self.n_beads, self.n_beads)
+        atom_offsets = np.arange(n_copies) * self.n_atoms
+        references = np.tile(self.references, (n_copies, 1))
+        references = np.where(
+            references >= 0, references + bead_offsets[:, None], -1
+        )
+        owner = self.owner + bead_offsets[:: self.n_beads, None]
+        bonds = self.bonds + atom_offsets[:, None, None]
+        return n_copies, references, owner.reshape(-1), bonds.reshape(-1, 2)
 
-def has_number(string):
-    """
-    Returns True if string contains a number.
-    Else returns False.
-    """
-    return bool(re.search("[0-9]", string))
+    def backmap(self, cg_xyz, box=None):
+        """
+        Rebuilds atomistic coordinates for one or many frames. If cg_xyz holds
+        several copies of the mapped molecule (e.g. a box filled with chains),
+        the atoms of each copy follow in the same order.
 
+        Parameters
+        ----------
+        cg_xyz : np.ndarray (M,3) or (F,M,3), bead coordinates
+        box : box accepted by box_matrix(), one per frame for (F,M,3)
+            coordinates (default None)
 
-def has_common_member(set_a, tup):
-    """
-    return True if set_a (set) and tup (tuple) share a common member
-    else return False
-    """
-    set_b = set(tup)
-    return set_a & set_b
+        Returns
+        -------
+        np.ndarray (N*M/n_beads,3) or (F,N*M/n_beads,3), atom coordinates
+        (unwrapped with respect to their bead)
+        """
+        cg_xyz = np.asarray(cg_xyz, dtype=_float_dtype())
+        n_copies, references, owner, _ = self._tile(cg_xyz.shape[-2])
+        frames = _bead_frames(cg_xyz, references, box)
+        local_xyz = np.tile(self.local_xyz, (n_copies, 1))
+        return cg_xyz[..., owner, :] + np.einsum(
+            "...nij,nj->...ni", frames[..., owner, :, :], local_xyz
+        )
 
+    def backmap_gsd(
+        self, cg_gsd, out_gsd, start=0, stop=None, stride=1, scale=1.0, chunk_size=100
+    ):
+        """
+        Writes an atomistic gsd trajectory from a coarse-grained one. The bead
+        order of the CG trajectory must match the mapped compound (or repeated
+        copies of it). Atoms are wrapped into the box and their images are
+        written so they can be unwrapped.
 
-def cg_comp(comp, bead_inds):
+        Parameters
+        ----------
+        cg_gsd : str, filename of the coarse-grained gsd trajectory, or a FrameCache
+            (for a cache built with scale, use scale=1.0 here)
+        out_gsd : str, filename of the atomistic gsd trajectory to write
+        start, stop, stride : int, frames to use, following python slicing
+            (default 0, None, 1)
+        scale : float, scaling factor multiplied to the CG coordinates to get nm.
+            The output is written in the units of the CG trajectory (default 1.0)
+        chunk_size : int, number of frames backmapped at once (default 100)
+        """
+        reader = _open_frames(cg_gsd)
+        frames = range(len(reader))[start:stop:stride]
+
+        n_copies, _, _, bonds = self._tile(len(reader[0].position))
+        typeid = np.tile(self.typeid, n_copies)
+        names = np.array(self.types)[typeid]
+        bond_names = np.sort(names[bonds], axis=1)
+        bond_types, bond_typeid = np.unique(
+            [f"{a}-{b}" for a, b in bond_names], return_inverse=True
+        )
+
+        with reader, gsd.hoomd.open(out_gsd, "wb") as traj:
+            for i in range(0, len(frames), chunk_size):
+                chunk = list(_iter_frames(reader, frames[i : i + chunk_size]))
+                cg_xyz = np.stack([frame.position for frame in chunk]) * scale
+                boxes = np.stack([frame.box for frame in chunk])
+                boxes[:, :3] *= scale
+                xyz = self.backmap(cg_xyz, box=boxes)
+
+                matrix = box_matrix(boxes)
+                frac = xyz @ np.linalg.inv(matrix).swapaxes(-1, -2)
+                images = np.round(frac)
+                xyz = (frac - images) @ matrix.swapaxes(-1, -2)
+
+                for frame, pos, image in zip(chunk, xyz, images):
+                    new = gsd.hoomd.Snapshot()
+                    new.configuration.step = frame.step
+                    new.configuration.box = frame.box
+                    new.particles.N = len(pos)
+                    new.particles.types = list(self.types)
+                    new.particles.typeid = typeid
+                    new.particles.position = (pos / scale).astype(np.float32)
+                    new.particles.image = image.astype(np.int32)
+                    new.bonds.N = len(bonds)
+                    new.bonds.types = bond_types.tolist()
+                    new.bonds.typeid = bond_typeid
+                    new.bonds.group = bonds
+                    traj.append(new)
+
+
+def _bead_references(n_beads, cg_bonds):
     """
-    given an mbuild compound and bead_inds(list of tup)
-    return coarse-grained mbuild compound
+    Picks two reference beads for each bead: its first two bonded neighbors,
+    or its one neighbor and a neighbor of that neighbor. -1 if there is none.
     """
-    cg_compound = CG_Compound()
-    cg_compound.box = comp.box
+    neighbors = defaultdict(list)
+    for i, j in np.asarray(cg_bonds).tolist():
+        neighbors[i].append(j)
+        neighbors[j].append(i)
+
+    references = np.full((n_beads, 2), -1, dtype=int)
+    for i in range(n_beads):
+        near = sorted(neighbors[i])
+        if len(near) >= 2:
+            references[i] = near[:2]
+        elif len(near) == 1:
+            references[i, 0] = near[0]
+            second = sorted(set(neighbors[near[0]]) - {i})
+            if second:
+                references[i, 1] = second[0]
+    return references
+
+
+def _atom_owners(record, cg_xyz, box=None):
+    """
+    Assigns every atom to one bead: atoms in a bead group go to the first bead
+    that contains them, atoms in no bead (e.g. hydrogens) go to the bead of an
+    atom they are bonded to, and any left go to the closest bead.
+    """
+    owner = np.full(record.n_atoms, -1, dtype=int)
+    bead_ids = np.repeat(np.arange(record.n_beads), np.diff(record.bead_offsets))
+    atoms, first = np.unique(record.bead_atoms, return_index=True)
+    owner[atoms] = bead_ids[first]
+
+    bonds = record.bonds
+    while len(bonds):
+        a, b = owner[bonds[:, 0]], owner[bonds[:, 1]]
+        to_b = (a >= 0) & (b < 0)
+        to_a = (b >= 0) & (a < 0)
+        if not (to_a.any() or to_b.any()):
+            break
+        owner[bonds[to_b, 1]] = a[to_b]
+        owner[bonds[to_a, 0]] = b[to_a]
+
+    left = np.flatnonzero(owner < 0)
+    if len(left):
+        diff = record.xyz[left, None, :] - cg_xyz[None, :, :]
+        if box is not None:
+            diff = minimum_image(diff, box)
+        owner[left] = np.argmin(np.linalg.norm(diff, axis=-1), axis=1)
+    return owner
+
+
+def _element_from_mass(mass, tol=0.1):
+    """
+    Element symbol whose standard atomic mass is within tol of mass, or None
+    """
+    from parmed.periodic_table import Element, Mass
 
-    for bead, smarts, bead_name in bead_inds:
-        bead_xyz = comp.xyz[bead, :]
-        avg_xyz = np.mean(bead_xyz, axis=0)
-        bead = mb.Particle(name=bead_name, pos=avg_xyz)
-        bead.smarts_string = smarts
-        cg_compound.add(bead)
-    return cg_compound
+    # parmed's Element maps atomic numbers to symbols, which skips dummy types
+    symbols = [Element[i] for i in range(1, len(Element)) if Element[i] in Mass]
+    masses = np.array([Mass[e] for e in symbols])
+    nearest = np.argmin(np.abs(masses - mass))
+    return symbols[nearest] if abs(masses[nearest] - mass) <= tol else None
 
 
-def cg_bonds(comp, cg_compound, beads):
+class UnitedAtomMap:
     """
-    add bonds based on bonding in aa compound
-    return bonded mbuild compound
+    Maps an all-atom structure onto united atoms (as in
+    forcefields/p3ht-ua.xml): each hydrogen is merged into the heavy atom it
+    is bonded to, which keeps its position. Sites are typed "CA" (aromatic
+    carbon), "CT" (aliphatic carbon), or by element (e.g. "S"), and carry
+    the summed mass of their atoms.
+
+    Attributes
+    ----------
+    heavy : np.ndarray (n_sites,), atom index of each united atom
+    owner : np.ndarray (N,), united atom index of each atom
+    types : tuple of str, united atom type names
+    typeid : np.ndarray (n_sites,)
+    mass : np.ndarray (n_sites,), summed atom masses
+    bonds : np.ndarray (B,2), united atom indices of each bond
+    angles : np.ndarray (A,3), united atom indices of each angle
     """
-    bonds = comp.get_bonds()
-    bead_bonds = []
-    for i, (bead_i, _, _) in enumerate(beads[:-1]):
-        for j, (bead_j, _, _) in enumerate(beads[(i + 1) :]):
-            for pair in bonds:
-                if (pair[0] in bead_i) and (pair[1] in bead_j):
-                    bead_bonds.append((i, j + i + 1))
-                if (pair[1] in bead_i) and (pair[0] in bead_j):
-                    bead_bonds.append((i, j + i + 1))
-    for pair in bead_bonds:
-        bond_pair = [
-            particle
-            for i, particle in enumerate(cg_compound.particles())
-            if i == pair[0] or i == pair[1]
-        ]
-        cg_compound.add_bond(bond_pair)
-    return cg_compound
 
+    def __init__(self, elements, bonds, aromatic=None, type_elements=None):
+        """
+        Parameters
+        ----------
+        elements : list of str (N,), element symbol, amber type, or a type
+            name in type_elements of each atom
+        bonds : np.ndarray (B,2), atom indices of each bond
+        aromatic : np.ndarray (N,) of bool, aromatic atoms (default None)
+            If None, carbons with three bonded atoms are taken as aromatic and
+            carbons with four as aliphatic.
+        type_elements : dict of str, element symbol of each type name
+            (default None), e.g. forcefield_elements("forcefields/p3ht-aa.xml")
+        """
+        from parmed.periodic_table import Mass
 
-def num2str(num):
-    """
-    Returns a capital letter for positive integers up to 701
-    e.g. num2str(0) = 'A'
-    """
-    if num < 26:
-        return chr(num + 65)
-    return "".join([chr(num // 26 + 64), chr(num % 26 + 65)])
+        type_elements = type_elements or {}
+        elements = np.array(
+            [type_elements.get(e, amber_dict.get(e, e)) for e in elements]
+        )
+        unknown = sorted(set(elements.tolist()) - set(Mass))
+        if unknown:
+            raise ValueError(
+                f"Could not find the element of types {unknown}. Pass "
+                "type_elements, e.g. forcefield_elements() of the forcefield."
+            )
+        bonds = np.asarray(bonds, dtype=_index_dtype()).reshape(-1, 2)
+        if aromatic is None:
+            degree = np.bincount(bonds.ravel(), minlength=len(elements))
+            aromatic = (elements == "C") & (degree == 3)
+        aromatic = np.asarray(aromatic, dtype=bool)
+
+        hydrogen = elements == "H"
+        self.heavy = np.flatnonzero(~hydrogen).astype(_index_dtype())
+        owner = np.full(len(elements), -1, dtype=_index_dtype())
+        owner[self.heavy] = np.arange(len(self.heavy))
+        # hydrogens take the site of their bonded heavy atom
+        for a, b in (bonds.T, bonds.T[::-1]):
+            merge = hydrogen[a] & ~hydrogen[b]
+            owner[a[merge]] = owner[b[merge]]
+        if np.any(owner < 0):
+            raise ValueError("Found hydrogens not bonded to a heavy atom.")
+        self.owner = owner
+
+        names = elements[self.heavy].astype(object)
+        names[(names == "C") & aromatic[self.heavy]] = "CA"
+        names[names == "C"] = "CT"
+        types, typeid = np.unique(names.astype(str), return_inverse=True)
+        self.types = tuple(types.tolist())
+        self.typeid = typeid.astype(_typeid_dtype(len(types)) or int)
+
+        masses = np.array([Mass[e] for e in elements])
+        self.mass = np.bincount(owner, weights=masses, minlength=len(self.heavy))
+
+        heavy_bonds = bonds[~hydrogen[bonds].any(axis=1)]
+        self.bonds = owner[heavy_bonds]
+        self.angles = angles_from_bonds(self.bonds).astype(_index_dtype())
 
+    @classmethod
+    def from_pybel(cls, pybel_mol):
+        """
+        Uses OpenBabel's aromaticity
 
-def coarse(mol, bead_list):
-    """
-    Creates a coarse-grained (CG) compound given a starting structure and
-    smart strings for desired beads.
+        Parameters
+        ----------
+        pybel_mol : pybel.Molecule
 
-    Parameters
-    ----------
-    mol : pybel.Molecule
-    bead_list : list of tuples of strings, desired bead name
-    followed by SMARTS string of that bead
+        Returns
+        -------
+        UnitedAtomMap
+        """
+        arrays = pybel_to_arrays(pybel_mol)
+        elements = _pybel_names(arrays)
+        return cls(elements, arrays["bonds"], aromatic=arrays["aromatic"])
 
-    Returns
-    -------
-    CG_Compound
-    """
-    matches = []
-    for i, item in enumerate(bead_list):
-        bead_name, smart_str = item
-        smarts = pybel.Smarts(smart_str)
-        if not smarts.findall(mol):
-            print(f"{smart_str} not found in compound!")
-        for group in smarts.findall(mol):
-            group = tuple(i - 1 for i in group)
-            matches.append((group, smart_str, bead_name))
+    @classmethod
+    def from_gsd(cls, gsdfile, frame=0, type_elements=None):
+        """
+        Reads the particle types and bonds of an all-atom gsd trajectory.
+        Types which are not element symbols, amber types or in type_elements
+        (e.g. "C1", "S1", "H1" of forcefields/p3ht-aa.xml) get the element
+        closest in mass to their particle mass.
 
-    seen = set()
-    bead_inds = []
-    for group, smarts, name in matches:
-        # smart strings for rings can share atoms
-        # add bead regardless of whether it was seen
-        if has_number(smarts):
-            for atom in group:
-                seen.add(atom)
-            bead_inds.append((group, smarts, name))
-        # alkyl chains should be exclusive
-        else:
-            if has_common_member(seen, group):
-                pass
-            else:
-                for atom in group:
-                    seen.add(atom)
-                bead_inds.append((group, smarts, name))
+        Parameters
+        ----------
+        gsdfile : str, filename of the gsd trajectory, or a FrameCache
+        frame : int, frame number (default 0)
+        type_elements : dict of str, element symbol of each type name
+            (default None), e.g. forcefield_elements("forcefields/p3ht-aa.xml")
 
-    n_atoms = mol.OBMol.NumHvyAtoms()
-    if n_atoms != len(seen):
-        print(
-            "WARNING: Some atoms have been left out of coarse-graining!"
-        )  # TODO make this more informative
+        Returns
+        -------
+        UnitedAtomMap
+        """
+        from parmed.periodic_table import Mass
+
+        type_elements = dict(type_elements or {})
+        with _open_frames(gsdfile) as reader:
+            snap = reader[frame]
+            mass = np.asarray(reader.mass, dtype=float)
+            bonds = reader.bonds
+        for i, name in enumerate(snap.types):
+            if type_elements.get(name, amber_dict.get(name, name)) in Mass:
+                continue
+            type_mass = mass[snap.typeid == i]
+            element = _element_from_mass(type_mass.mean()) if len(type_mass) else None
+            if element is not None:
+                type_elements[name] = element
+        elements = np.array(snap.types)[snap.typeid]
+        return cls(elements, bonds, type_elements=type_elements)
+
+    @property
+    def n_sites(self):
+        return len(self.heavy)
+
+    def map(self, xyz):
+        """
+        Returns the united atom positions (n_sites,3) or (F,n_sites,3) given
+        atom positions (N,3) or (F,N,3)
+        """
+        return np.asarray(xyz)[..., self.heavy, :]
 
-    comp = CG_Compound.from_pybel(mol)
-    cg_compound = cg_comp(comp, bead_inds)
-    cg_compound = cg_bonds(comp, cg_compound, bead_inds)
+    def _topology_types(self, group):
+        names = np.array(self.types)[self.typeid][group]
+        # same type names as mbuild's gsd writer: the ends are sorted
+        ends = np.sort(names[:, [0, -1]], axis=1)
+        names = np.column_stack((ends[:, :1], names[:, 1:-1], ends[:, 1:]))
+        return np.unique(["-".join(n) for n in names], return_inverse=True)
 
-    cg_compound.atomistic = comp
+    def write_gsd(self, gsdfile, out_gsd, start=0, stop=None, stride=1):
+        """
+        Writes a united atom gsd trajectory from an all-atom one, with the
+        united atom types, masses, bonds and angles.
 
-    return cg_compound
+        Parameters
+        ----------
+        gsdfile : str, filename of the all-atom gsd trajectory, or a FrameCache
+        out_gsd : str, filename of the united atom gsd trajectory to write
+        start, stop, stride : int, frames to use, following python slicing
+            (default 0, None, 1)
+        """
+        bond_types, bond_typeid = self._topology_types(self.bonds)
+        angle_types, angle_typeid = self._topology_types(self.angles)
+
+        reader = _open_frames(gsdfile)
+        frames = range(len(reader))[start:stop:stride]
+        with reader, gsd.hoomd.open(out_gsd, "wb") as traj:
+            for frame in _iter_frames(reader, frames):
+                new = gsd.hoomd.Snapshot()
+                new.configuration.step = frame.step
+                new.configuration.box = frame.box
+                new.particles.N = self.n_sites
+                new.particles.types = list(self.types)
+                new.particles.typeid = self.typeid
+                new.particles.mass = self.mass.astype(np.float32)
+                new.particles.position = self.map(frame.position).astype(np.float32)
+                if frame.image is not None:
+                    new.particles.image = self.map(frame.image).astype(np.int32)
+                new.bonds.N = len(self.bonds)
+                new.bonds.types = bond_types.tolist()
+                new.bonds.typeid = bond_typeid
+                new.bonds.group = self.bonds
+                new.angles.N = len(self.angles)
+                new.angles.types = angle_types.tolist()
+                new.angles.typeid = angle_typeid
+                new.angles.group = self.angles
+                traj.append(new)
 
 
 amber_dict = {
@@ -618,6 +4392,24 @@ amber_dict = {
 }
 
 
+# single bond covalent radii in nm
+# Cordero et al., Dalton Trans. 2008, 2832-2838
+covalent_radii = {
+    "H": 0.031,
+    "B": 0.084,
+    "C": 0.076,
+    "N": 0.071,
+    "O": 0.066,
+    "F": 0.057,
+    "Si": 0.111,
+    "P": 0.107,
+    "S": 0.105,
+    "Cl": 0.102,
+    "Br": 0.120,
+    "I": 0.139,
+}
+
+
 # features SMARTS
 features_dict = {
     "thiophene": "c1sccc1",
@@ -637,753 +4429,196 @@ features_dict = {
 }
 
 
-class CG_Compound(mb.Compound):
-    def __init__(self):
-        super().__init__()
-        self.box = None
-        self.atomistic = None
-
-    @classmethod
-    def from_gsd(cls, gsdfile, frame=-1, coords_only=False, scale=1.0):
-        """
-        Given a trajectory gsd file creates an CG_Compound.
-        If there are multiple separate molecules, they are returned
-        as one compound.
-
-        Parameters
-        ----------
-        gsdfile : str, filename
-        frame : int, frame number (default -1)
-        coords_only : bool (default False)
-            If True, return compound with no bonds
-        scale : float, scaling factor multiplied to coordinates (default 1.0)
-
-        Returns
-        -------
-        CG_Compound
-        """
-        f = gsd.pygsd.GSDFile(open(gsdfile, "rb"))
-        t = gsd.hoomd.HOOMDTrajectory(f)
-
-        snap = t[frame]
-        bond_array = snap.bonds.group
-        n_atoms = snap.particles.N
-
-        # Add particles
-        comp = cls()
-        comp.box = mb.box.Box(lengths=snap.configuration.box[:3] * scale)
-        for i in range(n_atoms):
-            name = snap.particles.types[snap.particles.typeid[i]]
-            xyz = snap.particles.position[i] * scale
-            charge = snap.particles.charge[i]
-
-            atom = mb.Particle(name=name, pos=xyz, charge=charge)
-            comp.add(atom, label=str(i))
-
-        if not coords_only:
-            # Add bonds
-            for i in range(bond_array.shape[0]):
-                atom1 = int(bond_array[i][0])
-                atom2 = int(bond_array[i][1])
-                comp.add_bond([comp[atom1], comp[atom2]])
-        return comp
-
-    def amber_to_element(self):
-        """
-        Pybel does not know how to parse atoms names in AMBER style
-        so this functions renames them to their atomistic counterparts
-        """
-        for particle in self.particles():
-            particle.name = amber_dict[particle.name]
-
-    def remove_hydrogens(self):
-        """
-        Remove all particles with name = "H" in the compound
-        """
-        self.remove([i for i in self.particles() if i.name == "H"])
+class Topology(namedtuple("Topology", ["names", "bonds"])):
+    """
+    Particle names and bonds which can be shared between compounds cloned
+    from the same template.
 
-    def get_molecules(self):
-        """
-        Translates bond_graph.connected_components to particle indices in compound
+    Attributes
+    ----------
+    names : tuple of str (N,), particle names
+    bonds : np.ndarray (B,2), particle indices of each bond (read-only)
+    """
 
-        Returns
-        -------
-        list of sets of connected atom indices
-        """
-        particle_list = [part for part in self.particles()]
-        molecules = []
-        for group in self.bond_graph.connected_components():
-            molecules.append(set(map(particle_list.index, group)))
-        return molecules
+    __slots__ = ()
 
-    def get_bonds(self):
-        """
-        Translates bond_graph.bond_edges to particle indices in compound
 
-        Returns
-        -------
-        list of tuples of bonded atom indices sorted
-        """
-        particle_list = [part for part in self.particles()]
-        bonds = []
-        for tup in self.bond_graph.edges():
-            bonds.append(tuple(sorted(map(particle_list.index, tup))))
-        # This sorting is required for coarse-graining
-        bonds.sort(key=lambda tup: (tup[0], tup[1]))
-        return bonds
+def _make_topology(names, bonds):
+    bonds = np.asarray(bonds, dtype=int).reshape(-1, 2)
+    bonds.flags.writeable = False
+    return Topology(tuple(names), bonds)
 
-    def from_pybel(pybel_mol, use_element=True):
-        """
-        Create a Compound from a Pybel.Molecule
 
-        Parameters
-        ---------
-        pybel_mol: pybel.Molecule
-        use_element : bool, default True
-            If True, construct mb Particles based on the pybel Atom's element.
-            If False, constructs mb Particles based on the pybel Atom's type
+def _compound_topology(compound):
+    """
+    Reads the topology of any mbuild compound
+    """
+    particles = [p for p in compound.particles()]
+    index = {p: i for i, p in enumerate(particles)}
+    try:
+        bonds = [(index[a], index[b]) for a, b in compound.bonds()]
+    except KeyError:
+        from mbuild.exceptions import MBuildError
 
-        Returns
-        ------
-        cmpd : CG_Compound
-        """
-        openbabel = mb.utils.io.import_("openbabel")
-        cmpd = CG_Compound()
-        resindex_to_cmpd = {}
-
-        # Iterating through pybel_mol for atom/residue information
-        # This could just as easily be implemented by
-        # an OBMolAtomIter from the openbabel library,
-        # but this seemed more convenient at time of writing
-        # pybel atoms are 1-indexed, coordinates in Angstrom
-        for atom in pybel_mol.atoms:
-            xyz = np.array(atom.coords) / 10
-            if use_element:
-                try:
-                    temp_name = Element[atom.atomicnum]
-                except KeyError:
-                    warn(
-                        "No element detected for atom at index "
-                        "{} with number {}, type {}".format(
-                            atom.idx, atom.atomicnum, atom.type
-                        )
-                    )
-                    temp_name = atom.type
-            else:
-                temp_name = atom.type
-            temp = mb.compound.Particle(name=temp_name, pos=xyz)
-            if hasattr(atom, "residue"):  # Is there a safer way to check for res?
-                if atom.residue.idx not in resindex_to_cmpd:
-                    res_cmpd = CG_Compound()
-                    resindex_to_cmpd[atom.residue.idx] = res_cmpd
-                    cmpd.add(res_cmpd)
-                resindex_to_cmpd[atom.residue.idx].add(temp)
-            else:
-                cmpd.add(temp)
-
-        # Iterating through pybel_mol.OBMol for bond information
-        # Bonds are 0-indexed, but the atoms are 1-indexed
-        # Bond information doesn't appear stored in pybel_mol,
-        # so we need to look into the OBMol object,
-        # using an iterator from the openbabel library
-        for bond in openbabel.OBMolBondIter(pybel_mol.OBMol):
-            cmpd.add_bond(
-                [cmpd[bond.GetBeginAtomIdx() - 1], cmpd[bond.GetEndAtomIdx() - 1]]
-            )
+        raise MBuildError(
+            "Cloning failed. Compound contains bonds to "
+            "Particles outside of its containment hierarchy."
+        )
+    return _make_topology([p.name for p in particles], bonds)
 
-        if hasattr(pybel_mol, "unitcell"):
-            box = mb.box.Box(
-                lengths=[
-                    pybel_mol.unitcell.GetA() / 10,
-                    pybel_mol.unitcell.GetB() / 10,
-                    pybel_mol.unitcell.GetC() / 10,
-                ],
-                angles=[
-                    pybel_mol.unitcell.GetAlpha(),
-                    pybel_mol.unitcell.GetBeta(),
-                    pybel_mol.unitcell.GetGamma(),
-                ],
-            )
-            cmpd.periodicity = box.lengths
-        else:
-            warn("No unitcell detected for pybel.Molecule {}".format(pybel_mol))
-            box = None
 
-        cmpd.box = box
+class AtomisticRecord:
+    """
+    Compact store of the atomistic structure behind a coarse-grained compound:
+    coordinates, particle type codes, bonds, and the bead -> atom mapping.
+    Use to_compound() to get a CG_Compound when one is needed.
 
-        return cmpd
+    Attributes
+    ----------
+    xyz : np.ndarray (N,3), coordinates in nm
+    types : tuple of str, unique particle names
+    typeid : np.ndarray (N,) of uint8 or uint16, index into types
+    bonds : np.ndarray (B,2) of int32, atom indices of each bond
+    bead_atoms : np.ndarray of int32, atom indices of all beads, concatenated
+    bead_offsets : np.ndarray (n_beads+1,) of int32, bead i is
+        bead_atoms[bead_offsets[i]:bead_offsets[i+1]]
+    box : mbuild.box.Box or None
+    """
 
-    def wrap(self):
-        """
-        Finds particles which are out of the box and translates
-        them to within the box.
+    __slots__ = (
+        "xyz",
+        "types",
+        "typeid",
+        "bonds",
+        "bead_atoms",
+        "bead_offsets",
+        "box",
+    )
+
+    def __init__(self, xyz, names, bonds, bead_inds=None, box=None, dtype=None):
         """
-        try:
-            freud_box = mb_to_freud_box(self.box)
-        except TypeError:
-            print("Can't wrap because CG_Compound.box values aren't assigned.")
-            return
-        particles = [part for part in self.particles()]
-        # find rows where particles are out of the box
-        for row in np.argwhere(abs(self.xyz) > self.box.maxs / 2)[:, 0]:
-            new_xyz = freud_box.wrap(particles[row].pos)
-            particles[row].translate_to(new_xyz)
-
-    def unwrap(self, d_tolerance=0.22, _count=0):
-        """
-        Used to correct molecules which span the periodic boundary by translating particles
-        to their real-space position. The function uses a distance tolerance to detect
-        bonds which span the periodic boundary and from those determines which particle
-        should be considered an outlier, finds other particles the outlier is bonded to,
-        and shifts their position.
-
         Parameters
         ----------
-        d_tolerance = float, distance beyond which a bond is considered "bad" (default=0.22)
-        _count = int, used in recursive algorithm to prevent function from getting stuck
-                 fixing bonds which span the pbc -- user should not set this value.
-
-        if function is getting stuck in an endless loop, try adjusting d_tolerance
-        """
-
-        molecules = self.get_molecules()
-        particles = [part for part in self.particles()]
-
-        def check_bad_bonds(compound):
-            """
-            Used for identifying particles whose bonds span the periodic boundary.
-            Finds particles indices in the compound with bonds longer than the
-            distance tolerance.
-
-            Parameters
-            ----------
-            compound : CG_Compound
-
-            Returns
-            -------
-            list of tuples of particle indices
-            """
-            bad_bonds = [
-                bond
-                for bond in compound.bonds()
-                if distance(bond[0].pos, bond[1].pos) > d_tolerance
-            ]
-            maybe_outliers = [
-                (particles.index(bond[0]), particles.index(bond[1]))
-                for bond in bad_bonds
-            ]
-            return maybe_outliers
-
-        maybe_outliers = check_bad_bonds(self)
-        if not maybe_outliers:
-            print(
-                f"No bonds found longer than {d_tolerance}. Either compound doesn't need"
-                + " unwrapping or d_tolerance is too small. No changes made."
-            )
-            return
-
-        def find_outliers(compound):
-            """
-            Finds "outliers" (bonded particles which span the periodic boundary).
-            Starts by finding bonds that are too long, then determines which particle
-            in the pair is an outlier based on whether removal of that particle reduces
-            the average distance from the particles in the molecule to the geometric center.
-            From these, the function follows the bond graph and adds all particles
-            bonded to the outliers.
-
-            Parameters
-            ----------
-            compound : CG_Compound
-
-            Returns
-            -------
-            set of the particle indices of all outliers in the compound.
-            """
-
-            def _is_outlier(index):
-                for molecule in molecules:
-                    if index in molecule:
-                        test_molecule = molecule.copy()
-                        test_molecule.remove(index)
-                        a = compound.xyz[list(molecule), :]
-                        b = compound.xyz[list(test_molecule), :]
-                        center_a = np.mean(a, axis=0)
-                        center_b = np.mean(b, axis=0)
-                        avg_dist_a = np.mean(v_distance(a, center_a))
-                        avg_dist_b = np.mean(v_distance(b, center_b))
-                return avg_dist_a > avg_dist_b
-
-            def _d_to_center(index):
-                for molecule in molecules:
-                    if index in molecule:
-                        mol_xyz = compound.xyz[list(molecule), :]
-                        center = np.mean(mol_xyz, axis=0)
-                        dist = distance(particles[index].pos, center)
-                return dist
-
-            outliers = set()
-            checked = set()
-            for tup in maybe_outliers:
-                if _is_outlier(tup[0]) and _is_outlier(tup[1]):
-                    # add whichever is further from the center
-                    d_0 = _d_to_center(tup[0])
-                    d_1 = _d_to_center(tup[1])
-                    if d_0 > d_1:
-                        outliers.add(tup[0])
-                    elif d_1 > d_0:
-                        outliers.add(tup[1])
-                    else:
-                        raise RuntimeError(
-                            f"Can't determine which is outlier between indices {tup}"
-                        )
-                elif _is_outlier(tup[0]):
-                    outliers.add(tup[0])
-                elif _is_outlier(tup[1]):
-                    outliers.add(tup[1])
-                checked.add(tup[0])
-                checked.add(tup[1])
-
-            starts = outliers.copy()
-            while starts:
-                index = starts.pop()
-                outliers.update(bond_dict[index] - checked)
-                starts.update(bond_dict[index] - checked)
-                checked.add(index)
-            return outliers
-
-        bond_dict = self.bond_dict()
-        outliers = find_outliers(self)
-
-        # organize outliers by molecule
-        outlier_dict = defaultdict(set)
-        for outlier in outliers:
-            mol_ind = [i for i, mol in enumerate(molecules) if outlier in mol]
-            if mol_ind:
-                outlier_dict[mol_ind[0]].add(outlier)
-
-        # find the center of the molecule without outliers
-        for mol_ind in outlier_dict:
-            molecule = molecules[mol_ind].copy()
-            molecule -= outlier_dict[mol_ind]  # not outlier indices
-            mol_xyz = self.xyz[list(molecule), :]
-            mol_avg = np.mean(mol_xyz, axis=0)
-
-            # translate the outlier to its real-space position found using
-            # freud.box.unwrap. the direction is determined using the
-            # difference between the particle position and the molecule center
-            freud_box = mb_to_freud_box(self.box)
-            for outlier in outlier_dict[mol_ind]:
-                image = mol_avg - particles[outlier].pos
-                img = np.where(image > self.box.maxs / 2, 1, 0) + np.where(
-                    image < -self.box.maxs / 2, -1, 0
-                )
-                new_xyz = freud_box.unwrap(particles[outlier].pos, img)
-                particles[outlier].translate_to(new_xyz)
-
-        # check if any bad bonds remain
-        bad_bonds = check_bad_bonds(self)
-        if bad_bonds:
-            if _count < 5:
-                _count += 1
-                print(f"Bad bonds still present! Trying unwrap again. {_count}")
-                self.unwrap(d_tolerance=d_tolerance, _count=_count)
-            else:
-                print("Bad bonds still present and try limit exceeded.")
-
-    def bond_dict(self):
-        """
-        given an CG_Compound return an dict of the particle indices for each bond
-
-        CG_Compound.bond_dict() --> dict of sets
+        xyz : np.ndarray (N,3), coordinates in nm
+        names : list of str (N,), particle names
+        bonds : np.ndarray (B,2), atom indices of each bond
+        bead_inds : list of index groups, or bead_inds as built in coarse()
+            (default None)
+        box : mbuild.box.Box (default None)
+        dtype : numpy dtype used to store the coordinates (default None)
+            If None, float64, or float32 if COMPACT_DTYPES is set.
         """
-        parts = [part for part in self.particles()]
-        bond_dict = defaultdict(set)
-        for bond in self.bonds():
-            bond_dict[int(parts.index(bond[0]))].add(int(parts.index(bond[1])))
-            bond_dict[int(parts.index(bond[1]))].add(int(parts.index(bond[0])))
-        return bond_dict
+        if dtype is None:
+            dtype = _float_dtype()
+        self.xyz = np.asarray(xyz, dtype=dtype).reshape(-1, 3)
+        types, typeid = np.unique(np.asarray(names, dtype=str), return_inverse=True)
+        self.types = tuple(types.tolist())
+        self.typeid = typeid.astype(np.uint8 if len(types) < 256 else np.uint16)
+        self.bonds = np.asarray(bonds, dtype=np.int32).reshape(-1, 2)
+        if bead_inds is None:
+            bead_inds = []
+        atoms, offsets, counts = _flatten_groups(_bead_groups(bead_inds))
+        self.bead_atoms = atoms.astype(np.int32)
+        self.bead_offsets = np.append(offsets, counts.sum()).astype(np.int32)
+        self.box = box
 
-    def get_name_inds(self, name):
+    @classmethod
+    def from_arrays(cls, xyz, types, typeid, bonds, bead_atoms, bead_offsets, box=None):
         """
-        Find indices of particles in compound where particle.name matches given name
+        Creates a record from arrays already in the stored layout, without
+        going through per-atom names
 
         Parameters
         ----------
-        name : str, particle.name in mb.Compound
+        xyz : np.ndarray (N,3), coordinates in nm, stored with their dtype
+        types : list of str, unique particle names
+        typeid : np.ndarray (N,) of uint8 or uint16, index into types
+        bonds : np.ndarray (B,2), atom indices of each bond
+        bead_atoms : np.ndarray, atom indices of all beads, concatenated
+        bead_offsets : np.ndarray (n_beads+1,), see the class attributes
+        box : mbuild.box.Box (default None)
 
         Returns
         -------
-        list of particles indices which match name
+        AtomisticRecord
         """
-        return [i for i, part in enumerate(self.particles()) if part.name == name]
+        record = cls.__new__(cls)
+        record.xyz = np.asarray(xyz).reshape(-1, 3)
+        record.types = tuple(types)
+        record.typeid = np.asarray(typeid)
+        record.bonds = np.asarray(bonds, dtype=np.int32).reshape(-1, 2)
+        record.bead_atoms = np.asarray(bead_atoms, dtype=np.int32)
+        record.bead_offsets = np.asarray(bead_offsets, dtype=np.int32)
+        record.box = box
+        return record
 
-    def tuple_to_names(self, tup):
+    @classmethod
+    def from_compound(cls, compound, bead_inds=None, dtype=None):
         """
-        Get the names of particle indices passed in as a tuple.
-
         Parameters
         ----------
-        tup : tuple of ints, particle indices
+        compound : CG_Compound
+        bead_inds : list of index groups, or bead_inds as built in coarse()
+        dtype : numpy dtype used to store the coordinates (default None)
 
         Returns
         -------
-        tuple of strings, particle.name of given indices
+        AtomisticRecord
         """
-        particles = [part for part in self.particles()]
-
-        types = []
-        for index in tup:
-            types.append(particles[index].name)
-        return tuple(sorted(types))
+        return cls(
+            compound.xyz,
+            [p.name for p in compound.particles()],
+            compound.bond_array(),
+            bead_inds=bead_inds,
+            box=getattr(compound, "box", None),
+            dtype=dtype,
+        )
 
-    def find_angles(self):
-        """
-        Adapted from cme_utils.manip.builder.building_block.find_angles()
-        Finds unique angle constraints and their types.
+    @property
+    def n_atoms(self):
+        return len(self.typeid)
 
-        Returns
-        -------
-        Dictionary with keys correponding to the angle types and
-        values which list the particle indices which have this angle type
-        """
-        angles = []
-        bond_dict = self.bond_dict()
-        for i in range(self.n_particles):
-            for n1 in bond_dict[i]:
-                for n2 in bond_dict[n1]:
-                    if n2 != i:
-                        if n2 > i:
-                            angles.append((i, n1, n2))
-                        else:
-                            angles.append((n2, n1, i))
-        angles = sorted(set(angles))
-        angle_types = []
-        for t in angles:
-            angle_types.append(self.tuple_to_names(t))
-
-        angle_dict = defaultdict(list)
-        for a, b in zip(angle_types, angles):
-            angle_dict[a].append(b)
-        return angle_dict
-
-    def find_bonds(self):
-        """
-        Finds unique bond constraints and their types.
+    @property
+    def n_beads(self):
+        return len(self.bead_offsets) - 1
 
-        Returns
-        -------
-        Dictionary with keys correponding to the bond types and
-        values which list the particle indices which have this type
+    @property
+    def names(self):
         """
-        bonds = []
-        bond_dict = self.bond_dict()
-        for i in range(self.n_particles):
-            for n1 in bond_dict[i]:
-                if n1 > i:
-                    bonds.append((i, n1))
-                else:
-                    bonds.append((n1, i))
-        bonds = sorted(set(bonds))
-        bond_types = []
-        for t in bonds:
-            bond_types.append(self.tuple_to_names(t))
-
-        bond_dict = defaultdict(list)
-        for a, b in zip(bond_types, bonds):
-            bond_dict[a].append(b)
-        return bond_dict
-
-    def find_pairs(self):
+        list of str (N,), particle names
         """
-        Finds unique (coarse-grained) pair types
-        (coarse particle names start with "_")
+        return np.array(self.types)[self.typeid].tolist()
 
-        Returns
-        -------
-        list of tuples of pair names
+    @property
+    def nbytes(self):
+        """
+        Memory used by the arrays in the record
         """
-        particles = {p.name for p in self.particles() if p.name[0] == "_"}
-        pairs = set()
-        for i in particles:
-            for j in particles:
-                pair = tuple(sorted([i, j]))
-                pairs.add(pair)
-        return sorted(pairs)
+        arrays = (self.xyz, self.typeid, self.bonds, self.bead_atoms, self.bead_offsets)
+        return sum(a.nbytes for a in arrays)
 
-    def remove_atomistic(self):
+    def bond_array(self):
         """
-        all coarse-grained particles are named starting with '_'
-        remove any particles whose names do not start with '_'
+        np.ndarray (B,2), atom indices of each bond
         """
-        for i in self.particles():
-            if i.name[0] != "_":
-                self.remove(i)
-        # Remove residual ports
-        for child in self.children:
-            if type(child) == mb.port.Port:
-                self.remove(child)
+        return self.bonds
 
-    def is_bad_bond(self, tup):
+    def bead_groups(self):
         """
-        Determines whether a bond spans the periodic boundary based on a distance
-        cutoff of the self.box.maxs/2
-
-        Parameters
-        ----------
-        tup : tuple, indices of the bonded particles
-
-        Returns
-        -------
-        bool
-        """
-        if tup not in self.get_bonds() and tup[::-1] not in self.get_bonds():
-            print(f"Bond {tup} not found in compound! Aborting...")
-            return
-        pair = [p for i, p in enumerate(self.particles()) if i == tup[0] or i == tup[1]]
-        test = np.where(abs(pair[0].xyz - pair[1].xyz) > self.box.maxs / 2)[1]
-        if test.size > 0:
-            return True
-        else:
-            return False
-
-    def unwrap_position(self, tup):
+        list of np.ndarray, the atom indices in each bead
         """
-        Given the indices of a bonded pair which spans the periodic boundary,
-        moves the second index to it's real-space position.
-
-        Parameters
-        ----------
-        tup : tuple, indices (2) of bonded particles
-
-        Returns
-        -------
-        np.ndarray(3,), unwrapped coordinates for index in tup[1]
-        (if you want to move the first index, enter it as tup[::-1])
-        """
-        freud_box = mb_to_freud_box(self.box)
-        pair = [p for i, p in enumerate(self.particles()) if i == tup[0] or i == tup[1]]
-        diff = pair[0].pos - pair[1].pos
-        img = np.where(diff > self.box.maxs / 2, 1, 0) + np.where(
-            diff < -self.box.maxs / 2, -1, 0
-        )
-        return freud_box.unwrap(pair[1].pos, img)
+        return np.split(self.bead_atoms, self.bead_offsets[1:-1])
 
-
-    @classmethod
-    def from_mbuild(cls, compound):
+    def to_compound(self):
         """
-        Instantiates a CG_Compound and follows mb.Compound.deep_copy
-        to copy particles and bonds to CG_Compound
-
-        Parameters
-        ----------
-        compound : mb.Compound to be compied
+        Builds the atomistic structure as a CG_Compound
 
         Returns
         -------
         CG_Compound
         """
+        from cg_compound import CG_Compound
 
-        comp = cls()
-
-        clone_dict = {}
-        comp.name = deepcopy(compound.name)
-        comp.periodicity = deepcopy(compound.periodicity)
-        comp._pos = deepcopy(compound._pos)
-        comp.port_particle = deepcopy(compound.port_particle)
-        comp._check_if_contains_rigid_bodies = deepcopy(
-            compound._check_if_contains_rigid_bodies
+        return CG_Compound.from_arrays(
+            self.xyz.astype(float), self.names, bonds=self.bonds, box=self.box
         )
-        comp._contains_rigid = deepcopy(compound._contains_rigid)
-        comp._rigid_id = deepcopy(compound._rigid_id)
-        comp._charge = deepcopy(compound._charge)
-
-        if compound.children is None:
-            comp.children = None
-        else:
-            comp.children = OrderedSet()
-        # Parent should be None initially.
-        comp.parent = None
-        comp.labels = OrderedDict()
-        comp.referrers = set()
-        comp.bond_graph = None
-        for p in compound.particles():
-            new_particle = mb.Particle(name=p.name, pos=p.xyz.flatten())
-            comp.add(new_particle)
-            clone_dict[p] = new_particle
-
-        for c1, c2 in compound.bonds():
-            try:
-                comp.add_bond((clone_dict[c1], clone_dict[c2]))
-            except KeyError:
-                raise MBuildError(
-                    "Cloning failed. Compound contains bonds to "
-                    "Particles outside of its containment hierarchy."
-                )
-        return comp
-
-    def visualize(self, show_ports=False, backend='py3dmol',
-            color_scheme={}, show_atomistic=False, scale=1.0): # pragma: no cover
-        """
-        Visualize the Compound using py3dmol (default) or nglview.
-        Allows for visualization of a Compound within a Jupyter Notebook.
-        Parameters
-        ----------
-        show_ports : bool, optional, default=False
-            Visualize Ports in addition to Particles
-        backend : str, optional, default='py3dmol'
-            Specify the backend package to visualize compounds
-            Currently supported: py3dmol, nglview
-        color_scheme : dict, optional
-            Specify coloring for non-elemental particles
-            keys are strings of the particle names
-            values are strings of the colors
-            i.e. {'_CGBEAD': 'blue'}
-        NOTE!: Only py3dmol will work with CG_Compounds
-        """
-        viz_pkg = {'nglview': self._visualize_nglview,
-                'py3dmol': self._visualize_py3dmol}
-        if run_from_ipython():
-            if backend.lower() in viz_pkg:
-                return viz_pkg[backend.lower()](show_ports=show_ports,
-                        color_scheme=color_scheme, show_atomistic=show_atomistic, scale=scale)
-            else:
-                raise RuntimeError("Unsupported visualization " +
-                        "backend ({}). ".format(backend) +
-                        "Currently supported backends include nglview and py3dmol")
-
-        else:
-            raise RuntimeError('Visualization is only supported in Jupyter '
-                               'Notebooks.')
-
-
-    def _visualize_py3dmol(self,
-            show_ports=False,
-            color_scheme={},
-            show_atomistic=False,
-            scale=1.0):
-        """
-        Visualize the Compound using py3Dmol.
-        Allows for visualization of a Compound within a Jupyter Notebook.
-        Modified to show atomistic elements (translucent) with larger CG beads.
-
-        Parameters
-        ----------
-        show_ports : bool, optional, default=False
-            Visualize Ports in addition to Particles
-        color_scheme : dict, optional
-            Specify coloring for non-elemental particles
-            keys are strings of the particle names
-            values are strings of the colors
-            i.e. {'_CGBEAD': 'blue'}
-        show_atomistic : show the atomistic structure stored in CG_Compound.atomistic
-
-        Returns
-        ------
-        view : py3Dmol.view
-        """
-        py3Dmol = import_("py3Dmol")
-
-        atom_names = []
-
-        if self.atomistic is not None and show_atomistic:
-            atomistic = mb.clone(self.atomistic)
-            for particle in atomistic.particles():
-                if not particle.name:
-                    particle.name = "UNK"
-                else:
-                    if (particle.name != 'Compound') and (particle.name != 'CG_Compound'):
-                        atom_names.append(particle.name)
-
-        coarse = mb.clone(self)
-        modified_color_scheme = {}
-        for name, color in color_scheme.items():
-            # Py3dmol does some element string conversions,
-            # first character is as-is, rest of the characters are lowercase
-            new_name = name[0] + name[1:].lower()
-            modified_color_scheme[new_name] = color
-            modified_color_scheme[name] = color
-
-        cg_names = []
-        for particle in coarse.particles():
-            if not particle.name:
-                particle.name = "UNK"
-            else:
-                if (particle.name != 'Compound') and (particle.name != 'CG_Compound'):
-                    cg_names.append(particle.name)
-
-
-        tmp_dir = tempfile.mkdtemp()
-
-        view = py3Dmol.view()
-
-        if atom_names:
-            atomistic.save(
-                os.path.join(tmp_dir, "atomistic_tmp.mol2"),
-                show_ports=show_ports,
-                overwrite=True,
-            )
-
-            # atomistic
-            with open(os.path.join(tmp_dir, "atomistic_tmp.mol2"), "r") as f:
-                view.addModel(f.read(), "mol2", keepH=True)
-
-            if cg_names:
-                opacity = 0.6
-            else:
-                opacity = 1.0
-
-            view.setStyle(
-                {
-                    "stick": {"radius": 0.2 * scale, "opacity": opacity, "color": "grey"},
-                    "sphere": {
-                        "scale": 0.3 * scale,
-                        "opacity": opacity,
-                        "colorscheme": modified_color_scheme,
-                    },
-                }
-            )
-
-        # coarse
-        if cg_names:
-            coarse.save(
-                os.path.join(tmp_dir, "coarse_tmp.mol2"),
-                show_ports=show_ports,
-                overwrite=True,
-            )
-            with open(os.path.join(tmp_dir, "coarse_tmp.mol2"), "r") as f:
-                view.addModel(f.read(), "mol2", keepH=True)
-
-            if self.atomistic is None:
-                scale = 0.3 * scale
-            else:
-                scale = 0.7 * scale
-
-            view.setStyle(
-                {"atom": cg_names},
-                {
-                    "stick": {"radius": 0.2 * scale, "opacity": 1, "color": "grey"},
-                    "sphere": {
-                        "scale": scale,
-                        "opacity": 1,
-                        "colorscheme": modified_color_scheme,
-                    },
-                },
-            )
-
-        view.zoomTo()
-
-        return view
-
-    def remove_coarse(self):
-        """
-        all coarse-grained particles are named starting with '_'
-        remove any particles whose names start with '_'
-        """
-        for i in self.particles():
-            if i.name[0] == "_":
-                self.remove(i)
-        # Remove residual ports
-        for child in self.children:
-            if type(child) == mb.port.Port:
-                self.remove(child)